@@ -0,0 +1,1185 @@
+"""Benchmarks for the WeCare Product Management System
+
+Run with: python benchmark.py memory --rows 1000000
+          python benchmark.py durability --transactions 2000 --threads 8
+          python benchmark.py storage --rows 10000 100000 1000000
+          python benchmark.py stress --processes 8 --attempts 500
+          python benchmark.py invoice-numbers --count 100000 --processes 4
+          python benchmark.py report --lines 10000000 --days 30
+          python benchmark.py eligible --rows 1000000 --queries 1000
+          python benchmark.py search --rows 1000000
+          python benchmark.py load --rows 1000000
+          python benchmark.py startup --rows 1000000
+          python benchmark.py restock --rows 1000000 --lines 10000
+          python benchmark.py service --rows 100000 --clients 32 --requests 20000
+          python benchmark.py reorder --rows 1000000
+          python benchmark.py end-of-day --invoices 20000
+          python benchmark.py pricing --rows 1000000 --lines 500
+          python benchmark.py metrics --rows 100000
+          python benchmark.py replication --stores 4 --changes 5000 --rows 10000
+          python benchmark.py suite --sizes 1000 10000 100000 --output results.json [--compare old.json]
+          python benchmark.py generate --rows 100000 --orders 10000 --output-dir data
+"""
+import argparse
+import asyncio
+from collections import Counter
+import csv
+from datetime import date, datetime, timedelta
+import gc
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import newtry
+
+NAMES = ["Vitamin C Serum", "Skin Cleanser", "Sunscreen", "Aloe Vera Gel",
+         "Night Cream", "Face Wash", "Lip Balm", "Toner", "Hair Oil", "Body Lotion"]
+BRANDS = ["Garnier", "Cetaphil", "Aqualogica", "Nature Republic", "Olay",
+          "Neutrogena", "Nivea", "Cosrx", "Himalaya", "Mamaearth"]
+ORIGINS = ["France", "Switzerland", "India", "South Korea", "USA", "Germany", "Nepal"]
+
+# Realistic catalog: (category, cost price range in NPR), sizes scaling the
+# price, and brands with a home country, most popular first
+CATEGORIES = [("Serum", 800, 4000), ("Cleanser", 200, 1200), ("Sunscreen", 400, 2000),
+              ("Moisturizer", 500, 3000), ("Toner", 300, 1500), ("Face Mask", 100, 800),
+              ("Lip Balm", 100, 500), ("Shampoo", 200, 1200), ("Body Lotion", 300, 1500),
+              ("Eye Cream", 900, 5000), ("Night Cream", 600, 3500), ("Face Wash", 150, 900)]
+INGREDIENTS = ["Vitamin C", "Hyaluronic", "Niacinamide", "Retinol", "Aloe Vera", "Green Tea",
+               "Snail Mucin", "Charcoal", "Rose", "Ceramide", "Brightening", "Hydrating",
+               "Oil-Free", "Gentle", "Daily", "Salicylic", "Centella", "Tea Tree"]
+PACK_SIZES = [("30ml", 0.6), ("50ml", 1.0), ("100ml", 1.7), ("200ml", 2.8)]
+BRAND_ORIGINS = [("Garnier", "France"), ("Cetaphil", "Switzerland"), ("Nivea", "Germany"),
+                 ("Himalaya", "India"), ("Olay", "USA"), ("Neutrogena", "USA"), ("Mamaearth", "India"),
+                 ("Cosrx", "South Korea"), ("L'Oreal", "France"), ("The Ordinary", "Canada"),
+                 ("Innisfree", "South Korea"), ("Aqualogica", "India"), ("Nature Republic", "South Korea"),
+                 ("Clinique", "USA"), ("Biotique", "India"), ("Laneige", "South Korea"),
+                 ("Bioderma", "France"), ("Vaseline", "USA"), ("Lakme", "India"), ("Klairs", "South Korea"),
+                 ("Some By Mi", "South Korea"), ("La Roche-Posay", "France"), ("Plum", "India"),
+                 ("Dove", "UK"), ("Simple", "UK"), ("Eucerin", "Germany"), ("Minimalist", "India"),
+                 ("Etude House", "South Korea"), ("Glow Recipe", "USA"), ("Khadi", "Nepal")]
+CUSTOMERS = ["Aarav", "Sita", "Bikash", "Anjali", "Ramesh", "Priya", "Suman", "Nisha", "Kiran",
+             "Pooja", "Rohan", "Asha", "Dipesh", "Maya", "Sanjay", "Rita", "Binod", "Gita"]
+
+def realistic_products(rows, seed=42):
+    """Yield (id, name, brand, quantity, price, origin) tuples for a realistic catalog
+
+    Brand popularity follows a Zipf-like curve, most products come from the
+    brand's home country, prices depend on category and pack size, and a
+    share of products is sold out or nearly so.
+    """
+    rng = random.Random(seed)
+    brand_weights = list(itertools.accumulate(1 / rank ** 1.1 for rank in range(1, len(BRAND_ORIGINS) + 1)))
+    origins = sorted({origin for _, origin in BRAND_ORIGINS})
+    for product_id in range(1, rows + 1):
+        brand, origin = rng.choices(BRAND_ORIGINS, cum_weights=brand_weights)[0]
+        if rng.random() < 0.15:
+            origin = rng.choice(origins)  # made under licence elsewhere
+        category, low, high = rng.choice(CATEGORIES)
+        size, factor = rng.choice(PACK_SIZES)
+        price = round(rng.uniform(low, high) * factor)
+        stock = rng.random()
+        quantity = 0 if stock < 0.05 else rng.randint(1, 10) if stock < 0.15 else int(rng.lognormvariate(4.5, 0.8))
+        yield (product_id, f"{rng.choice(INGREDIENTS)} {category} {size}", brand,
+               min(quantity, newtry.MAX_RESTOCK_QUANTITY), float(price), origin)
+
+def write_realistic_catalog(path, rows, seed=42):
+    """Write a realistic products file, streaming so 10^7 rows fit in memory"""
+    with open(path, "w") as file:
+        lines = []
+        for product in realistic_products(rows, seed):
+            lines.append(",".join(newtry.quote_field(field) for field in product))
+            if len(lines) >= 100000:
+                file.write("\n".join(lines) + "\n")
+                lines = []
+        file.write("\n".join(lines))
+
+def generate_orders(store, count, seed=42):
+    """Yield batch-mode orders against a ProductStore
+
+    Popular products (the first fifth of the catalog) get 80% of the lines.
+    Quantities favour multiples of 3, and lines that earn free items choose
+    named free items, the best-value pick or the 50% discount.
+    """
+    rng = random.Random(seed)
+    rows = len(store)
+    hot = max(1, rows // 5)
+    prices = store.prices
+    for n in range(1, count + 1):
+        items = []
+        for _ in range(rng.choices((1, 2, 3, 4), weights=(50, 30, 15, 5))[0]):
+            i = rng.randrange(hot) if rng.random() < 0.8 else rng.randrange(rows)
+            quantity = rng.choices((1, 2, 3, 4, 5, 6, 9), weights=(30, 15, 25, 5, 5, 15, 5))[0]
+            item = {'id': store.ids[i], 'quantity': quantity}
+            if quantity >= 3:
+                reward = rng.choices(("free", "best", "discount"), weights=(40, 30, 30))[0]
+                if reward == "free":
+                    candidates = [j for j in (rng.randrange(rows) for _ in range(8)) if prices[j] <= prices[i]]
+                    if candidates:
+                        item['free'] = [{'id': store.ids[candidates[0]], 'quantity': quantity // 3}]
+                    else:
+                        reward = "best"
+                item['reward'] = reward
+            items.append(item)
+        yield {'order_id': n, 'customer': rng.choice(CUSTOMERS), 'items': items}
+
+def write_synthetic_catalog(path, rows, seed=42):
+    """Write a synthetic products file with the given number of rows"""
+    rng = random.Random(seed)
+    with open(path, "w") as file:
+        lines = []
+        for product_id in range(1, rows + 1):
+            lines.append(f"{product_id},{rng.choice(NAMES)} {product_id},{rng.choice(BRANDS)},"
+                         f"{rng.randint(0, 1000)},{rng.randint(50, 5000)}.0,{rng.choice(ORIGINS)}")
+            if len(lines) >= 100000:
+                file.write("\n".join(lines) + "\n")
+                lines = []
+        file.write("\n".join(lines))
+
+def measure(loader, path):
+    """Return (bytes allocated, seconds) for loading the catalog with loader"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = loader(path)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, elapsed
+
+def bench_memory(rows):
+    """Compare the dict-per-product layout against the columnar ProductStore"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        print(f"\nMemory benchmark: {rows:,} products")
+        print("{:<25} {:>15} {:>15} {:>10}".format('Layout', 'Total (MB)', 'Bytes/row', 'Load (s)'))
+        print("-" * 68)
+        for label, loader in (("list of dicts", newtry.parse_products_file),
+                              ("columnar ProductStore", newtry.load_product_store)):
+            used, elapsed = measure(loader, path)
+            print("{:<25} {:>15,.1f} {:>15,.0f} {:>10.2f}".format(
+                label, used / 1e6, used / rows, elapsed))
+
+def bench_durability(transactions, threads):
+    """Measure committed transactions and reservations per second for each durability level"""
+    print(f"\nDurability benchmark: {transactions:,} transactions on {threads} threads")
+    print("{:<10} {:<8} {:>12} {:>12} {:>10}".format('Level', 'Call', 'Tx/s', 'fsyncs', 'Time (s)'))
+    print("-" * 57)
+    for level in newtry.DURABILITY_LEVELS:
+        for call in ("commit", "reserve"):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "products.txt")
+                write_synthetic_catalog(path, 1000)
+                storage = newtry.TextStorage(path, compact_after=float("inf"), durability=level)
+                storage.load()
+                per_thread = transactions // threads
+
+                def worker(seed):
+                    rng = random.Random(seed)
+                    for _ in range(per_thread):
+                        changes = [newtry.StockChange('sale', rng.randint(1, 1000), -1, None)]
+                        if call == "commit":
+                            storage.commit(changes)
+                        else:
+                            storage.reserve(changes, lambda product_id: transactions)
+
+                workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+                start = time.perf_counter()
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+                fsyncs = {"none": 0, "group": storage._group.fsyncs, "always": per_thread * threads}[level]
+                print("{:<10} {:<8} {:>12,.0f} {:>12,} {:>10.2f}".format(
+                    level, call, per_thread * threads / elapsed, fsyncs, elapsed))
+
+def timed(func, repeat=1):
+    """Return the average seconds per call of func over repeat calls"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def bench_storage(sizes, lookups=1000):
+    """Compare the text and SQLite backends on load, lookups and sales"""
+    print("\nStorage benchmark (lookups and sales are averages per call)")
+    print("{:>10} {:<8} {:>10} {:>12} {:>14} {:>14} {:>12}".format(
+        'Rows', 'Backend', 'Load (s)', 'Import (s)', 'By id (us)', 'By brand (ms)', 'Sale (us)'))
+    print("-" * 86)
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            text_path = os.path.join(tmp, "products.txt")
+            db_path = os.path.join(tmp, "products.db")
+            write_synthetic_catalog(text_path, rows)
+            rng = random.Random(1)
+            ids = [rng.randint(1, rows) for _ in range(lookups)]
+
+            text = newtry.TextStorage(text_path, compact_after=float("inf"), durability="none")
+            catalog = newtry.ProductCatalog(text)
+            load = timed(catalog.refresh)
+            by_id = timed(lambda: [catalog.get(i) for i in ids]) / lookups
+            by_brand = timed(lambda: catalog.find_by_brand("Olay"), 10)
+            sale = timed(lambda: text.commit([newtry.StockChange('sale', rng.choice(ids), -1, None)]), lookups)
+            print("{:>10,} {:<8} {:>10.2f} {:>12} {:>14.2f} {:>14.2f} {:>12.1f}".format(
+                rows, 'text', load, '-', by_id * 1e6, by_brand * 1e3, sale * 1e6))
+
+            sqlite = newtry.SQLiteStorage(db_path, durability="none")
+            imported = timed(lambda: sqlite.import_text(text_path))
+            load = timed(sqlite.load)
+            by_id = timed(lambda: [sqlite.get(i) for i in ids]) / lookups
+            by_brand = timed(lambda: sqlite.find_by_brand("Olay"), 10)
+            sale = timed(lambda: sqlite.commit([newtry.StockChange('sale', rng.choice(ids), -1, None)]), lookups)
+            sqlite.close()
+            print("{:>10,} {:<8} {:>10.2f} {:>12.2f} {:>14.2f} {:>14.2f} {:>12.1f}".format(
+                rows, 'sqlite', load, imported, by_id * 1e6, by_brand * 1e3, sale * 1e6))
+
+def _stress_worker(backend, path, products, attempts, seed, results):
+    """Sell random products from one terminal process until attempts run out"""
+    storage = (newtry.TextStorage(path, durability="none") if backend == "text"
+               else newtry.SQLiteStorage(path, durability="none"))
+    catalog = newtry.ProductCatalog(storage)
+    catalog.refresh()
+    rng = random.Random(seed)
+    sold = Counter()
+    rejected = 0
+    for _ in range(attempts):
+        product_id = rng.randint(1, products)
+        quantity = rng.randint(1, 5)
+        try:
+            catalog.reserve(catalog.get(product_id), quantity)
+            sold[product_id] += quantity
+        except newtry.StockConflict:
+            rejected += 1
+    storage.wait_for_compaction()
+    results.put((dict(sold), rejected))
+
+def check_lagging_compaction(products=5, stock=500):
+    """Compact from a terminal that has not polled another terminal's sales
+
+    Once with one unseen entry and once with more than the compacted
+    ledger holds; both must leave every terminal with the same stock.
+    """
+    problems = []
+    for unseen in (1, 200):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "products.txt")
+            initial = [{'id': i, 'name': f"Product {i}", 'brand': "Brand", 'quantity': stock,
+                        'price': 100.0, 'origin': "Nepal"} for i in range(1, products + 1)]
+            newtry.TextStorage(path).save(initial)
+            lagging = newtry.ProductCatalog(newtry.TextStorage(path, compact_after=float("inf")))
+            other = newtry.ProductCatalog(newtry.TextStorage(path, compact_after=float("inf")))
+            lagging.refresh()
+            other.refresh()
+            lagging.reserve(lagging.get(1), 1)
+            for n in range(unseen):
+                other.reserve(other.get(n % products + 1), 1)
+            lagging.storage.compact()
+            lagging.refresh()
+            other.refresh()
+            fresh = newtry.ProductCatalog(newtry.TextStorage(path))
+            fresh.refresh()
+            for product_id in range(1, products + 1):
+                counts = [catalog.get(product_id)['quantity'] for catalog in (lagging, other, fresh)]
+                if len(set(counts)) > 1:
+                    problems.append(f"{unseen} unseen entries: product {product_id} has "
+                                    f"{counts[0]} / {counts[1]} / {counts[2]} in lagging / other / fresh")
+    print("\ncompaction behind other terminals:")
+    print("  " + ("\n  ".join(problems) if problems else "✓ no stock lost or oversold"))
+    return not problems
+
+def stress(processes, attempts, products=5, stock=500):
+    """Run concurrent terminals against one catalog and check no stock is lost"""
+    ok = True
+    for backend in newtry.STORAGE_BACKENDS:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "products.txt" if backend == "text" else "products.db")
+            initial = [{'id': i, 'name': f"Product {i}", 'brand': "Brand", 'quantity': stock,
+                        'price': 100.0, 'origin': "Nepal"} for i in range(1, products + 1)]
+            storage = (newtry.TextStorage(path) if backend == "text" else newtry.SQLiteStorage(path))
+            storage.save(initial)
+
+            results = multiprocessing.Queue()
+            workers = [multiprocessing.Process(target=_stress_worker,
+                                               args=(backend, path, products, attempts, seed, results))
+                       for seed in range(processes)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            outcomes = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+            sold = Counter()
+            rejected = 0
+            for worker_sold, worker_rejected in outcomes:
+                sold.update(worker_sold)
+                rejected += worker_rejected
+            final = newtry.ProductCatalog(newtry.TextStorage(path) if backend == "text"
+                                          else newtry.SQLiteStorage(path))
+            final.refresh()
+            problems = []
+            for product_id in range(1, products + 1):
+                left = final.get(product_id)['quantity']
+                if left < 0:
+                    problems.append(f"product {product_id} oversold: {left}")
+                if left != stock - sold[product_id]:
+                    problems.append(f"product {product_id}: {left} left but {sold[product_id]} of {stock} sold")
+            ok = ok and not problems
+            print(f"\n{backend}: {processes} terminals x {attempts} sales in {elapsed:.2f}s "
+                  f"({processes * attempts / elapsed:,.0f} reservations/s), "
+                  f"{sum(sold.values())} units sold, {rejected} rejected")
+            print("  " + ("\n  ".join(problems) if problems else "✓ no stock lost or oversold"))
+    return check_lagging_compaction() and ok
+
+def _number_worker(path, count, block_size, results):
+    sequence = newtry.InvoiceSequence(path, block_size)
+    results.put([sequence.next() for _ in range(count)])
+
+def bench_invoice_numbers(count, processes, block_size=newtry.INVOICE_BLOCK_SIZE):
+    """Allocate invoice numbers from several processes and check uniqueness"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "invoice.seq")
+        results = multiprocessing.Queue()
+        per_process = count // processes
+        workers = [multiprocessing.Process(target=_number_worker, args=(path, per_process, block_size, results))
+                   for _ in range(processes)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        numbers = [number for _ in workers for number in results.get()]
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+    duplicates = len(numbers) - len(set(numbers))
+    print(f"\nInvoice numbers: {len(numbers):,} from {processes} processes in {elapsed:.2f}s "
+          f"({len(numbers) / elapsed:,.0f}/s including process start-up), {duplicates} duplicates")
+    return duplicates == 0
+
+def write_synthetic_transactions(directory, lines, days, products=10000, seed=42):
+    """Write lines synthetic transaction rows spread over days day files"""
+    rng = random.Random(seed)
+    log = newtry.TransactionLog(directory)
+    header = ",".join(newtry.TRANSACTION_FIELDS) + "\n"
+    catalog = [(f"{rng.choice(NAMES)} {n}", rng.choice(BRANDS), rng.choice(ORIGINS), rng.randint(50, 5000))
+               for n in range(1, products + 1)]
+    customers = [f"Customer {n}" for n in range(1000)]
+    per_day = lines // days
+    os.makedirs(directory, exist_ok=True)
+    for day in range(days):
+        stamp = (date(2025, 1, 1) + timedelta(days=day)).isoformat()
+        with open(log.path(stamp), "w") as file:
+            file.write(header)
+            batch = []
+            for n in range(per_day):
+                product_id = rng.randint(1, products)
+                name, brand, origin, price = catalog[product_id - 1]
+                line = "free" if n % 10 == 9 else "sale"
+                customer, quantity = rng.choice(customers), rng.randint(1, 6)
+                batch.append(f"{stamp} 12:00:00,SALE_{n},sale,{customer},{product_id},{name},"
+                             f"{brand},{origin},{line},{quantity},{price}.0,"
+                             f"{0 if line == 'free' else price * 3}.0,0,{0 if line == 'free' else quantity // 3}\n")
+                if len(batch) >= 100000:
+                    file.write("".join(batch))
+                    batch = []
+            file.write("".join(batch))
+    return log
+
+def csv_columns(text):
+    """Transaction columns the way the report used to parse them: csv.reader, then transposed"""
+    columns = list(zip(*csv.reader(io.StringIO(text))))
+    return list(columns[:9]) + [list(map(float, column)) for column in columns[9:]]
+
+def bench_report(lines, days, workers=None, target=10000000):
+    """Time the sales report over a synthetic transaction log
+
+    Also times parsing alone, csv.reader against the split used by the
+    report, and projects how long target lines take at the measured rate.
+    """
+    workers = workers or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        log = write_synthetic_transactions(os.path.join(tmp, "Transactions"), lines, days)
+        size = sum(os.path.getsize(path) for path in log.files())
+        chunks = newtry.report_chunks(log.files())
+        print(f"\nReport benchmark: {lines:,} line items in {days} day files ({size / 1e6:,.0f} MB)")
+        header = ",".join(newtry.TRANSACTION_FIELDS) + "\n"
+        texts = [newtry.read_chunk(*chunk).replace(header, "") for chunk in chunks[:4]]
+        parsed = sum(text.count("\n") for text in texts)
+        for label, parse in (("csv.reader", csv_columns), ("columns", newtry.transaction_columns)):
+            elapsed = timed(lambda: [parse(text) for text in texts])
+            print(f"Parse with {label:<11} {parsed / elapsed:>12,.0f} lines/s per core")
+        print("{:<10} {:>8} {:>10} {:>14} {:>22}".format('By', 'Workers', 'Time (s)', 'Lines/s',
+                                                       f'{target / 1e6:,.0f}M lines (s)'))
+        print("-" * 68)
+        single = []
+        for dimension in ("product", "brand", "customer"):
+            for count in sorted({1, workers}):
+                start = time.perf_counter()
+                newtry.aggregate_transactions(dimension, workers=count, log=log)
+                elapsed = time.perf_counter() - start
+                if count == 1:
+                    single.append(lines / elapsed)
+                print("{:<10} {:>8} {:>10.2f} {:>14,.0f} {:>22.1f}".format(
+                    dimension, count, elapsed, lines / elapsed, target * elapsed / lines))
+        print(f"{target / 1e6:,.0f}M lines in 10 s needs about {target / 10 / min(single):,.0f} "
+              f"cores at the slowest single-worker rate")
+
+def bench_eligible(rows, queries, limit=newtry.PAGE_SIZE):
+    """Compare the full scan for free-item eligibility with the price index"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        catalog = newtry.ProductCatalog(newtry.TextStorage(path, durability="none"))
+        catalog.refresh()
+        rng = random.Random(7)
+        prices = [float(rng.randint(50, 5000)) for _ in range(queries)]
+        products = list(catalog.products)
+
+        def scan():
+            for base_price in prices:
+                eligible = [p for p in products if p['price'] <= base_price and p['quantity'] > 0]
+                eligible[:limit]
+
+        def indexed():
+            for base_price in prices:
+                catalog.list_products(max_price=base_price, in_stock=True, sort='price',
+                                      descending=True, limit=limit)
+
+        build = timed(catalog.in_stock_by_price)
+        scan_time = timed(scan) / queries
+        index_time = timed(indexed) / queries
+        listing = timed(lambda: catalog.list_products(in_stock=True, offset=rows // 100), queries)
+        ids = [rng.randint(1, rows) for _ in range(queries)]
+        update = timed(lambda: [catalog.adjust_stock(catalog.get(i), -catalog.get(i)['quantity'], 'sale')
+                                for i in ids]) / queries
+        print(f"\nFree-item eligibility: {rows:,} products, {queries:,} queries (first {limit} results)")
+        print(f"  full scan        {scan_time * 1e3:>10.3f} ms/query")
+        print(f"  price index      {index_time * 1e3:>10.3f} ms/query ({scan_time / index_time:,.0f}x faster)")
+        print(f"  index build      {build:>10.3f} s")
+        print(f"  in-stock listing {listing * 1e3:>10.3f} ms/page (catalog order, page {rows // 100 // limit + 1})")
+        print(f"  sell out update  {update * 1e6:>10.1f} us/change")
+
+SEARCH_QUERIES = ["garnier", "vitamin serum", "sun", "nivea body lot", "serom", "cetaphl skin",
+                  "night cream 4242", "mamaearth hair oil"]
+
+def bench_search(rows, repeat=200):
+    """Time search index build, queries and incremental adds"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        catalog = newtry.ProductCatalog(newtry.TextStorage(path, durability="none"))
+        catalog.refresh()
+        build = timed(lambda: catalog.search("warm-up"))
+        print(f"\nSearch benchmark: {rows:,} products, index built in {build:.2f}s")
+        print("{:<25} {:>10} {:>12}".format('Query', 'Results', 'Time (ms)'))
+        print("-" * 49)
+        for query in SEARCH_QUERIES:
+            found = len(catalog.search(query))
+            print("{:<25} {:>10} {:>12.3f}".format(query, found, timed(lambda: catalog.search(query), repeat) * 1e3))
+        next_id = catalog.next_id()
+
+        def add():
+            catalog.add({'id': next_id, 'name': f"Snail Essence {next_id}", 'brand': "Cosrx",
+                         'quantity': 1, 'price': 100.0, 'origin': "South Korea"})
+            catalog.commit()
+        print(f"Add one product (ledger commit + incremental index update): {timed(add) * 1e3:.3f} ms")
+
+def consume_batches(path):
+    """Stream the products file without keeping it, summing stock as a stand-in for real work"""
+    return sum(sum(batch.quantities) for batch in newtry.iter_product_batches(path))
+
+def bench_load(rows):
+    """Products file parse throughput and peak memory per loader"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        size = os.path.getsize(path)
+        print(f"\nLoad benchmark: {rows:,} products ({size / 1e6:,.0f} MB)")
+        print("{:<30} {:>10} {:>14} {:>14}".format('Loader', 'Time (s)', 'Rows/s', 'Peak (MB)'))
+        print("-" * 71)
+        for label, loader in (("line by line (list of dicts)", newtry.parse_products_file),
+                              ("streaming batches", consume_batches),
+                              ("columnar ProductStore", newtry.load_product_store)):
+            gc.collect()
+            elapsed = min(timed(lambda: loader(path)) for _ in range(3))
+            # Measured separately: tracing allocations slows parsing down several times
+            tracemalloc.start()
+            result = loader(path)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del result
+            print("{:<30} {:>10.2f} {:>14,.0f} {:>14,.1f}".format(label, elapsed, rows / elapsed, peak / 1e6))
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import newtry
+path, mode, product_id = sys.argv[1], sys.argv[2], int(sys.argv[3])
+imported = time.perf_counter()
+catalog = newtry.ProductCatalog(newtry.TextStorage(path))
+if mode == "text":
+    catalog.set_products(newtry.load_product_store(path))
+else:
+    catalog.refresh()
+loaded = time.perf_counter()
+name = catalog.get(product_id)['name']
+found = time.perf_counter()
+print(json.dumps({"load": loaded - imported, "lookup": found - loaded, "total": found - start}))
+"""
+
+def bench_startup(rows, runs=3):
+    """Cold start of a fresh process from the text file vs the binary snapshot"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        newtry.TextStorage(path).load()  # writes products.bin
+        here = os.path.dirname(os.path.abspath(__file__))
+        print(f"\nStartup benchmark: {rows:,} products, best of {runs} fresh processes")
+        print("{:<10} {:>12} {:>18} {:>12}".format('Snapshot', 'Load (s)', 'First lookup (us)', 'Total (s)'))
+        print("-" * 55)
+        for mode in ("text", "binary"):
+            results = []
+            for _ in range(runs):
+                output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, path, mode, str(rows // 2)],
+                                        capture_output=True, text=True, check=True, cwd=here).stdout
+                results.append(json.loads(output))
+            best = min(results, key=lambda result: result['total'])
+            print("{:<10} {:>12.3f} {:>18.1f} {:>12.3f}".format(
+                mode, best['load'], best['lookup'] * 1e6, best['total']))
+
+def write_synthetic_manifest(path, catalog_path, rows, lines, seed=42):
+    """Write a supplier manifest: a third by id, a third by name and brand, a third new products"""
+    rng = random.Random(seed)
+    names = {}
+    with open(catalog_path) as file:
+        for line in file:
+            product_id, name, brand = line.split(",", 3)[:3]
+            names[int(product_id)] = (name, brand)
+    with open(path, "w") as file:
+        file.write("id,name,brand,quantity,price,origin\n")
+        for n in range(lines):
+            quantity = rng.randint(1, 500)
+            if n % 3 == 0:
+                file.write(f"{rng.randint(1, rows)},,,{quantity},,\n")
+            elif n % 3 == 1:
+                name, brand = names[rng.randint(1, rows)]
+                file.write(f",{name.upper()},{brand},{quantity},,\n")
+            else:
+                file.write(f",{rng.choice(NAMES)} New {n},{rng.choice(BRANDS)},{quantity},"
+                           f"{rng.randint(50, 5000)}.0,{rng.choice(ORIGINS)}\n")
+
+def bench_restock(rows, lines):
+    """Time a bulk restock import against a catalog of the given size"""
+    here = os.getcwd()
+    saved = newtry.catalog
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        manifest = os.path.join(tmp, "manifest.csv")
+        write_synthetic_manifest(manifest, path, rows, lines)
+        os.chdir(tmp)
+        try:
+            newtry.catalog = newtry.ProductCatalog(newtry.TextStorage(path))
+            load = timed(newtry.read_products)
+            print(f"\nRestock import: {lines:,} manifest lines into {rows:,} products (catalog loaded in {load:.2f}s)")
+            start = time.perf_counter()
+            newtry.import_manifest(manifest, "Benchmark Supplier")
+            elapsed = time.perf_counter() - start
+            print(f"  import         {elapsed:>10.3f} s ({lines / elapsed:,.0f} lines/s)")
+            newtry.catalog.storage.wait_for_compaction()
+        finally:
+            newtry.catalog = saved
+            newtry.invoice_writer.shutdown()
+            os.chdir(here)
+
+def write_synthetic_day(path, invoices, seed=42):
+    """Write a day's transaction file of multi-line sales and restock invoices"""
+    rng = random.Random(seed)
+    products = list(realistic_products(2000, seed))
+    created = datetime(2025, 1, 1, 18, 0, 0)
+    rows = []
+    for n in range(invoices):
+        items = []
+        for product in rng.sample(products, rng.randint(1, 5)):
+            quantity = rng.randint(1, 9)
+            items.append({'id': product[0], 'name': product[1], 'brand': product[2], 'origin': product[5],
+                          'quantity': quantity, 'price': product[4], 'unit_price': product[4] * 3,
+                          'discount': 0, 'free_earned': quantity // 3})
+        invoice_no = f"SALE_20250101180000_{n:08d}"
+        if n % 20 == 19:
+            rows.extend(newtry.purchase_records(invoice_no.replace("SALE", "RESTOCK"), created, "Supplier", items))
+        else:
+            free_items = [newtry.free_item(item, item['free_earned']) for item in items if item['free_earned']]
+            rows.extend(newtry.sale_records(invoice_no, created, rng.choice(CUSTOMERS), items, free_items))
+    with open(path, "w", newline="") as file:
+        file.write(",".join(newtry.TRANSACTION_FIELDS) + "\n")
+        csv.writer(file, lineterminator="\n").writerows(rows)
+    return len(rows)
+
+def bench_end_of_day(invoices, workers=None):
+    """Time end-of-day rendering and export against archiving invoices one at a time"""
+    with tempfile.TemporaryDirectory() as tmp:
+        log = newtry.TransactionLog(os.path.join(tmp, "Transactions"))
+        os.makedirs(log.directory)
+        path = log.path("2025-01-01")
+        lines = write_synthetic_day(path, invoices)
+        print(f"\nEnd of day: {invoices:,} invoices, {lines:,} line items "
+              f"({os.path.getsize(path) / 1e6:,.1f} MB of transactions)")
+        archive = newtry.InvoiceArchive(os.path.join(tmp, "one at a time"))
+        with open(path, newline="") as file:
+            rows = list(csv.reader(file))[1:]
+        start = time.perf_counter()
+        for invoice_no, group in itertools.groupby(rows, lambda row: row[1]):
+            group = list(group)
+            created = datetime.strptime(group[0][0], '%Y-%m-%d %H:%M:%S')
+            archive.store(invoice_no, group[0][2], group[0][3], created, newtry.render_records(group))
+        baseline = time.perf_counter() - start
+        archive.close()
+        print("{:<22} {:>10} {:>14} {:>10}".format('Method', 'Time (s)', 'Invoices/s', 'Speedup'))
+        print("-" * 60)
+        print("{:<22} {:>10.2f} {:>14,.0f} {:>10}".format('one at a time', baseline, invoices / baseline, '1.0x'))
+        bundles = set()
+        counts = sorted({1, 2, 4, workers or os.cpu_count() or 1})
+        for count in counts:
+            export_dir = os.path.join(tmp, f"eod-{count}")
+            start = time.perf_counter()
+            written, exported, _ = newtry.close_day("2025-01-01", export_dir, workers=count, log=log)
+            elapsed = time.perf_counter() - start
+            print("{:<22} {:>10.2f} {:>14,.0f} {:>9.1f}x".format(
+                f"end-of-day, {count} worker{'s' if count > 1 else ''}", elapsed, written / elapsed, baseline / elapsed))
+            with open(os.path.join(export_dir, "2025-01-01-invoices.gz"), "rb") as file:
+                bundles.add(file.read())
+            assert (written, exported) == (invoices, lines)
+        # Tiny chunks put invoices across many boundaries; the output must not change
+        saved, newtry.EOD_CHUNK_BYTES = newtry.EOD_CHUNK_BYTES, 4096
+        try:
+            newtry.close_day("2025-01-01", os.path.join(tmp, "eod-small"), workers=1, log=log)
+        finally:
+            newtry.EOD_CHUNK_BYTES = saved
+        with open(os.path.join(tmp, "eod-small", "2025-01-01-invoices.gz"), "rb") as file:
+            bundles.add(file.read())
+        columns = newtry.read_line_columns(os.path.join(tmp, "eod-small", "2025-01-01-lines.wcc"))
+        same = len(bundles) == 1 and len(columns['invoice_no']) == lines
+        print(f"{'✓' if same else '✗'} identical output for every worker count and chunk size"
+              f" ({os.cpu_count()} CPUs available)")
+        return same
+
+PRICING_RULES = {
+    "markup": 3.0,
+    "brand_markup": {"Olay": 3.5, "Cetaphil": 3.2, "The Ordinary": 2.6},
+    "origin_markup": {"Nepal": 2.5, "India": 2.8},
+    "promotions": [
+        {"name": "Festival", "start": "2000-01-01", "end": "2099-12-31", "brands": ["Olay", "Nivea"], "percent": 10},
+        {"name": "Bulk", "tiers": [[6, 5], [12, 10], [24, 15]]},
+        {"name": "Local", "origins": ["Nepal"], "percent": 8},
+        {"name": "Expired", "end": "2001-01-01", "percent": 50},
+    ],
+}
+
+def bench_pricing(rows, lines, repeat=200):
+    """Time basket quotes and the selling price cache under per-brand markups and promotions"""
+    saved = newtry.catalog
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_realistic_catalog(path, rows)
+        try:
+            newtry.catalog = newtry.ProductCatalog(newtry.TextStorage(path, durability="none"))
+            newtry.catalog.refresh()
+            newtry.pricing.apply(PRICING_RULES)
+            rng = random.Random(7)
+            basket = [(rng.randint(1, rows), rng.randint(1, 30)) for _ in range(lines)]
+            build = timed(newtry.catalog.selling_prices)
+            cold = timed(lambda: newtry.quote_sale(basket))
+            quote = timed(lambda: [newtry.quote_sale(basket) for _ in range(repeat)]) / repeat
+            newtry.pricing.apply(PRICING_RULES)  # a rule change rebuilds the cache once
+            rebuild = timed(newtry.catalog.selling_prices)
+            _, total = newtry.quote_sale(basket)
+            print(f"\nPricing: {rows:,} products, baskets of {lines:,} lines, "
+                  f"{len(PRICING_RULES['promotions'])} promotions")
+            print(f"  price cache build  {build:>10.3f} s")
+            print(f"  first quote        {cold / lines * 1e6:>10.2f} us/line")
+            print(f"  quote              {quote / lines * 1e6:>10.2f} us/line ({quote * 1e3:.2f} ms/basket)")
+            print(f"  rebuild on change  {rebuild:>10.3f} s")
+            print(f"  basket total       NPR {total:,.2f}")
+        finally:
+            newtry.pricing.apply({})
+            newtry.catalog = saved
+
+def _store_worker(store, path, directory, rows, changes, snapshot_every, seed):
+    """One store's terminal: random sales and restocks published to the shared event log"""
+    newtry.events = newtry.EventLog(store, directory, snapshot_every)
+    catalog = newtry.ProductCatalog(newtry.TextStorage(path, durability="none"))
+    catalog.refresh()
+    rng = random.Random(seed)
+    for _ in range(changes):
+        product = catalog.get(rng.randint(1, rows))
+        try:
+            if rng.random() < 0.8:
+                catalog.reserve(product, rng.randint(1, 5))
+            else:
+                catalog.reserve_many([newtry.StockChange('restock', product['id'], rng.randint(10, 50), None)])
+        except newtry.StockConflict:
+            pass
+    catalog.storage.wait_for_compaction()
+    newtry.events.wait_for_snapshot()
+
+def store_stock(path):
+    """A store's quantities by product id, read straight from its storage"""
+    products = newtry.TextStorage(path).load()
+    return dict(zip(products.ids, products.quantities))
+
+def bench_replication(stores, changes, rows, snapshot_every=1000):
+    """Several store processes publish events; replicas must end up with each store's exact stock"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "Replication")
+        names = [f"store-{n}" for n in range(stores)]
+        paths = {}
+        for name in names:
+            os.makedirs(os.path.join(tmp, name))
+            paths[name] = os.path.join(tmp, name, "products.txt")
+            write_synthetic_catalog(paths[name], rows)
+
+        follower = newtry.ReplicaSet([newtry.FileTransport(directory)])
+        workers = [multiprocessing.Process(target=_store_worker,
+                                           args=(name, paths[name], directory, rows, changes, snapshot_every, seed))
+                   for seed, name in enumerate(names)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        applied = sync_time = 0
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(0.05)
+            sync_start = time.perf_counter()
+            applied += follower.sync()
+            sync_time += time.perf_counter() - sync_start
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        sync_start = time.perf_counter()
+        applied += follower.sync()
+        sync_time += time.perf_counter() - sync_start
+
+        bootstrap_start = time.perf_counter()
+        fresh = newtry.ReplicaSet([newtry.FileTransport(directory)])
+        fresh.sync()
+        bootstrap = time.perf_counter() - bootstrap_start
+
+        env = dict(os.environ, WECARE_STORE=names[0], WECARE_REPLICATION_DIR=directory)
+        server = subprocess.Popen([sys.executable, os.path.abspath(newtry.__file__), "serve", "--port", "0"],
+                                  cwd=os.path.dirname(paths[names[0]]), env=env, stdout=subprocess.PIPE, text=True)
+        try:
+            port = int(server.stdout.readline().rsplit(":", 1)[1])
+            remote = newtry.ReplicaSet([newtry.HTTPTransport(f"http://127.0.0.1:{port}")])
+            remote.sync()
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+        problems = []
+        for name in names:
+            actual = store_stock(paths[name])
+            for label, replicas in (("follower", follower), ("fresh", fresh), ("http", remote)):
+                replica = replicas.replicas.get(name)
+                if replica is None:
+                    if label != "http" or name == names[0]:
+                        problems.append(f"{label}: no replica of {name}")
+                    continue
+                copy = dict(zip(replica.products.ids, replica.products.quantities))
+                wrong = sum(1 for product_id in actual if copy.get(product_id) != actual[product_id])
+                if wrong:
+                    problems.append(f"{label}: {wrong} products of {name} differ")
+        events = sum(replica.seq for replica in follower.replicas.values())
+    print(f"\nReplication: {stores} stores x {changes:,} changes on {rows:,} products, "
+          f"snapshot every {snapshot_every:,} events")
+    print(f"Stores finished in {elapsed:.2f}s; {events:,} events published")
+    print(f"Follower applied {applied:,} events in {sync_time:.3f}s of syncing "
+          f"({applied / sync_time if sync_time else 0:,.0f} events/s)")
+    print(f"Fresh replica from snapshots + tail: {bootstrap:.3f}s")
+    print("  " + ("\n  ".join(problems) if problems else "✓ every replica matches its store's stock"))
+    return not problems
+
+def bench_reorder(rows, changes=10000):
+    """Compare a full catalog scan for low stock with the incrementally kept index"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        catalog = newtry.ProductCatalog(newtry.TextStorage(path, durability="none"))
+        catalog.refresh()
+        store = catalog.products
+
+        def scan():
+            groups = {}
+            for product in store:
+                if product['quantity'] <= catalog.reorder_point(product['id'])[0]:
+                    groups.setdefault((product['brand'], product['origin']), []).append(product)
+            return groups
+
+        scan_time = timed(scan)
+        build = timed(catalog.watch_low_stock)
+        suggest = timed(catalog.reorder_suggestions, 5)
+        low = sum(len(lines) for _, _, lines in catalog.reorder_suggestions())
+        rng = random.Random(5)
+        ids = [rng.randint(1, rows) for _ in range(changes)]
+        update = timed(lambda: [catalog.adjust_stock(catalog.get(i), -min(catalog.get(i)['quantity'], 5), 'sale')
+                                for i in ids]) / changes
+        print(f"\nLow stock: {rows:,} products, {low:,} at or below their reorder point")
+        print(f"  full scan          {scan_time * 1e3:>10.1f} ms")
+        print(f"  index build        {build * 1e3:>10.1f} ms (once)")
+        print(f"  suggested manifest {suggest * 1e3:>10.1f} ms")
+        print(f"  sale update        {update * 1e6:>10.1f} us/change")
+
+METRICS_SCRIPT = """
+import json, random, sys, time
+import newtry
+path, lookups = sys.argv[1], int(sys.argv[2])
+catalog = newtry.ProductCatalog(newtry.TextStorage(path, durability="none"))
+catalog.refresh()
+ids = [random.randint(1, len(catalog.products)) for _ in range(lookups)]
+get = catalog.get
+start = time.perf_counter()
+for product_id in ids:
+    get(product_id)
+lookup = (time.perf_counter() - start) / lookups
+start = time.perf_counter()
+for page in range(200):
+    newtry.format_product_table(*catalog.list_products(offset=page * 50, limit=50))
+page = (time.perf_counter() - start) / 200
+print(json.dumps({"lookup": lookup, "page": page}))
+"""
+
+def bench_metrics(rows, lookups=1000000, runs=3):
+    """Cost of the instrumentation on product lookups and page rendering, off vs on"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "products.txt")
+        write_synthetic_catalog(path, rows)
+        here = os.path.dirname(os.path.abspath(__file__))
+        print(f"\nInstrumentation overhead: {rows:,} products, best of {runs} fresh processes")
+        print("{:<10} {:>14} {:>14}".format('Metrics', 'Lookup (ns)', 'Page (us)'))
+        print("-" * 40)
+        for label, metrics_path in (("off", None), ("on", os.path.join(tmp, "metrics.prom"))):
+            env = dict(os.environ)
+            env.pop("WECARE_METRICS", None)
+            if metrics_path:
+                env["WECARE_METRICS"] = metrics_path
+            results = [json.loads(subprocess.run([sys.executable, "-c", METRICS_SCRIPT, path, str(lookups)],
+                                                 capture_output=True, text=True, check=True, cwd=here,
+                                                 env=env).stdout) for _ in range(runs)]
+            print("{:<10} {:>14.0f} {:>14.1f}".format(label, min(r['lookup'] for r in results) * 1e9,
+                                                      min(r['page'] for r in results) * 1e6))
+
+SUITE_SCRIPT = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import benchmark
+print(json.dumps(benchmark.run_suite_size(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))))
+"""
+
+def run_suite_size(rows, orders, seed):
+    """Drive the real load, lookup, save and sale paths in the current directory; return timings"""
+    result = {'rows': rows, 'orders': orders}
+    result['generate_s'] = timed(lambda: write_realistic_catalog(newtry.PRODUCTS_FILE, rows, seed))
+    result['load_text_s'] = timed(newtry.read_products)  # parses the text and writes the binary
+    newtry.catalog = newtry.ProductCatalog()
+    result['load_binary_s'] = timed(newtry.read_products)
+    store = newtry.catalog.products
+    rng = random.Random(seed)
+    ids = [store.ids[rng.randrange(rows)] for _ in range(100000)]
+    result['lookup_us'] = timed(lambda: [newtry.catalog.get(i) for i in ids]) / len(ids) * 1e6
+    stream = list(generate_orders(store, orders, seed))
+    result['save_s'] = timed(lambda: newtry.save_products(newtry.catalog.products))
+    latencies = []
+    sales = []
+    start = time.perf_counter()
+    for order in stream:
+        begin = time.perf_counter()
+        sales.extend(newtry.process_orders([order]))
+        latencies.append(time.perf_counter() - begin)
+    checkout = time.perf_counter() - start
+    result['invoice_flush_s'] = timed(newtry.invoice_writer.flush)
+    latencies.sort()
+    accepted = [sale for sale in sales if sale['status'] == "ok"]
+    result.update(accepted=len(accepted), free_units=sum(sale['free_units'] for sale in accepted),
+                  sale_p50_ms=percentile(latencies, 50) * 1e3, sale_p99_ms=percentile(latencies, 99) * 1e3,
+                  orders_per_s=orders / (checkout + result['invoice_flush_s']))
+    newtry.invoice_writer.shutdown()
+    newtry.catalog.storage.wait_for_compaction()
+    return result
+
+def git_revision():
+    """Return the current commit of the checkout, or None"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+SUITE_METRICS = [("load_text_s", "Load text (s)"), ("load_binary_s", "Load binary (s)"),
+                 ("lookup_us", "Lookup (us)"), ("save_s", "Save (s)"), ("sale_p50_ms", "Sale p50 (ms)"),
+                 ("sale_p99_ms", "Sale p99 (ms)"), ("invoice_flush_s", "Invoice flush (s)"),
+                 ("orders_per_s", "Orders/s")]
+
+def best_result(runs):
+    """Merge repeated runs of one size, keeping the best value of every timing"""
+    best = dict(runs[0])
+    for run in runs[1:]:
+        for key, _ in SUITE_METRICS:
+            best[key] = max(best[key], run[key]) if key == "orders_per_s" else min(best[key], run[key])
+    return best
+
+def bench_suite(sizes, orders, seed, output=None, compare=None, repeat=3):
+    """Run the suite per catalog size in fresh processes and directories, best of repeat"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, WECARE_STORAGE="text")
+    env.pop("WECARE_METRICS", None)
+    results = []
+    for rows in sizes:
+        runs = []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                output_text = subprocess.run(
+                    [sys.executable, "-c", SUITE_SCRIPT, here, str(rows), str(orders), str(seed)],
+                    capture_output=True, text=True, check=True, cwd=tmp, env=env).stdout
+                runs.append(json.loads(output_text.strip().splitlines()[-1]))
+        results.append(best_result(runs))
+    report = {'revision': git_revision(), 'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'seed': seed, 'repeat': repeat, 'results': results}
+    print(f"\nBenchmark suite: {orders:,} orders per size, seed {seed}, best of {repeat}, "
+          f"revision {report['revision']}")
+    print("{:<18}".format('Metric') + "".join("{:>14,}".format(result['rows']) for result in results))
+    print("-" * (18 + 14 * len(results)))
+    for key, label in SUITE_METRICS:
+        print("{:<18}".format(label) + "".join("{:>14.3f}".format(result[key]) for result in results))
+    print("{:<18}".format('Accepted orders') + "".join("{:>14,}".format(result['accepted']) for result in results))
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {output}")
+    if compare:
+        with open(compare) as file:
+            previous = {result['rows']: result for result in json.load(file)['results']}
+        print(f"\nChange against {compare} (negative is faster, except Orders/s)")
+        for result in results:
+            old = previous.get(result['rows'])
+            if old is None:
+                continue
+            changes = [f"{label} {(result[key] - old[key]) / old[key]:+.0%}"
+                       for key, label in SUITE_METRICS if old.get(key)]
+            print(f"{result['rows']:>12,}: " + ", ".join(changes))
+    return report
+
+def generate_data(rows, orders, directory, seed):
+    """Write a realistic products file and a matching batch order stream"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, newtry.PRODUCTS_FILE)
+    write_realistic_catalog(path, rows, seed)
+    store = newtry.load_product_store(path)
+    with open(os.path.join(directory, "orders.jsonl"), "w") as file:
+        for order in generate_orders(store, orders, seed):
+            file.write(json.dumps(order) + "\n")
+    print(f"✓ Wrote {rows:,} products and {orders:,} orders to {directory}")
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted list"""
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+async def http_request(reader, writer, method, target, body=None):
+    """Send one keep-alive request; return the status code"""
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+def service_request(rng, rows, write_ratio):
+    """Pick a request the way a mix of terminals and the web shop would"""
+    if rng.random() < write_ratio:
+        return "sell", "POST", "/sales", {'customer': "Load Test", 'items': [
+            {'id': rng.randint(1, rows), 'quantity': rng.randint(1, 3), 'reward': "best"}]}
+    kind = rng.choice(("list", "product", "search"))
+    if kind == "list":
+        return kind, "GET", f"/products?page={rng.randint(1, 20)}&sort={rng.choice(newtry.SORT_KEYS)}", None
+    if kind == "product":
+        return kind, "GET", f"/products/{rng.randint(1, rows)}", None
+    return kind, "GET", f"/search?q={rng.choice(SEARCH_QUERIES).replace(' ', '+')}", None
+
+async def load_test(port, rows, clients, requests, write_ratio):
+    """Run requests across concurrent keep-alive clients; return (latencies by kind, errors, seconds)"""
+    latencies = {}
+    errors = Counter()
+    remaining = iter(range(requests))
+
+    async def client(seed):
+        rng = random.Random(seed)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for _ in remaining:
+            kind, method, target, body = service_request(rng, rows, write_ratio)
+            start = time.perf_counter()
+            status = await http_request(reader, writer, method, target, body)
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+            if status >= 500 or (status >= 400 and kind != "sell"):
+                errors[status] += 1
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(seed) for seed in range(clients)))
+    return latencies, errors, time.perf_counter() - start
+
+def bench_service(rows, clients, requests, write_ratio):
+    """Load test the HTTP service: p50/p99 latency per request kind and requests per second"""
+    with tempfile.TemporaryDirectory() as tmp:
+        write_synthetic_catalog(os.path.join(tmp, "products.txt"), rows)
+        server = subprocess.Popen([sys.executable, os.path.abspath(newtry.__file__), "serve", "--port", "0"],
+                                  cwd=tmp, stdout=subprocess.PIPE, text=True)
+        try:
+            port = int(server.stdout.readline().rsplit(":", 1)[1])
+            latencies, errors, elapsed = asyncio.run(load_test(port, rows, clients, requests, write_ratio))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+    print(f"\nService load test: {rows:,} products, {clients} clients, {requests:,} requests, "
+          f"{write_ratio:.0%} sales")
+    print("{:<10} {:>10} {:>12} {:>12}".format('Request', 'Count', 'p50 (ms)', 'p99 (ms)'))
+    print("-" * 47)
+    everything = []
+    for kind in sorted(latencies):
+        values = sorted(latencies[kind])
+        everything.extend(values)
+        print("{:<10} {:>10,} {:>12.2f} {:>12.2f}".format(
+            kind, len(values), percentile(values, 50) * 1e3, percentile(values, 99) * 1e3))
+    everything.sort()
+    print("{:<10} {:>10,} {:>12.2f} {:>12.2f}".format(
+        'all', len(everything), percentile(everything, 50) * 1e3, percentile(everything, 99) * 1e3))
+    print(f"Throughput: {requests / elapsed:,.0f} requests/s")
+    if errors:
+        print(f"Errors: {dict(errors)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="WeCare benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    memory = sub.add_parser("memory", help="catalog memory footprint")
+    memory.add_argument("--rows", type=int, default=100000)
+    durability = sub.add_parser("durability", help="ledger commit throughput per durability level")
+    durability.add_argument("--transactions", type=int, default=2000)
+    durability.add_argument("--threads", type=int, default=8)
+    storage = sub.add_parser("storage", help="text vs SQLite storage backends")
+    storage.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    stress_test = sub.add_parser("stress", help="multi-process overselling check")
+    stress_test.add_argument("--processes", type=int, default=8)
+    stress_test.add_argument("--attempts", type=int, default=500)
+    numbers = sub.add_parser("invoice-numbers", help="invoice number allocation rate and uniqueness")
+    numbers.add_argument("--count", type=int, default=100000)
+    numbers.add_argument("--processes", type=int, default=4)
+    report = sub.add_parser("report", help="sales report aggregation throughput")
+    report.add_argument("--lines", type=int, default=1000000)
+    report.add_argument("--days", type=int, default=30)
+    report.add_argument("--workers", type=int)
+    eligible = sub.add_parser("eligible", help="free-item eligibility scan vs price index")
+    eligible.add_argument("--rows", type=int, default=100000)
+    eligible.add_argument("--queries", type=int, default=200)
+    search = sub.add_parser("search", help="product search latency")
+    search.add_argument("--rows", type=int, default=100000)
+    load = sub.add_parser("load", help="products file parse throughput")
+    load.add_argument("--rows", type=int, default=1000000)
+    startup = sub.add_parser("startup", help="cold start from text vs binary snapshot")
+    startup.add_argument("--rows", type=int, default=1000000)
+    restock = sub.add_parser("restock", help="bulk restock import from a supplier manifest")
+    restock.add_argument("--rows", type=int, default=1000000)
+    restock.add_argument("--lines", type=int, default=10000)
+    service = sub.add_parser("service", help="HTTP service load test")
+    service.add_argument("--rows", type=int, default=100000)
+    service.add_argument("--clients", type=int, default=32)
+    service.add_argument("--requests", type=int, default=20000)
+    service.add_argument("--write-ratio", type=float, default=0.1, help="share of requests that are sales")
+    suite = sub.add_parser("suite", help="end-to-end suite recorded as JSON")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    suite.add_argument("--orders", type=int, default=2000)
+    suite.add_argument("--seed", type=int, default=42)
+    suite.add_argument("--repeat", type=int, default=3, help="fresh runs per size; the best is kept")
+    suite.add_argument("--output", help="write results to this JSON file")
+    suite.add_argument("--compare", help="earlier results file to compare against")
+    generate = sub.add_parser("generate", help="write a synthetic catalog and order stream")
+    generate.add_argument("--rows", type=int, default=100000)
+    generate.add_argument("--orders", type=int, default=10000)
+    generate.add_argument("--seed", type=int, default=42)
+    generate.add_argument("--output-dir", default="benchmark-data")
+    instrumentation = sub.add_parser("metrics", help="instrumentation overhead, disabled vs enabled")
+    instrumentation.add_argument("--rows", type=int, default=100000)
+    reorder = sub.add_parser("reorder", help="low-stock scan vs incremental index")
+    reorder.add_argument("--rows", type=int, default=1000000)
+    closing = sub.add_parser("end-of-day", help="end-of-day invoice rendering and export scaling")
+    closing.add_argument("--invoices", type=int, default=20000)
+    closing.add_argument("--workers", type=int)
+    prices = sub.add_parser("pricing", help="basket quote latency and selling price cache")
+    prices.add_argument("--rows", type=int, default=1000000)
+    prices.add_argument("--lines", type=int, default=500)
+    replication = sub.add_parser("replication", help="multi-store event replication and consolidated stock")
+    replication.add_argument("--stores", type=int, default=4)
+    replication.add_argument("--changes", type=int, default=5000, help="stock changes per store")
+    replication.add_argument("--rows", type=int, default=10000)
+    replication.add_argument("--snapshot-every", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "memory":
+        bench_memory(args.rows)
+    elif args.command == "durability":
+        bench_durability(args.transactions, args.threads)
+    elif args.command == "storage":
+        bench_storage(args.rows)
+    elif args.command == "stress":
+        sys.exit(0 if stress(args.processes, args.attempts) else 1)
+    elif args.command == "invoice-numbers":
+        sys.exit(0 if bench_invoice_numbers(args.count, args.processes) else 1)
+    elif args.command == "report":
+        bench_report(args.lines, args.days, args.workers)
+    elif args.command == "eligible":
+        bench_eligible(args.rows, args.queries)
+    elif args.command == "search":
+        bench_search(args.rows)
+    elif args.command == "load":
+        bench_load(args.rows)
+    elif args.command == "startup":
+        bench_startup(args.rows)
+    elif args.command == "restock":
+        bench_restock(args.rows, args.lines)
+    elif args.command == "suite":
+        bench_suite(args.sizes, args.orders, args.seed, args.output, args.compare, args.repeat)
+    elif args.command == "generate":
+        generate_data(args.rows, args.orders, args.output_dir, args.seed)
+    elif args.command == "metrics":
+        bench_metrics(args.rows)
+    elif args.command == "reorder":
+        bench_reorder(args.rows)
+    elif args.command == "end-of-day":
+        sys.exit(0 if bench_end_of_day(args.invoices, args.workers) else 1)
+    elif args.command == "pricing":
+        bench_pricing(args.rows, args.lines)
+    elif args.command == "replication":
+        sys.exit(0 if bench_replication(args.stores, args.changes, args.rows, args.snapshot_every) else 1)
+    elif args.command == "service":
+        bench_service(args.rows, args.clients, args.requests, args.write_ratio)
+
+if __name__ == "__main__":
+    main()
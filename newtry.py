@@ -1,580 +1,5161 @@
+import argparse
+from array import array
+import asyncio
+import atexit
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import cProfile
+import csv
+import functools
+import gzip
+import heapq
+import io
+import itertools
+import json
 from datetime import datetime
+from http import HTTPStatus
+import mmap
+import multiprocessing
+import operator
 import os
+import queue
+import re
+import signal
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, unquote, urlsplit
+from urllib.request import urlopen
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: the storage lock only covers this process
+    fcntl = None
+
+_invoice_directories_ready = False
 
 def create_invoice_directories():
-    """Create directories for invoices if they don't exist"""
-    directories = ["Sales Invoice", "Restock Invoice"]
+    """Create directories for invoices if they don't exist (once per process)"""
+    global _invoice_directories_ready
+    if _invoice_directories_ready:
+        return
+    directories = [INVOICE_ARCHIVE_DIR, TRANSACTIONS_DIR]
     for directory in directories:
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
+    _invoice_directories_ready = True
+
+PRODUCTS_FILE = "products.txt"
+SQLITE_FILE = "products.db"
+PRODUCT_FIELDS = ('id', 'name', 'brand', 'quantity', 'price', 'origin')
+STORAGE_BACKENDS = ("text", "sqlite")
+STORAGE = os.environ.get("WECARE_STORAGE", "text")
+LEDGER_SUFFIX = ".ledger"
+BINARY_SUFFIX = ".bin"
+REORDER_SUFFIX = ".reorder"  # per-product reorder points: id,threshold,order-up-to
+REORDER_POINT = int(os.environ.get("WECARE_REORDER_POINT", "10"))  # default threshold
+REORDER_COVER = 3  # default order-up-to level, as a multiple of the threshold
+PRICING_FILE = os.environ.get("WECARE_PRICING", "pricing.json")
+DEFAULT_MARKUP = 3.0  # selling price = 3 x cost, the 200% markup
+FREE_EVERY = 3  # buy 3 get 1 free
+FREE_DISCOUNT = 0.5  # share of the selling price refunded per free unit not taken
+LEDGER_KINDS = ('sale', 'free', 'restock', 'release', 'new')
+LOCK_SUFFIX = ".lock"
+COMPACT_AFTER = 1000  # ledger entries before a background compaction
+DURABILITY_LEVELS = ("none", "group", "always")
+DURABILITY = os.environ.get("WECARE_DURABILITY", "group")
+GROUP_COMMIT_DELAY = float(os.environ.get("WECARE_GROUP_COMMIT_MS", "5")) / 1000
+GROUP_COMMIT_SIZE = 64  # waiting commits that trigger an early fsync
+RESERVE_RETRIES = 8
+MAX_SALE_QUANTITY = 1000
+MAX_RESTOCK_QUANTITY = 10000
+MAX_COST_PRICE = 1000000
+INVOICE_WORKERS = int(os.environ.get("WECARE_INVOICE_WORKERS", "2"))
+INVOICE_QUEUE_SIZE = 256  # queued invoices before create_*_invoice() blocks
+INVOICE_SEQUENCE_FILE = "invoice.seq"
+INVOICE_ARCHIVE_DIR = "Invoice Archive"
+LEGACY_INVOICE_DIRS = ("Sales Invoice", "Restock Invoice")
+INVOICE_BLOCK_SIZE = 1000  # invoice numbers reserved per trip to the counter file
+RESERVE_BACKOFF = 0.005  # seconds, doubled after every busy retry
+TRANSACTIONS_DIR = "Transactions"
+TRANSACTION_FIELDS = ('created', 'invoice_no', 'kind', 'party', 'product_id', 'name', 'brand',
+                      'origin', 'line', 'quantity', 'unit_cost', 'unit_price', 'discount', 'free_earned')
+LEGACY_TRANSACTION_WIDTH = 13  # rows written before free_earned was recorded
+REPORT_CHUNK_BYTES = 4 * 1024 * 1024  # transaction file bytes aggregated per task
+EOD_CHUNK_BYTES = 1024 * 1024  # transaction file bytes rendered and exported per task
+EXPORT_DIR = "End of Day"
+EXPORT_FORMATS = ("csv", "columnar")
+EXPORT_BUFFER = 1024 * 1024  # write buffer of each end-of-day output file
+LOAD_CHUNK_BYTES = 64 * 1024  # products file bytes parsed per batch; small enough to stay in cache
+PAGE_SIZE = 50  # products per listing page
+SORT_KEYS = ('id', 'name', 'brand', 'quantity', 'price', 'origin')
+SEARCH_LIMIT = 20
+PREFIX_EXPANSIONS = 100  # completions of a partial word searched for
+FUZZY_MIN_LENGTH = 3  # shorter words must match exactly or as a prefix
+SERVICE_HOST = os.environ.get("WECARE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("WECARE_PORT", "8080"))
+SERVICE_POLL_INTERVAL = 1.0  # seconds between checks for changes from other terminals
+MAX_REQUEST_BODY = 16 * 1024 * 1024
+SERVICE_ENDPOINTS = ("products", "search", "quote", "sales", "restock", "invoices", "reorder", "metrics",
+                     "replication", "stores")
+STORE_NAME = os.environ.get("WECARE_STORE", "")  # this shop's name; publishing is off without one
+REPLICATION_DIR = os.environ.get("WECARE_REPLICATION_DIR", "Replication")
+PEERS = [url for url in os.environ.get("WECARE_PEERS", "").split(",") if url.strip()]  # other stores' services
+SNAPSHOT_EVERY = 10000  # events between automatic snapshots
+EVENTS_PAGE = 10000  # events per /replication/events response
+STORE_NAME_PATTERN = re.compile(r"[\w.-]+")
+# Instrumentation is off unless a metrics file is named; it is read at
+# import so disabled timers cost nothing at all
+METRICS_PATH = os.environ.get("WECARE_METRICS")
+PROFILE_PATH = os.environ.get("WECARE_PROFILE")  # cProfile stats of the main thread
+TRACEMALLOC_PATH = os.environ.get("WECARE_TRACEMALLOC")  # top allocation sites at exit
+TRACEMALLOC_TOP = 25
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """Counters and latency histograms, exported in Prometheus text format
+
+    Every method returns straight away while disabled.
+    """
+
+    def __init__(self, enabled=False, path=None):
+        self.enabled = enabled
+        self.path = path
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1, **labels):
+        """Increase a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        """Record one latency in the histogram for name"""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((name, list(histogram)) for name, histogram in self.histograms.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE wecare_{name} counter")
+            for (counter, labels), value in counters:
+                if counter == name:
+                    label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                    lines.append(f"wecare_{name}{{{label_text}}} {value}" if labels else f"wecare_{name} {value}")
+        if histograms:
+            lines.append("# TYPE wecare_latency_seconds histogram")
+        for name, histogram in histograms:
+            counts, total = histogram[:-1], histogram[-1]
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'wecare_latency_seconds_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'wecare_latency_seconds_sum{{op="{name}"}} {total:.6f}')
+            lines.append(f'wecare_latency_seconds_count{{op="{name}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Save the metrics to the metrics file"""
+        if self.enabled and self.path:
+            atomic_write(self.path, self.render().encode())
+
+metrics = Metrics(bool(METRICS_PATH), METRICS_PATH)
+if metrics.enabled:
+    atexit.register(metrics.write)
+
+def timed(name):
+    """Decorator recording a function's latency under name when metrics are enabled"""
+    def decorate(func):
+        if not metrics.enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def profiled(func, *args):
+    """Call func, capturing cProfile stats and allocation sites when asked to"""
+    profiler = None
+    if PROFILE_PATH:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if TRACEMALLOC_PATH:
+        tracemalloc.start()
+    try:
+        return func(*args)
+    finally:
+        if TRACEMALLOC_PATH:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, module.__file__) for module in (cProfile, tracemalloc)])
+            tracemalloc.stop()
+            with open(TRACEMALLOC_PATH, "w") as file:
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                    file.write(f"{stat.size / 1024:>12,.1f} KiB {stat.count:>10,} blocks  {stat.traceback}\n")
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(PROFILE_PATH)
+
+# One stock mutation; product carries the full record for kind 'new'
+StockChange = namedtuple('StockChange', 'kind product_id delta product')
+
+def split_fields(line):
+    """Split a comma-separated line, honouring double-quoted fields"""
+    if '"' in line:
+        return [x.strip() for x in next(csv.reader([line]))]
+    return [x.strip() for x in line.split(",")]
+
+def quote_field(value):
+    """Quote a field if it contains a comma or double quote"""
+    value = str(value)
+    if ',' in value or '"' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+def parse_products_file(path):
+    """Parse the products file into a list of product dictionaries"""
+    products = []
+    with open(path, "r") as file:
+        for line in file:
+            data = split_fields(line.strip())
+            if len(data) == 6:  # ID, name, brand, quantity, price, origin
+                products.append({
+                    'id': int(data[0]),
+                    'name': data[1],
+                    'brand': data[2],
+                    'quantity': int(data[3]),
+                    'price': float(data[4]),
+                    'origin': data[5]
+                })
+    return products
+
+COUNT_COMMAS = operator.methodcaller("count", ",")
+
+# Columns of a run of products file lines, in PRODUCT_FIELDS order
+ProductBatch = namedtuple('ProductBatch', 'ids names brands quantities prices origins')
+
+def parse_product_fields(data):
+    """Convert the split fields of one line, raising ValueError if unusable"""
+    if len(data) != 6:  # ID, name, brand, quantity, price, origin
+        raise ValueError(f"expected 6 fields, found {len(data)}")
+    return (int(data[0]), data[1].strip(), data[2].strip(),
+            int(data[3]), float(data[4]), data[5].strip())
+
+def parse_product_text(text, first_line=1, on_error=None):
+    """Parse a run of products file lines into a ProductBatch
+
+    When every line is unquoted with six fields, the whole text is split
+    at once and each column converted in one map() call. Otherwise the
+    lines are parsed one by one, passing each bad line to
+    on_error(line_no, line, reason). Blank lines are skipped.
+    """
+    if text.endswith("\n"):
+        text = text[:-1]
+    lines = text.split("\n")
+    if '"' not in text and set(map(COUNT_COMMAS, lines)) == {5}:
+        fields = text.replace("\n", ",").split(",")
+        try:
+            return ProductBatch(list(map(int, fields[0::6])), list(map(str.strip, fields[1::6])),
+                                list(map(str.strip, fields[2::6])), list(map(int, fields[3::6])),
+                                list(map(float, fields[4::6])), list(map(str.strip, fields[5::6])))
+        except ValueError:
+            pass
+    good = []
+    for line_no, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        try:
+            good.append(parse_product_fields(split_fields(line)))
+        except ValueError as e:
+            if on_error is not None:
+                on_error(line_no, line, str(e))
+    if not good:
+        return ProductBatch([], [], [], [], [], [])
+    return ProductBatch(*map(list, zip(*good)))
+
+def report_malformed(path):
+    """Return an on_error callback that prints skipped lines of path"""
+    def report(line_no, line, reason):
+        print(f"Skipping malformed line {line_no} of {path} ({reason}): {line.strip()[:60]}")
+    return report
+
+def iter_product_batches(path, chunk_bytes=LOAD_CHUNK_BYTES, on_error=None):
+    """Stream the products file as ProductBatch columns, chunk_bytes at a time
+
+    Memory use is bounded by the chunk size however large the file is.
+    """
+    line_no = 1
+    rest = b""
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(chunk_bytes)
+            if not block:
+                if rest:
+                    yield parse_product_text(rest.decode(), line_no, on_error)
+                return
+            block = rest + block
+            cut = block.rfind(b"\n") + 1
+            rest = block[cut:]
+            if cut:
+                yield parse_product_text(block[:cut].decode(), line_no, on_error)
+                line_no += block.count(b"\n", 0, cut)
+
+def iter_products(path, chunk_bytes=LOAD_CHUNK_BYTES, on_error=None):
+    """Stream the products file as one product dictionary per row"""
+    for batch in iter_product_batches(path, chunk_bytes, on_error):
+        for values in zip(*batch):
+            yield dict(zip(PRODUCT_FIELDS, values))
+
+@timed("parse_products")
+def load_product_store(path, on_error=None):
+    """Parse the products file straight into a columnar ProductStore
+
+    Malformed lines are reported with their line numbers and skipped.
+    """
+    store = ProductStore()
+    for batch in iter_product_batches(path, on_error=on_error or report_malformed(path)):
+        store.extend(batch)
+    return store
+
+def format_ledger_entry(change):
+    """Format one stock ledger line: kind,id,delta[,name,brand,price,origin]"""
+    fields = [change.kind, change.product_id, change.delta]
+    if change.kind == 'new':
+        product = change.product
+        fields += [product['name'], product['brand'], product['price'], product['origin']]
+    return ",".join(quote_field(field) for field in fields) + "\n"
+
+def parse_ledger_entry(line):
+    """Parse one ledger line into a StockChange, or None if unusable"""
+    data = split_fields(line.strip())
+    if data[0] not in LEDGER_KINDS:
+        return None
+    try:
+        kind, product_id, delta = data[0], int(data[1]), int(data[2])
+        if kind != 'new':
+            return StockChange(kind, product_id, delta, None) if len(data) == 3 else None
+        if len(data) != 7:
+            return None
+        return StockChange(kind, product_id, delta, {
+            'id': product_id,
+            'name': data[3],
+            'brand': data[4],
+            'quantity': delta,
+            'price': float(data[5]),
+            'origin': data[6]
+        })
+    except (IndexError, ValueError):
+        return None
+
+def apply_change(store, by_id, change, on_new=None):
+    """Apply one StockChange to a store; return False if it does not fit
+
+    Besides the ledger kinds, 'set' carries an absolute quantity (and the
+    full record, for products this store has not seen yet).
+    """
+    if change.kind == 'set':
+        i = by_id.get(change.product_id)
+        if i is not None:
+            store.quantities[i] = change.delta
+            return True
+    if change.kind in ('new', 'set'):
+        if change.product_id in by_id:
+            return False
+        i = store.append(change.product)
+        by_id[change.product_id] = i
+        if on_new is not None:
+            on_new(i)
+        return True
+    i = by_id.get(change.product_id)
+    if i is None:
+        return False
+    store.quantities[i] += change.delta
+    return True
+
+class ProductRow:
+    """Dictionary-like view of one row of a ProductStore"""
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, key):
+        store, i = self.store, self.index
+        if key == 'id':
+            return store.ids[i]
+        if key == 'name':
+            return store.names[i]
+        if key == 'brand':
+            return store.strings[store.brand_codes[i]]
+        if key == 'quantity':
+            return store.quantities[i]
+        if key == 'price':
+            return store.prices[i]
+        if key == 'origin':
+            return store.strings[store.origin_codes[i]]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'quantity':
+            self.store.quantities[self.index] = value
+        elif key == 'price':
+            self.store.prices[self.index] = value
+        else:
+            raise KeyError(f"{key} is read-only")
+
+    def __contains__(self, key):
+        return key in PRODUCT_FIELDS
+
+    def __eq__(self, other):
+        if isinstance(other, ProductRow):
+            return self.store is other.store and self.index == other.index
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.store), self.index))
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def get(self, key, default=None):
+        return self[key] if key in PRODUCT_FIELDS else default
+
+    def keys(self):
+        return PRODUCT_FIELDS
+
+    def to_dict(self):
+        """Return a plain dictionary copy of the row"""
+        store, i = self.store, self.index
+        return {'id': store.ids[i], 'name': store.names[i], 'brand': store.strings[store.brand_codes[i]],
+                'quantity': store.quantities[i], 'price': store.prices[i],
+                'origin': store.strings[store.origin_codes[i]]}
+
+class ProductStore:
+    """Columnar product storage with dictionary-encoded brand and origin
+
+    id, quantity and price live in typed arrays and brand/origin are stored
+    as codes into a shared string table, so a row costs little more than its
+    name instead of a six-key dictionary.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.quantities = array('q')
+        self.prices = array('d')
+        self.names = []
+        self.brand_codes = array('I')
+        self.origin_codes = array('I')
+        self.strings = []
+        self._codes = {}
+        self.ids_ascending = None  # known from a binary snapshot header
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.ids)
+        if not 0 <= index < len(self.ids):
+            raise IndexError("product index out of range")
+        return ProductRow(self, index)
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield ProductRow(self, i)
+
+    def encode(self, value):
+        """Return the string table code for a brand or origin"""
+        code = self._codes.get(value)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(value)
+            self._codes[value] = code
+        return code
+
+    def _unpack(self):
+        """Copy columns mapped from a binary snapshot into growable arrays"""
+        for column in ('ids', 'quantities', 'prices', 'brand_codes', 'origin_codes'):
+            view = getattr(self, column)
+            if isinstance(view, memoryview):
+                values = array(view.format)
+                values.frombytes(view.cast('B'))
+                setattr(self, column, values)
+
+    def append_values(self, product_id, name, brand, quantity, price, origin):
+        """Append a row and return its index"""
+        if isinstance(self.ids, memoryview):
+            self._unpack()
+        self.ids_ascending = None
+        self.ids.append(product_id)
+        self.names.append(name)
+        self.brand_codes.append(self.encode(brand))
+        self.quantities.append(quantity)
+        self.prices.append(price)
+        self.origin_codes.append(self.encode(origin))
+        return len(self.ids) - 1
+
+    def append(self, product):
+        """Append a product dictionary (or row) and return its index"""
+        return self.append_values(product['id'], product['name'], product['brand'],
+                                  product['quantity'], product['price'], product['origin'])
+
+    def extend(self, batch):
+        """Append every row of a ProductBatch"""
+        for value in set(batch.brands).union(batch.origins).difference(self._codes):
+            self.encode(value)
+        if isinstance(self.ids, memoryview):
+            self._unpack()
+        self.ids_ascending = None
+        self.ids.extend(batch.ids)
+        self.names.extend(batch.names)
+        self.brand_codes.extend(map(self._codes.__getitem__, batch.brands))
+        self.quantities.extend(batch.quantities)
+        self.prices.extend(batch.prices)
+        self.origin_codes.extend(map(self._codes.__getitem__, batch.origins))
+
+    @classmethod
+    def from_products(cls, products):
+        """Build a store from any iterable of product dictionaries"""
+        store = cls()
+        for product in products:
+            store.append(product)
+        return store
+
+def ids_ascending(store):
+    """Whether the store's ids are strictly increasing"""
+    if store.ids_ascending is None:
+        ids = store.ids
+        store.ids_ascending = all(map(operator.lt, ids[:-1], ids[1:]))
+    return store.ids_ascending
+
+class IdIndex:
+    """Product id to row mapping that searches an ascending ids column
+
+    Nothing is built up front, so a mapped binary snapshot can be queried
+    straight away. Rows indexed later go into an ordinary dictionary.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.rows = len(ids)
+        self.extra = {}
+
+    def get(self, product_id, default=None):
+        i = bisect_left(self.ids, product_id, 0, self.rows)
+        if i < self.rows and self.ids[i] == product_id:
+            return i
+        return self.extra.get(product_id, default)
+
+    def __getitem__(self, product_id):
+        i = self.get(product_id)
+        if i is None:
+            raise KeyError(product_id)
+        return i
+
+    def __contains__(self, product_id):
+        return self.get(product_id) is not None
+
+    def __setitem__(self, product_id, i):
+        self.extra[product_id] = i
+
+    def __len__(self):
+        return self.rows + len(self.extra)
+
+def index_ids(store):
+    """Return a product id to row mapping for store"""
+    if ids_ascending(store):
+        return IdIndex(store.ids)
+    return {product_id: i for i, product_id in enumerate(store.ids)}
+
+class PackedStrings:
+    """Read-only list of strings stored as UTF-8 bytes plus end offsets
+
+    Strings are decoded on access, so a column of a million names costs two
+    buffers instead of a million str objects. Appended strings are kept in
+    an ordinary list after the packed ones.
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        self.extra = []
+
+    def __len__(self):
+        return len(self.offsets) - 1 + len(self.extra)
+
+    def __getitem__(self, i):
+        packed = len(self.offsets) - 1
+        if i < 0:
+            i += len(self)
+        if i >= packed:
+            return self.extra[i - packed]
+        if i < 0:
+            raise IndexError("string index out of range")
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, value):
+        self.extra.append(value)
+
+    def extend(self, values):
+        self.extra.extend(values)
+
+# Binary snapshot header: magic, version, byte order, flags, rows, strings, the (mtime, size,
+# inode) of the text file it was made from, then the byte lengths of the name and string blobs
+BINARY_HEADER = struct.Struct("<4sHBBQQqQQQQ")
+BINARY_MAGIC = b"WCPB"
+BINARY_VERSION = 1
+BYTE_ORDER = {"little": 1, "big": 2}[sys.byteorder]
+IDS_ASCENDING = 1  # header flag
+
+def pad8(data):
+    """Pad bytes to a multiple of 8 so the next column stays aligned"""
+    return data + bytes(-len(data) % 8)
+
+def pack_strings(strings):
+    """Return (offsets, blob) bytes for a PackedStrings column"""
+    encoded = [value.encode() for value in strings]
+    offsets = array('Q', [0])
+    offsets.extend(itertools.accumulate(map(len, encoded)))
+    return offsets.tobytes(), b"".join(encoded)
+
+def encode_binary_snapshot(store):
+    """Encode a store as the body of a binary snapshot; returns (flags and sizes, body)"""
+    name_offsets, names = pack_strings(store.names)
+    string_offsets, strings = pack_strings(store.strings)
+    body = b"".join(pad8(bytes(column)) for column in (
+        store.ids, store.quantities, store.prices, store.brand_codes, store.origin_codes))
+    body += name_offsets + string_offsets + pad8(names) + strings
+    flags = IDS_ASCENDING if ids_ascending(store) else 0
+    return (flags, len(store), len(store.strings), len(names), len(strings)), body
+
+def text_signature(path):
+    """Return (mtime, size, inode) identifying one version of a text snapshot, or None"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def write_binary_snapshot(path, encoded, signature):
+    """Atomically write an encoded snapshot tagged with the text file's signature"""
+    (flags, rows, strings, names_size, strings_size), body = encoded
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BYTE_ORDER, flags, rows, strings,
+                                *signature, names_size, strings_size)
+    atomic_write(path, header + body)
+
+def load_binary_snapshot(path, signature):
+    """Map a binary snapshot as a ProductStore, or return None if it is missing or stale
+
+    Numeric columns are memoryviews straight onto the file (a private,
+    copy-on-write mapping, so stock updates never reach the file) and names
+    stay packed; nothing is parsed. Windows cannot replace a mapped file,
+    so there the snapshot is read into memory instead.
+    """
+    try:
+        with open(path, "rb") as file:
+            file_size = os.fstat(file.fileno()).st_size
+            if file_size < BINARY_HEADER.size:
+                return None
+            if os.name == "nt":
+                buffer = bytearray(file_size)
+                file.readinto(buffer)
+            else:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    except FileNotFoundError:
+        return None
+    (magic, version, byte_order, flags, rows, strings, mtime, size, inode,
+     names_size, strings_size) = BINARY_HEADER.unpack_from(buffer)
+    if ((magic, version, byte_order) != (BINARY_MAGIC, BINARY_VERSION, BYTE_ORDER)
+            or (mtime, size, inode) != signature):
+        return None
+    padded = rows * 4 + (-rows * 4) % 8
+    expected = (BINARY_HEADER.size + rows * 24 + padded * 2 + (rows + 1) * 8 + (strings + 1) * 8
+                + names_size + (-names_size) % 8 + strings_size)
+    if expected != file_size:
+        return None  # torn or foreign file
+
+    view = memoryview(buffer)
+    position = BINARY_HEADER.size
+
+    def take(length, fmt=None):
+        nonlocal position
+        column = view[position:position + length]
+        position += length + (-length) % 8
+        return column.cast(fmt) if fmt else column
+
+    store = ProductStore()
+    store.ids = take(rows * 8, 'q')
+    store.quantities = take(rows * 8, 'q')
+    store.prices = take(rows * 8, 'd')
+    store.brand_codes = take(rows * 4, 'I')
+    store.origin_codes = take(rows * 4, 'I')
+    name_offsets = take((rows + 1) * 8, 'Q')
+    string_offsets = take((strings + 1) * 8, 'Q')
+    store.names = PackedStrings(name_offsets, take(names_size))
+    store.strings = list(PackedStrings(string_offsets, take(strings_size)))
+    store._codes = {value: code for code, value in enumerate(store.strings)}
+    store.ids_ascending = bool(flags & IDS_ASCENDING)
+    return store
+
+def file_mode(path, default=0o644):
+    """Return the permission bits of path, or default if it does not exist"""
+    try:
+        return os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        return default
+
+def write_temp_file(path, data):
+    """Write bytes to an fsynced temp file next to path and return its name"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temp_path, file_mode(path))
+        metrics.add("bytes_written_total", len(data), file=os.path.basename(path))
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+def fsync_directory(path):
+    """Flush a rename in the directory containing path to disk"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # directories cannot be opened on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(temp_path, path):
+    """Atomically move a finished temp file over path"""
+    os.replace(temp_path, path)
+    fsync_directory(path)
+
+def atomic_write(path, data):
+    """Write bytes to path so readers see either the old or the new file"""
+    replace_file(write_temp_file(path, data), path)
+
+def ledger_header(snapshot_data):
+    """Return the first ledger line binding it to one snapshot's contents"""
+    return f"snapshot,{zlib.crc32(snapshot_data)},{len(snapshot_data)}\n".encode()
+
+def snapshot_header(path):
+    """Return ledger_header() for the snapshot currently at path"""
+    with open(path, "rb") as file:
+        return ledger_header(file.read())
+
+class GroupCommitter:
+    """Batch ledger fsyncs from concurrent commits into one per window
+
+    Committers call begin() before writing and wait_durable() afterwards. A
+    background thread collects waiters until no other commit is mid-write,
+    max_batch are waiting or max_delay seconds have passed, and covers them
+    all with one fsync.
+    """
+
+    def __init__(self, path, max_delay=GROUP_COMMIT_DELAY, max_batch=GROUP_COMMIT_SIZE):
+        self.path = path
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.fsyncs = 0
+        self._cond = threading.Condition()
+        self._writing = 0
+        self._requested = 0
+        self._synced = 0
+        self._error = None
+        self._thread = None
+
+    def begin(self):
+        """Announce a commit that is about to write to the ledger"""
+        with self._cond:
+            self._writing += 1
+
+    def abort(self):
+        """Withdraw a begin() whose write failed"""
+        with self._cond:
+            self._writing -= 1
+            self._cond.notify_all()
+
+    def wait_durable(self):
+        """Block until everything written before this call has been fsynced"""
+        with self._cond:
+            self._writing -= 1
+            self._requested += 1
+            ticket = self._requested
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            while self._synced < ticket:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._requested == self._synced:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.max_delay
+                while self._writing and self._requested - self._synced < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                target = self._requested
+            error = None
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                error = e
+            with self._cond:
+                self.fsyncs += 1
+                self._error = error
+                self._synced = target
+                self._cond.notify_all()
+
+class StockConflict(Exception):
+    """A reservation would take a product below zero stock"""
+
+    def __init__(self, product_id, available):
+        super().__init__(f"Insufficient stock for product {product_id}! Available: {available}")
+        self.product_id = product_id
+        self.available = available
+
+class StorageBusy(Exception):
+    """Another terminal held the storage lock for too long"""
+
+class InterProcessLock:
+    """Reentrant lock shared by threads and, through flock(), by processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._local.acquire()
+        if self._depth == 0 and fcntl is not None:
+            fd = None
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                if fd is not None:
+                    os.close(fd)
+                self._local.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._local.release()
+
+def check_durability(durability):
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError(f"durability must be one of {', '.join(DURABILITY_LEVELS)}")
+
+def number_new_products(changes, next_id):
+    """Give the 'new' changes in a list consecutive IDs from next_id, in place
+
+    Each product record is updated too, so callers holding it see its final ID.
+    """
+    for n, change in enumerate(changes):
+        if change.kind == 'new':
+            change.product['id'] = next_id
+            changes[n] = StockChange('new', next_id, change.delta, change.product)
+            next_id += 1
+    return changes
+
+def check_reservation(changes, current_stock):
+    """Raise StockConflict if applying changes would oversell any product"""
+    wanted = {}
+    for change in changes:
+        if change.delta < 0:
+            wanted[change.product_id] = wanted.get(change.product_id, 0) - change.delta
+    for product_id, quantity in wanted.items():
+        available = current_stock(product_id)
+        if available is None or available < quantity:
+            raise StockConflict(product_id, available or 0)
+
+class TextStorage:
+    """products.txt snapshot plus an append-only ledger of stock changes
+
+    A transaction only appends a few bytes to the ledger; load() replays it
+    on top of the snapshot and poll() picks up entries other processes have
+    appended since. compact() folds the ledger back into a new snapshot.
+    Every file operation holds an flock() on products.lock, so several
+    terminals can share the same files.
+
+    durability controls ledger appends: "none" leaves flushing to the OS,
+    "group" batches fsyncs across concurrent commits and "always" fsyncs
+    every commit. Snapshots are always replaced atomically.
+    """
+
+    def __init__(self, path=PRODUCTS_FILE, compact_after=COMPACT_AFTER, durability=DURABILITY):
+        check_durability(durability)
+        base = os.path.splitext(path)[0]
+        self.path = path
+        self.ledger_path = base + LEDGER_SUFFIX
+        self.binary_path = base + BINARY_SUFFIX
+        self.compact_after = compact_after
+        self.durability = durability
+        self._signature = None
+        self._ledger_inode = None
+        self._ledger_offset = 0
+        self._ledger_entries = 0
+        self._unapplied = []
+        self._lock = InterProcessLock(base + LOCK_SUFFIX)
+        self._compactor = None
+        self._group = GroupCommitter(self.ledger_path)
+
+    def _file_signature(self):
+        """Return (mtime, size) of the products file or None if missing"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _ledger_stat(self):
+        """Return (inode, size) of the ledger, or (None, 0) if missing"""
+        try:
+            stat = os.stat(self.ledger_path)
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def _recover_ledger(self):
+        """Finish or discard a snapshot/ledger swap interrupted by a crash"""
+        next_path = self.ledger_path + ".next"
+        if not os.path.exists(next_path):
+            return
+        with open(next_path, "rb") as file:
+            header = file.readline()
+        if header == snapshot_header(self.path):
+            replace_file(next_path, self.ledger_path)
+        else:
+            os.remove(next_path)
+
+    @timed("storage_load")
+    def load(self):
+        """Return a ProductStore of the snapshot with the whole ledger applied
+
+        The snapshot comes from the binary copy when it matches the text
+        file; otherwise the text is parsed and the binary copy rewritten.
+        """
+        with self._lock:
+            self._recover_ledger()
+            signature = text_signature(self.path)
+            store = load_binary_snapshot(self.binary_path, signature) if signature else None
+            if store is None:
+                store = load_product_store(self.path)
+                self._write_binary(encode_binary_snapshot(store))
+            self._signature = self._file_signature()
+            self._ledger_inode, _ = self._ledger_stat()
+            self._ledger_offset = 0
+            self._ledger_entries = 0
+            self._unapplied = []
+            changes = self._read_ledger_tail()
+            by_id = index_ids(store) if changes else None
+            for change in changes:
+                apply_change(store, by_id, change)
+            return store
+
+    def poll(self):
+        """Return changes others appended since the last call, or None to reload"""
+        with self._lock:
+            inode, ledger_size = self._ledger_stat()
+            if (self._file_signature() != self._signature or inode != self._ledger_inode
+                    or ledger_size < self._ledger_offset):
+                return None
+            changes, self._unapplied = self._unapplied, []
+            if ledger_size > self._ledger_offset:
+                changes.extend(self._read_ledger_tail())
+            return changes
+
+    def _read_ledger_tail(self):
+        """Parse ledger entries written after the current offset"""
+        try:
+            with open(self.ledger_path, "rb") as file:
+                file.seek(self._ledger_offset)
+                data = file.read()
+        except FileNotFoundError:
+            return []
+        # Only take complete lines; a torn final line is picked up later
+        end = data.rfind(b"\n") + 1
+        changes = []
+        for line in data[:end].decode().splitlines():
+            change = parse_ledger_entry(line) if line else None
+            if change is not None:
+                changes.append(change)
+        self._ledger_offset += end
+        self._ledger_entries += len(changes)
+        return changes
+
+    def commit(self, changes, next_id=None):
+        """Append changes to the ledger and make them durable per self.durability
+
+        New products are numbered from next_id(), which is called with the
+        inter-process lock held after the caller has caught up with every
+        other terminal's entries, so two terminals never hand out one ID.
+        """
+        def number():
+            if next_id is not None and any(change.kind == 'new' for change in changes):
+                number_new_products(changes, next_id())
+        self._commit(changes, number)
+
+    def reserve(self, changes, current_stock):
+        """Commit changes only if no product would drop below zero stock
+
+        current_stock(product_id) is called with the inter-process lock held,
+        after the caller has caught up with every other terminal's entries,
+        so the check and the append happen as one atomic step.
+        """
+        self._commit(changes, lambda: check_reservation(changes, current_stock))
+
+    @timed("storage_commit")
+    def _commit(self, changes, prepare):
+        """Call prepare() and append changes under the lock, then wait for durability
+
+        The lock is released before waiting, so other terminals can append
+        while the fsync runs and one group commit covers them all.
+        """
+        if not changes:
+            return
+        group = self.durability == "group"
+        if group:
+            self._group.begin()
+        try:
+            with self._lock:
+                prepare()
+                data = "".join(format_ledger_entry(change) for change in changes).encode()
+                due = self._append_ledger(data, len(changes))
+        except BaseException:
+            if group:
+                self._group.abort()
+            raise
+        if group:
+            self._group.wait_durable()
+        if due:
+            self.compact_in_background()
+
+    def _append_ledger(self, data, entries):
+        """Write encoded ledger lines; return True when compaction is due"""
+        with self._lock:
+            inode, ledger_size = self._ledger_stat()
+            if inode == self._ledger_inode and ledger_size > self._ledger_offset:
+                # Keep entries other processes appended for the next poll()
+                self._unapplied.extend(self._read_ledger_tail())
+            with open(self.ledger_path, "ab+") as file:
+                size = file.seek(0, os.SEEK_END)
+                if size:
+                    file.seek(size - 1)
+                    if file.read(1) != b"\n":
+                        data = b"\n" + data  # seal a torn line left by a crash
+                file.write(data)
+                file.flush()
+                metrics.add("bytes_written_total", len(data), file=os.path.basename(self.ledger_path))
+                if self.durability == "always":
+                    os.fsync(file.fileno())
+                self._ledger_offset = file.tell()
+            if inode is None:
+                fsync_directory(self.ledger_path)
+            elif inode != self._ledger_inode:
+                self._signature = None  # ledger was swapped underneath us
+            self._ledger_inode, _ = self._ledger_stat()
+            self._ledger_entries += entries
+            return self._ledger_entries >= self.compact_after
+
+    def compact_in_background(self):
+        """Start compact() on a worker thread unless one is already running"""
+        if self._compactor is not None and self._compactor.is_alive():
+            return self._compactor
+        self._compactor = threading.Thread(target=self.compact, name="ledger-compactor")
+        self._compactor.start()
+        return self._compactor
+
+    def compact(self):
+        """Fold the ledger into a new snapshot, keeping entries written meanwhile
+
+        Only entries this process has read are folded, so its offset still
+        points at the first entry it has not seen once the ledger is swapped.
+        The expensive rebuild runs without the lock; if another process
+        swapped the files in the meantime this compaction is abandoned.
+        """
+        with self._lock:
+            signature = self._file_signature()
+            inode, ledger_end = self._ledger_stat()
+            if self._signature == signature and self._ledger_inode == inode:
+                ledger_end = min(ledger_end, self._ledger_offset)
+        if inode is None or ledger_end == 0:
+            return False
+        with open(self.path, "rb") as snapshot_file, open(self.ledger_path, "rb") as ledger_file:
+            if (os.fstat(ledger_file.fileno()).st_ino != inode
+                    or self._file_signature() != signature):
+                return False
+            snapshot_data = snapshot_file.read()
+            folded = ledger_file.read(ledger_end)
+        store = ProductStore()
+        store.extend(parse_product_text(snapshot_data.decode()))
+        by_id = index_ids(store)
+        for line in folded[:folded.rfind(b"\n") + 1].decode().splitlines():
+            change = parse_ledger_entry(line) if line else None
+            if change is not None:
+                apply_change(store, by_id, change)
+        ledger_end = folded.rfind(b"\n") + 1
+        snapshot = products_file_data(store)
+        binary = encode_binary_snapshot(store)
+        temp_path = write_temp_file(self.path, snapshot)
+
+        with self._lock:
+            if self._file_signature() != signature or self._ledger_stat()[0] != inode:
+                os.unlink(temp_path)
+                return False
+            with open(self.ledger_path, "rb") as file:
+                file.seek(ledger_end)
+                tail = file.read()
+            in_sync = (self._signature == signature and self._ledger_inode == inode
+                       and self._ledger_offset >= ledger_end)
+            self._swap_snapshot(temp_path, snapshot, tail, binary)
+            if in_sync:
+                self._ledger_offset = self._ledger_offset - ledger_end + len(ledger_header(snapshot))
+                self._ledger_entries = tail.count(b"\n")
+            else:
+                self._signature = None
+        return True
+
+    def _write_binary(self, encoded):
+        """Refresh the binary snapshot; it is only a cache, so failures are ignored"""
+        signature = text_signature(self.path)
+        if signature is None:
+            return
+        try:
+            write_binary_snapshot(self.binary_path, encoded, signature)
+        except OSError:
+            pass
+
+    def _swap_snapshot(self, temp_path, snapshot, tail=b"", binary=None):
+        """Install a new snapshot and the ledger tail that applies on top of it
+
+        The new ledger is staged as <ledger>.next first, so a crash between
+        the two renames is repaired by _recover_ledger() on the next load.
+        binary is the encoded binary snapshot for the same contents.
+        """
+        next_path = self.ledger_path + ".next"
+        atomic_write(next_path, ledger_header(snapshot) + tail)
+        replace_file(temp_path, self.path)
+        replace_file(next_path, self.ledger_path)
+        self._signature = self._file_signature()
+        self._ledger_inode, _ = self._ledger_stat()
+        if binary is not None:
+            self._write_binary(binary)
+
+    @timed("storage_save")
+    def save(self, products):
+        """Write products as the new snapshot and start an empty ledger"""
+        self.wait_for_compaction()
+        snapshot = products_file_data(products)
+        if not isinstance(products, ProductStore):
+            products = ProductStore.from_products(products)
+        binary = encode_binary_snapshot(products)
+        temp_path = write_temp_file(self.path, snapshot)
+        with self._lock:
+            self._swap_snapshot(temp_path, snapshot, binary=binary)
+            self._ledger_offset = len(ledger_header(snapshot))
+            self._ledger_entries = 0
+            self._unapplied = []
+
+    def wait_for_compaction(self):
+        """Block until a running background compaction has finished"""
+        if self._compactor is not None:
+            self._compactor.join()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    brand TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    price REAL NOT NULL,
+    origin TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('seq', 0);
+INSERT OR IGNORE INTO meta VALUES ('generation', 0);
+"""
+
+SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS products_brand ON products (brand COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS products_origin ON products (origin COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS products_seq ON products (seq);
+"""
+
+class SQLiteStorage:
+    """Products table in an SQLite database running in WAL mode
+
+    Sales and restocks update single rows, readers in other processes are
+    never blocked by a writer, and lookups by id, brand and origin use
+    indexes. Every write stamps the rows it touches with a new sequence
+    number so poll() can fetch just the rows other terminals changed.
+    durability maps to PRAGMA synchronous.
+    """
+
+    SYNCHRONOUS = {"none": "OFF", "group": "NORMAL", "always": "FULL"}
+
+    def __init__(self, path=SQLITE_FILE, durability=DURABILITY):
+        check_durability(durability)
+        self.path = path
+        self.durability = durability
+        self._conn = None
+        self._data_version = None
+        self._seq = 0
+        self._generation = None
+        self._lock = threading.RLock()
+
+    def connect(self):
+        """Open the database, creating or upgrading the schema on first use"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[self.durability]}")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(SQLITE_SCHEMA)
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(products)")]
+            if 'seq' not in columns:
+                conn.execute("ALTER TABLE products ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+            conn.executescript(SQLITE_INDEXES)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _meta(self, conn, key):
+        return conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+
+    def _next_seq(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq'")
+        return self._meta(conn, 'seq')
+
+    @timed("storage_load")
+    def load(self):
+        """Return all products as a ProductStore"""
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(self.path)
+        with self._lock:
+            conn = self.connect()
+            conn.execute("BEGIN")
+            try:
+                store = ProductStore()
+                for row in conn.execute("SELECT id, name, brand, quantity, price, origin FROM products ORDER BY id"):
+                    store.append_values(*row)
+                self._seq = self._meta(conn, 'seq')
+                self._generation = self._meta(conn, 'generation')
+            finally:
+                conn.execute("COMMIT")
+            self._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            return store
+
+    def poll(self):
+        """Return rows changed since the last call as 'set' changes, or None to reload"""
+        with self._lock:
+            conn = self.connect()
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return []
+            conn.execute("BEGIN")
+            try:
+                if self._meta(conn, 'generation') != self._generation:
+                    return None
+                rows = conn.execute("SELECT id, name, brand, quantity, price, origin FROM products "
+                                    "WHERE seq > ? ORDER BY id", (self._seq,)).fetchall()
+                self._seq = self._meta(conn, 'seq')
+            finally:
+                conn.execute("COMMIT")
+            self._data_version = version
+            return [StockChange('set', row[0], row[3], dict(zip(PRODUCT_FIELDS, row))) for row in rows]
+
+    def _write(self, changes, check_stock):
+        """Apply changes in one IMMEDIATE transaction, retrying while busy
+
+        New products get the next IDs after the largest in the table, read
+        inside the transaction, so concurrent terminals never share one.
+        """
+        for attempt in range(RESERVE_RETRIES):
+            with self._lock:
+                conn = self.connect()
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                except sqlite3.OperationalError as e:
+                    if "locked" not in str(e) and "busy" not in str(e):
+                        raise
+                    time.sleep(RESERVE_BACKOFF * (2 ** attempt))
+                    continue
+                try:
+                    seq = self._next_seq(conn)
+                    if any(change.kind == 'new' for change in changes):
+                        number_new_products(changes, conn.execute(
+                            "SELECT COALESCE(MAX(id), 0) + 1 FROM products").fetchone()[0])
+                    for change in changes:
+                        if change.kind == 'new':
+                            p = change.product
+                            conn.execute("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (p['id'], p['name'], p['brand'], p['quantity'], p['price'],
+                                          p['origin'], seq))
+                            continue
+                        cursor = conn.execute(
+                            "UPDATE products SET quantity = quantity + ?, seq = ? WHERE id = ?"
+                            + (" AND quantity + ? >= 0" if check_stock and change.delta < 0 else ""),
+                            (change.delta, seq, change.product_id)
+                            + ((change.delta,) if check_stock and change.delta < 0 else ()))
+                        if cursor.rowcount == 0 and check_stock:
+                            row = conn.execute("SELECT quantity FROM products WHERE id = ?",
+                                               (change.product_id,)).fetchone()
+                            raise StockConflict(change.product_id, row[0] if row else 0)
+                    conn.execute("COMMIT")
+                    return
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        raise StorageBusy("database stayed locked; try again")
+
+    @timed("storage_commit")
+    def commit(self, changes, next_id=None):
+        """Apply changes as single-row updates in one transaction; new products are numbered by _write()"""
+        if changes:
+            self._write(changes, check_stock=False)
+
+    def reserve(self, changes, current_stock=None):
+        """Commit changes only if no product would drop below zero stock
+
+        The stock check is part of each UPDATE, so concurrent terminals
+        never wait on each other beyond SQLite's own write lock.
+        """
+        if changes:
+            self._write(changes, check_stock=True)
+
+    @timed("storage_save")
+    def save(self, products):
+        """Replace the whole products table"""
+        with self._lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._next_seq(conn)
+                conn.execute("DELETE FROM products")
+                conn.executemany("INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 ((p['id'], p['name'], p['brand'], p['quantity'], p['price'], p['origin'], seq)
+                                  for p in products))
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _query(self, where, params):
+        with self._lock:
+            cursor = self.connect().execute(
+                f"SELECT id, name, brand, quantity, price, origin FROM products WHERE {where} ORDER BY id", params)
+            return [dict(zip(PRODUCT_FIELDS, row)) for row in cursor]
+
+    def get(self, product_id):
+        """Return the product with the given ID or None"""
+        rows = self._query("id = ?", (product_id,))
+        return rows[0] if rows else None
+
+    def find_by_brand(self, brand):
+        """Return all products of a brand (case-insensitive)"""
+        return self._query("brand = ? COLLATE NOCASE", (brand,))
+
+    def find_by_origin(self, origin):
+        """Return all products from an origin country (case-insensitive)"""
+        return self._query("origin = ? COLLATE NOCASE", (origin,))
+
+    def import_text(self, text_path=PRODUCTS_FILE):
+        """Replace the table with a text catalog (snapshot plus ledger)"""
+        store = TextStorage(text_path).load()
+        self.save(store)
+        return len(store)
+
+    def wait_for_compaction(self):
+        """SQLite needs no compaction; present for interface parity"""
+
+def make_storage(backend=None, path=None):
+    """Create the storage backend named by backend or WECARE_STORAGE"""
+    backend = backend or STORAGE
+    if backend == "text":
+        return TextStorage(path or PRODUCTS_FILE)
+    if backend == "sqlite":
+        return SQLiteStorage(path or SQLITE_FILE)
+    raise ValueError(f"storage must be one of {', '.join(STORAGE_BACKENDS)}")
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def search_tokens(text):
+    """Lower-case words of a name, brand or query"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+def deletions(word):
+    """Every string made by deleting one character from word"""
+    return {word[:n] + word[n + 1:] for n in range(len(word))}
+
+def within_one_edit(a, b):
+    """Whether a and b differ by at most one insertion, deletion, substitution or transposition"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    if len(a) == len(b):
+        if a[n + 1:] == b[n + 1:]:
+            return True
+        return a[n] == b[n + 1] and a[n + 1] == b[n] and a[n + 2:] == b[n + 2:]
+    return a[n + 1:] == b[n:] if len(a) > len(b) else a[n:] == b[n + 1:]
+
+def contains(values, value):
+    """Whether a sorted array holds value"""
+    n = bisect_left(values, value)
+    return n < len(values) and values[n] == value
+
+def intersect_sorted(arrays, block=64):
+    """Yield the values present in every sorted array of unique values, in order
+
+    The smallest array is taken a block at a time and intersected as a set
+    with the matching slice of each other array, so the work runs in C rather
+    than one bisect per value; blocks double in size while few values match.
+    """
+    arrays = sorted(arrays, key=len)
+    if not arrays or not all(arrays):
+        return
+    smallest, others = arrays[0], arrays[1:]
+    starts = [0] * len(others)
+    begin = 0
+    while begin < len(smallest):
+        values = smallest[begin:begin + block]
+        begin += block
+        found = set(values)
+        for n, other in enumerate(others):
+            end = bisect_right(other, values[-1], starts[n])
+            found.intersection_update(other[starts[n]:end])
+            starts[n] = end
+            if not found:
+                break
+        yield from sorted(found)
+        block *= 2
+
+class SearchIndex:
+    """Inverted index over the words of product names and brands
+
+    postings maps each word to the rows containing it, in row order.
+    words is the sorted vocabulary, so prefixes are found with bisect, and
+    typos are matched through an index of every word with one character
+    deleted (built on the first fuzzy lookup). Rows are added one at a time
+    as the catalog grows.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.postings = {}
+        self.words = []
+        self._deletes = None
+        postings = self.postings
+        for i in range(len(store)):
+            for token in set(self.row_tokens(i)):
+                rows = postings.get(token)
+                if rows is None:
+                    rows = postings[token] = array('I')
+                rows.append(i)
+        self.words = sorted(postings)
+
+    def row_tokens(self, i):
+        store = self.store
+        return search_tokens(store.names[i] + " " + store.strings[store.brand_codes[i]])
+
+    def add(self, i):
+        """Index row i"""
+        for token in set(self.row_tokens(i)):
+            rows = self.postings.get(token)
+            if rows is None:
+                rows = self.postings[token] = array('I')
+                self.words.insert(bisect_left(self.words, token), token)
+                if self._deletes is not None:
+                    self._add_deletes(token)
+            rows.append(i)
+
+    def _add_deletes(self, word):
+        if len(word) >= FUZZY_MIN_LENGTH and not word.isdigit():
+            for variant in deletions(word) | {word}:
+                self._deletes.setdefault(variant, []).append(word)
+
+    def prefixed(self, prefix):
+        """Vocabulary words starting with prefix, other than prefix itself"""
+        start = bisect_left(self.words, prefix)
+        matches = []
+        for word in self.words[start:start + PREFIX_EXPANSIONS + 1]:
+            if not word.startswith(prefix):
+                break
+            if word != prefix:
+                matches.append(word)
+        return matches[:PREFIX_EXPANSIONS]
+
+    def similar(self, word):
+        """Vocabulary words one typo away from word"""
+        if len(word) < FUZZY_MIN_LENGTH or word.isdigit():
+            return []
+        if self._deletes is None:
+            self._deletes = {}
+            for known in self.words:
+                self._add_deletes(known)
+        candidates = set()
+        for variant in deletions(word) | {word}:
+            candidates.update(self._deletes.get(variant, ()))
+        return sorted(known for known in candidates if known != word and within_one_edit(word, known))
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return up to limit row indices matching every word of query, best first
+
+        Rows where every word matches exactly come first, then rows that
+        need a completed prefix, then rows that need a typo corrected; ties
+        keep catalog order. Only rows up to the limit are visited.
+        """
+        tokens = search_tokens(query)
+        if not tokens:
+            return []
+        exact = [{token} if token in self.postings else set() for token in tokens]
+        prefix = [set(self.prefixed(token)) for token in tokens]
+        fuzzy = [set(self.similar(token)) if not exact[n] else set() for n, token in enumerate(tokens)]
+        results, seen = [], set()
+        tiers = (exact,
+                 [e | p for e, p in zip(exact, prefix)],
+                 [e | p | f for e, p, f in zip(exact, prefix, fuzzy)])
+        for level, tier in enumerate(tiers):
+            if not all(tier) or (level and tier == tiers[level - 1]):
+                continue
+            # Query words with a single match are intersected block by block
+            # from the rarest posting list; words with several candidate matches are
+            # checked against each row's own words.
+            single = [self.postings[next(iter(words))] for words in tier if len(words) == 1]
+            several = sorted((words for words in tier if len(words) > 1),
+                             key=lambda words: sum(len(self.postings[word]) for word in words))
+            if single and (not several or min(map(len, single)) <=
+                           sum(len(self.postings[word]) for word in several[0])):
+                rows, checked = intersect_sorted(single), []
+            else:
+                rows = heapq.merge(*(self.postings[word] for word in sorted(several[0])))
+                several, checked = several[1:], single
+            for i in rows:
+                if i in seen:
+                    continue
+                if checked and not all(contains(values, i) for values in checked):
+                    continue
+                if several:
+                    row_words = set(self.row_tokens(i))
+                    if not all(row_words & words for words in several):
+                        continue
+                seen.add(i)
+                results.append(i)
+                if len(results) >= limit:
+                    return results
+        return results
+
+Promotion = namedtuple('Promotion', 'name start end brands origins ids tiers')
+
+def parse_promotion(data):
+    """Build a Promotion from its entry in the rules file; raises ValueError if malformed"""
+    name = str(data.get('name') or "promotion")
+    tiers = data.get('tiers') or [[1, data.get('percent')]]
+    try:
+        tiers = tuple(sorted(((int(minimum), float(percent) / 100) for minimum, percent in tiers), reverse=True))
+        start, end = (str(data.get(key) or "") for key in ('start', 'end'))
+        if len(end) == 10:
+            end += " 23:59:59"  # a whole last day
+        start, end = (datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S') if value else ""
+                      for value in (start, end))
+        ids = frozenset(int(product_id) for product_id in data.get('ids') or ())
+    except (TypeError, ValueError):
+        raise ValueError(f"promotion {name!r}: tiers must be [minimum quantity, percent] pairs, "
+                         "start/end YYYY-MM-DD dates and ids numbers")
+    if any(minimum < 1 or not 0 < share <= 1 for minimum, share in tiers):
+        raise ValueError(f"promotion {name!r}: percentages must be 0-100 and minimum quantities positive")
+    return Promotion(name, start, end, frozenset(str(brand).strip().lower() for brand in data.get('brands') or ()),
+                     frozenset(str(origin).strip().lower() for origin in data.get('origins') or ()),
+                     ids, tiers)
+
+class PricingEngine:
+    """Selling prices, promotions and the buy-N-get-one-free rule
+
+    Rules come from a JSON file; without one the shop's 200% markup and buy
+    3 get 1 free apply:
+
+        {"markup": 3.0, "brand_markup": {"Olay": 3.5}, "origin_markup": {"Nepal": 2.5},
+         "free_every": 3, "free_discount": 0.5,
+         "promotions": [{"name": "Dashain", "start": "2025-10-01", "end": "2025-10-15",
+                         "brands": ["Olay"], "percent": 10},
+                        {"name": "Bulk", "tiers": [[12, 5], [24, 10]]}]}
+
+    A brand's markup wins over its origin's, which wins over markup. A
+    promotion takes a percentage off the selling price from start to end
+    (whole days unless times are given) for the brands, origins and ids it
+    lists (every product if none), at the highest tier the line's quantity
+    reaches; a line gets its single best promotion. version changes with the
+    rules, so prices cached elsewhere know when to rebuild.
+    """
+
+    def __init__(self, path=PRICING_FILE):
+        self.path = path
+        self.version = 0
+        self._signature = None
+        self._lock = threading.Lock()
+        self.apply({})
+
+    def apply(self, rules):
+        """Replace the rules; raises ValueError and keeps the old ones if they are malformed"""
+        try:
+            markup = float(rules.get('markup', DEFAULT_MARKUP))
+            brand_markup, origin_markup = ({str(key).strip().lower(): float(value)
+                                            for key, value in (rules.get(name) or {}).items()}
+                                           for name in ('brand_markup', 'origin_markup'))
+            free_every = int(rules.get('free_every', FREE_EVERY))
+            free_discount = float(rules.get('free_discount', FREE_DISCOUNT))
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError("markups, free_every and free_discount must be numbers")
+        if min([markup, *brand_markup.values(), *origin_markup.values()]) < 1:
+            raise ValueError("markups must be at least 1 (no selling below cost)")
+        if free_every < 0 or not 0 <= free_discount <= 1:
+            raise ValueError("free_every must be 0 (off) or more and free_discount 0-1")
+        promotions = tuple(parse_promotion(promotion) for promotion in rules.get('promotions') or ())
+        with self._lock:
+            self.markup = markup
+            self.brand_markup = brand_markup
+            self.origin_markup = origin_markup
+            self.free_every = free_every
+            self.free_discount = free_discount
+            self.promotions = promotions
+            self._markups = {}
+            self.version += 1
+
+    def refresh(self):
+        """Reload the rules file if it changed; return whether the rules did"""
+        signature = text_signature(self.path)
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            if signature is None:
+                self.apply({})
+            else:
+                with open(self.path, "r") as file:
+                    self.apply(json.load(file))
+        except (OSError, ValueError) as e:
+            print(f"Error in pricing rules {self.path}: {e}")
+            return False
+        return True
+
+    def uniform_markup(self):
+        """The markup if every product has the same one, else None"""
+        return None if self.brand_markup or self.origin_markup else self.markup
+
+    def markup_for(self, brand, origin):
+        """Markup of a product of brand made in origin"""
+        markup = self._markups.get((brand, origin))
+        if markup is None:
+            markup = self.brand_markup.get(brand.strip().lower())
+            if markup is None:
+                markup = self.origin_markup.get(origin.strip().lower(), self.markup)
+            self._markups[brand, origin] = markup
+        return markup
+
+    def active_promotions(self, now=None):
+        """Promotions running at now (default: the current time)"""
+        stamp = (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+        return [promotion for promotion in self.promotions
+                if promotion.start <= stamp and (not promotion.end or stamp <= promotion.end)]
+
+    def best_promotion(self, promotions, product_id, brand, origin, quantity):
+        """Return (share off, promotion name) of the best promotion for a line, or (0, None)"""
+        best, name = 0, None
+        if not promotions:
+            return best, name
+        brand, origin = brand.lower(), origin.lower()
+        for promotion in promotions:
+            if ((promotion.brands and brand not in promotion.brands)
+                    or (promotion.origins and origin not in promotion.origins)
+                    or (promotion.ids and product_id not in promotion.ids)):
+                continue
+            for minimum, share in promotion.tiers:
+                if quantity >= minimum:
+                    if share > best:
+                        best, name = share, promotion.name
+                    break
+        return best, name
+
+    def free_units(self, quantity):
+        """Free units earned by buying quantity units"""
+        return quantity // self.free_every if self.free_every else 0
+
+    def free_item_discount(self, unit_price, units):
+        """Discount given instead of units free items"""
+        return units * unit_price * self.free_discount
+
+pricing = PricingEngine()
+
+class ProductCatalog:
+    """Products loaded once and indexed by id, brand and origin
+
+    Persistence is delegated to a storage backend. refresh() asks the
+    backend what changed since the last call and applies appended changes
+    incrementally, only reloading everything when it has to.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage if storage is not None else make_storage()
+        self.products = ProductStore()
+        self.by_id = {}
+        self._by_brand = None
+        self._by_origin = None
+        self.max_id = 0
+        self.pending = []
+        self._orders = {}
+        self._stocked_prices = None
+        self._stocked_rows = None
+        self._stocked = None
+        self._search = None
+        self._reorder_points = None
+        self._low = None
+        self._is_low = None
+        self._selling = None
+        self._selling_version = None
+        self.low_stock_alerts = []
+        self._loaded = False
+        self._loads = 0
+        # Storage access is serialised by _write_lock; _lock, which readers
+        # take, is only held while memory changes, never across a commit
+        self._write_lock = threading.RLock()
+        self._lock = threading.RLock()
+        self.reorder_path = os.path.splitext(self.storage.path)[0] + REORDER_SUFFIX
+
+    @timed("catalog_refresh")
+    def refresh(self):
+        """Bring the catalog up to date with its storage"""
+        with self._write_lock:
+            if self._loaded:
+                changes = self.storage.poll()
+                if changes is not None:
+                    metrics.add("catalog_loads_total", kind="incremental")
+                    with self._lock:
+                        for change in changes:
+                            apply_change(self.products, self.by_id, change, self._index)
+                        self._stock_changed(changes)
+                    return self.products
+            try:
+                store = self.storage.load()
+            except FileNotFoundError:
+                print("Products file not found!")
+                with self._lock:
+                    self.set_products(ProductStore())
+                self._loaded = False
+                return self.products
+            with self._lock:
+                self.set_products(store)
+            self._loaded = True
+            self._loads += 1
+            metrics.add("catalog_loads_total", kind="full")
+            return self.products
+
+    def invalidate(self):
+        """Drop uncommitted changes and force the next refresh() to reload"""
+        self.pending = []
+        self._loaded = False
+
+    def set_products(self, products):
+        """Replace the catalog contents and rebuild all indexes"""
+        if not isinstance(products, ProductStore):
+            products = ProductStore.from_products(products)
+        self.products = products
+        # Built in bulk so a mapped binary snapshot is usable at once; the
+        # brand and origin indexes wait until the first query that needs them
+        self.by_id = index_ids(products)
+        if isinstance(self.by_id, IdIndex):
+            self.max_id = products.ids[-1] if len(products) else 0
+        else:
+            self.max_id = max(products.ids, default=0)
+        self._by_brand = None
+        self._by_origin = None
+        self._orders = {}
+        self._stocked = None
+        self._search = None
+        self._reorder_points = None
+        self._low = None
+        self._is_low = None
+        self._selling = None
+        self.low_stock_alerts = []
+
+    @property
+    def by_brand(self):
+        """Row indices per lower-cased brand"""
+        if self._by_brand is None:
+            self._group_indexes()
+        return self._by_brand
+
+    @property
+    def by_origin(self):
+        """Row indices per lower-cased origin"""
+        if self._by_origin is None:
+            self._group_indexes()
+        return self._by_origin
+
+    def _group_indexes(self):
+        store = self.products
+        indexes = []
+        lowered = [value.lower() for value in store.strings]
+        for codes in (store.brand_codes, store.origin_codes):
+            index = {}
+            for i, code in enumerate(codes):
+                index.setdefault(lowered[code], array('I')).append(i)
+            indexes.append(index)
+        self._by_brand, self._by_origin = indexes
+
+    def _index(self, i):
+        store = self.products
+        product_id = store.ids[i]
+        self.by_id[product_id] = i
+        self.max_id = max(self.max_id, product_id)
+        if self._by_brand is not None:
+            brand = store.strings[store.brand_codes[i]].lower()
+            origin = store.strings[store.origin_codes[i]].lower()
+            self._by_brand.setdefault(brand, array('I')).append(i)
+            self._by_origin.setdefault(origin, array('I')).append(i)
+        if self._orders:
+            self._orders = {}
+        if self._stocked is not None:
+            self._stocked.append(0)
+            self._track_stock(i)
+        if self._search is not None:
+            self._search.add(i)
+        if self._is_low is not None:
+            self._is_low.append(0)
+            self._track_low(i)
+        if self._selling is not None:
+            self._selling.append(store.prices[i] * pricing.markup_for(
+                store.strings[store.brand_codes[i]], store.strings[store.origin_codes[i]]))
+
+    def add(self, product):
+        """Queue a new product for storage and return its record
+
+        The ID it comes with is provisional: commit() assigns the final one
+        under the storage lock, updates the record and only then adds the
+        product to the catalog.
+        """
+        record = {field: product[field] for field in PRODUCT_FIELDS}
+        self.pending.append(StockChange('new', record['id'], record['quantity'], record))
+        return record
+
+    def adjust_stock(self, product, delta, kind):
+        """Change a product's quantity in memory and queue the change"""
+        product['quantity'] += delta
+        change = StockChange(kind, product['id'], delta, None)
+        self._stock_changed([change])
+        self.pending.append(change)
+
+    def _current_stock(self, product_id):
+        """Return a product's stock after catching up with other terminals"""
+        self.refresh()
+        i = self.by_id.get(product_id)
+        return None if i is None else self.products.quantities[i]
+
+    def reserve(self, product, quantity, kind='sale'):
+        """Take stock for a sale atomically across terminals
+
+        Raises StockConflict if another terminal got there first and there
+        is no longer enough stock, or StorageBusy if the storage stayed locked.
+        """
+        self.reserve_many([StockChange(kind, product['id'], -quantity, None)])
+
+    @timed("reserve_stock")
+    def reserve_many(self, changes):
+        """Reserve several stock changes as one all-or-nothing transaction"""
+        if not changes:
+            return
+        with self._write_lock, events.publishing(changes, self.storage):
+            try:
+                self.storage.reserve(changes, self._current_stock)
+            except StockConflict:
+                self.refresh()
+                raise
+            with self._lock:
+                for change in changes:
+                    apply_change(self.products, self.by_id, change)
+                self._stock_changed(changes)
+        metrics.add("stock_commits_total")
+        metrics.add("stock_changes_total", len(changes))
+
+    def release(self, reservations):
+        """Return reserved (product_id, quantity) pairs to stock"""
+        changes = [StockChange('release', product_id, quantity, None)
+                   for product_id, quantity in reservations]
+        with self._write_lock, events.publishing(changes, self.storage):
+            self.storage.commit(changes)
+            with self._lock:
+                for change in changes:
+                    apply_change(self.products, self.by_id, change)
+                self._stock_changed(changes)
+
+    def commit(self):
+        """Write all pending stock changes to storage"""
+        with self._lock:
+            changes, self.pending = self.pending, []
+        with self._write_lock, events.publishing(changes, self.storage):
+            self.storage.commit(changes, self._next_free_id)
+            new = [change for change in changes if change.kind == 'new']
+            if new:
+                with self._lock:
+                    for change in new:
+                        apply_change(self.products, self.by_id, change, self._index)
+                    self._stock_changed(new)
+        metrics.add("stock_commits_total")
+        metrics.add("stock_changes_total", len(changes))
+
+    def save(self, products):
+        """Write products to storage as the complete catalog"""
+        with self._write_lock:
+            self.storage.save(products)
+            metrics.add("catalog_saves_total")
+            if events.enabled:
+                # Replicas cannot replay a full save; point them at a fresh snapshot
+                events.write_snapshot(self.storage, marker=True)
+            with self._lock:
+                if products is not self.products:
+                    self.set_products(products)
+                self.pending = []
+            self._loaded = True
+
+    @timed("product_lookup")
+    def get(self, product_id):
+        """Return the product with the given ID or None"""
+        i = self.by_id.get(product_id)
+        return None if i is None else ProductRow(self.products, i)
+
+    def find_by_brand(self, brand):
+        """Return all products of a brand (case-insensitive)"""
+        return [ProductRow(self.products, i) for i in self.by_brand.get(brand.lower(), ())]
+
+    def find_by_origin(self, origin):
+        """Return all products from an origin country (case-insensitive)"""
+        return [ProductRow(self.products, i) for i in self.by_origin.get(origin.lower(), ())]
+
+    def match_names(self, pairs):
+        """Map lowercased (name, brand) pairs to product IDs in one pass over the names"""
+        store = self.products
+        wanted = {name for name, _ in pairs}
+        brands = [value.lower() for value in store.strings]
+        found = {}
+        for i, name in enumerate(map(str.lower, store.names)):
+            if name in wanted:
+                key = (name, brands[store.brand_codes[i]])
+                if key in pairs and key not in found:
+                    found[key] = store.ids[i]
+        return found
+
+    def next_id(self):
+        """Return the next free product ID as far as this catalog knows"""
+        return self.max_id + 1
+
+    def _next_free_id(self):
+        """Return the next free product ID after catching up with other terminals
+
+        A full reload here loses the pending changes already applied in
+        memory, so the catalog is reloaded again once they are committed.
+        """
+        loads = self._loads
+        self.refresh()
+        if self._loads != loads:
+            self._loaded = False
+        return self.max_id + 1
+
+    def _stock_changed(self, changes):
+        """Keep the sort orders and in-stock price index in step with changes"""
+        if not changes:
+            return
+        with self._lock:
+            ordered = 'quantity' in self._orders
+            for change in changes:
+                i = self.by_id.get(change.product_id)
+                if i is None:
+                    continue
+                if ordered:
+                    self._track_quantity(i)
+                if self._stocked is not None:
+                    self._track_stock(i)
+                if self._is_low is not None and self._track_low(i):
+                    self.low_stock_alerts.append(i)
+
+    def _track_quantity(self, i):
+        """Move row i to its new place in the cached quantity order
+
+        The order is sorted by (quantity, row); quantity_seen holds each
+        row's quantity as it was last placed.
+        """
+        order, values, seen = (self._orders[key] for key in ('quantity', 'quantity_values', 'quantity_seen'))
+        old, new = seen[i], self.products.quantities[i]
+        if old == new:
+            return
+        position = bisect_left(order, i, bisect_left(values, old), bisect_right(values, old))
+        del order[position]
+        del values[position]
+        position = bisect_left(order, i, bisect_left(values, new), bisect_right(values, new))
+        order.insert(position, i)
+        values.insert(position, new)
+        seen[i] = new
+
+    def _price_index(self):
+        """Build the in-stock price index on first use
+
+        _stocked_prices and _stocked_rows are parallel arrays of the products
+        with stock, sorted by (price, row); _stocked flags which rows are in.
+        """
+        if self._stocked is None:
+            store = self.products
+            prices, quantities = store.prices, store.quantities
+            rows = sorted((i for i in range(len(store)) if quantities[i] > 0),
+                          key=lambda i: (prices[i], i))
+            self._stocked_rows = array('I', rows)
+            self._stocked_prices = array('d', (prices[i] for i in rows))
+            self._stocked = bytearray(len(store))
+            for i in rows:
+                self._stocked[i] = 1
+
+    def _track_stock(self, i):
+        """Add or remove row i from the price index when it gains or runs out of stock"""
+        in_stock = self.products.quantities[i] > 0
+        if in_stock == bool(self._stocked[i]):
+            return
+        price = self.products.prices[i]
+        prices, rows = self._stocked_prices, self._stocked_rows
+        lo, hi = bisect_left(prices, price), bisect_right(prices, price)
+        position = bisect_left(rows, i, lo, hi)
+        if in_stock:
+            prices.insert(position, price)
+            rows.insert(position, i)
+        else:
+            del prices[position]
+            del rows[position]
+        self._stocked[i] = in_stock
+
+    def reorder_points(self):
+        """Return the per-product overrides as {id: (threshold, order-up-to or None)}"""
+        if self._reorder_points is None:
+            points = {}
+            try:
+                with open(self.reorder_path, newline="") as file:
+                    for row in csv.reader(file):
+                        try:
+                            points[int(row[0])] = (int(row[1]), int(row[2]) if len(row) > 2 and row[2] else None)
+                        except (IndexError, ValueError):
+                            continue
+            except FileNotFoundError:
+                pass
+            self._reorder_points = points
+        return self._reorder_points
+
+    def reorder_point(self, product_id):
+        """Return (threshold, order-up-to level) for a product"""
+        threshold, level = self.reorder_points().get(product_id, (REORDER_POINT, None))
+        return threshold, threshold * REORDER_COVER if level is None else level
+
+    def set_reorder_point(self, product_id, threshold, level=None):
+        """Save a product's reorder threshold and optional order-up-to level"""
+        with self._lock:
+            points = self.reorder_points()
+            points[product_id] = (threshold, level)
+            atomic_write(self.reorder_path, "".join(
+                f"{key},{value[0]},{'' if value[1] is None else value[1]}\n"
+                for key, value in sorted(points.items())).encode())
+            i = self.by_id.get(product_id)
+            if self._is_low is not None and i is not None:
+                self._track_low(i)
+
+    def _low_index(self):
+        """Build the low-stock index on first use
+
+        _low groups the rows at or below their reorder point by (brand code,
+        origin code); _is_low flags which rows are in it. After this one scan
+        only rows whose stock changes are looked at again.
+        """
+        if self._is_low is None:
+            store = self.products
+            quantities = store.quantities
+            low = {i for i, quantity in enumerate(quantities) if quantity <= REORDER_POINT}
+            for product_id, (threshold, _) in self.reorder_points().items():
+                i = self.by_id.get(product_id)
+                if i is not None:
+                    if quantities[i] <= threshold:
+                        low.add(i)
+                    else:
+                        low.discard(i)
+            self._is_low = bytearray(len(store))
+            self._low = {}
+            for i in low:
+                self._is_low[i] = 1
+                self._low.setdefault((store.brand_codes[i], store.origin_codes[i]), set()).add(i)
+
+    def _track_low(self, i):
+        """Add or remove row i from the low-stock index; return True if it just fell low"""
+        store = self.products
+        low = store.quantities[i] <= self.reorder_point(store.ids[i])[0]
+        if low == bool(self._is_low[i]):
+            return False
+        key = (store.brand_codes[i], store.origin_codes[i])
+        if low:
+            self._low.setdefault(key, set()).add(i)
+        else:
+            group = self._low[key]
+            group.discard(i)
+            if not group:
+                del self._low[key]
+        self._is_low[i] = low
+        return low
+
+    def watch_low_stock(self):
+        """Start tracking products at or below their reorder point"""
+        with self._lock:
+            self._low_index()
+
+    def take_low_stock_alerts(self):
+        """Return products that fell to their reorder point since the last call"""
+        with self._lock:
+            rows, self.low_stock_alerts = self.low_stock_alerts, []
+            return [ProductRow(self.products, i) for i in dict.fromkeys(rows) if self._is_low[i]]
+
+    def reorder_suggestions(self, brand=None, origin=None):
+        """Return [(brand, origin, [(product, quantity to order)])] for low products
+
+        Only the rows in the low-stock index are visited, so this takes time
+        in proportion to the number of low products, not the catalog size.
+        Each product is topped up to its order-up-to level.
+        """
+        with self._lock:
+            self._low_index()
+            store = self.products
+            groups = []
+            for (brand_code, origin_code), rows in self._low.items():
+                group_brand, group_origin = store.strings[brand_code], store.strings[origin_code]
+                if brand is not None and group_brand.lower() != brand.strip().lower():
+                    continue
+                if origin is not None and group_origin.lower() != origin.strip().lower():
+                    continue
+                lines = []
+                for i in sorted(rows):
+                    quantity = min(self.reorder_point(store.ids[i])[1] - store.quantities[i], MAX_RESTOCK_QUANTITY)
+                    if quantity > 0:
+                        lines.append((ProductRow(store, i), quantity))
+                if lines:
+                    groups.append((group_brand, group_origin, lines))
+            groups.sort(key=lambda group: (group[0].lower(), group[1].lower()))
+            return groups
+
+    def selling_prices(self):
+        """Selling price of every row, cached until cost prices or the pricing rules change"""
+        with self._lock:
+            if self._selling is None or self._selling_version != pricing.version:
+                store = self.products
+                markup = pricing.uniform_markup()
+                if markup is not None:
+                    markups = itertools.repeat(markup)
+                else:
+                    # One lookup per brand and origin pair rather than per row
+                    pairs = list(zip(store.brand_codes, store.origin_codes))
+                    known = {(brand, origin): pricing.markup_for(store.strings[brand], store.strings[origin])
+                             for brand, origin in set(pairs)}
+                    markups = map(known.__getitem__, pairs)
+                self._selling = array('d', map(operator.mul, store.prices, markups))
+                self._selling_version = pricing.version
+            return self._selling
+
+    def selling_price(self, product):
+        """Selling price of a product row (or product dictionary)"""
+        if isinstance(product, ProductRow) and product.store is self.products:
+            return self.selling_prices()[product.index]
+        return product['price'] * pricing.markup_for(product['brand'], product['origin'])
+
+    def in_stock_by_price(self, min_price=None, max_price=None):
+        """Return row indices with stock and min_price <= price <= max_price, cheapest first
+
+        Served from the price index in O(log n + k).
+        """
+        with self._lock:
+            self._price_index()
+            prices = self._stocked_prices
+            lo = 0 if min_price is None else bisect_left(prices, min_price)
+            hi = len(prices) if max_price is None else bisect_right(prices, max_price)
+            return self._stocked_rows[lo:hi]
+
+    def suggest_free_items(self, base_price, count, available=None):
+        """Pick up to count free units priced at or below base_price, dearest first
+
+        The customer gets the most value for their free items. available(row)
+        may override the stock on hand, e.g. for stock already promised in a
+        batch. Returns a list of (row, quantity) pairs.
+        """
+        picks = []
+        with self._lock:
+            rows = self.in_stock_by_price(max_price=base_price)
+            for n in range(len(rows) - 1, -1, -1):
+                if count <= 0:
+                    break
+                row = ProductRow(self.products, rows[n])
+                quantity = min(count, row['quantity'] if available is None else available(row))
+                if quantity > 0:
+                    picks.append((row, quantity))
+                    count -= quantity
+        return picks
+
+    @timed("search")
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Return products whose name and brand match query (prefixes and typos allowed)"""
+        with self._lock:
+            if self._search is None:
+                self._search = SearchIndex(self.products)
+            return [ProductRow(self.products, i) for i in self._search.search(query, limit)]
+
+    def sort_key(self, sort):
+        """Return a function mapping a row index to its sort value"""
+        store = self.products
+        if sort == 'id':
+            return store.ids.__getitem__
+        if sort == 'name':
+            return lambda i: store.names[i].lower()
+        if sort == 'brand':
+            return lambda i: store.strings[store.brand_codes[i]].lower()
+        if sort == 'quantity':
+            return store.quantities.__getitem__
+        if sort == 'price':
+            return store.prices.__getitem__
+        if sort == 'origin':
+            return lambda i: store.strings[store.origin_codes[i]].lower()
+        raise ValueError(f"Cannot sort by {sort!r}")
+
+    def _order(self, sort):
+        """Row indices sorted by a column, cached until rows are added
+
+        The quantity order is kept up to date as stock changes.
+        """
+        order = self._orders.get(sort)
+        if order is None:
+            order = array('I', sorted(range(len(self.products)), key=self.sort_key(sort)))
+            self._orders[sort] = order
+            if sort == 'price':
+                prices = self.products.prices
+                self._orders['price_values'] = array('d', (prices[i] for i in order))
+            elif sort == 'quantity':
+                quantities = self.products.quantities
+                self._orders['quantity_values'] = array('q', (quantities[i] for i in order))
+                self._orders['quantity_seen'] = array('q', quantities)
+        return order
+
+    @timed("list_products")
+    def list_products(self, brand=None, origin=None, min_price=None, max_price=None,
+                      in_stock=False, sort='id', descending=False, offset=0, limit=PAGE_SIZE,
+                      min_selling=None, max_selling=None):
+        """Return (rows, total) for one page of the filtered, sorted catalog
+
+        Brand and origin filters start from their indexes, stock and cost
+        price filters from the in-stock price index or the price order;
+        otherwise rows are walked in a cached sort order. Matches from the
+        price indexes are put in another order by walking that sort order
+        until the page is full, or by sorting them when there are too few to
+        fill a page quickly. min_price and max_price are cost prices;
+        min_selling and max_selling filter on selling prices instead.
+        """
+        with self._lock:
+            store = self.products
+            if brand is not None or origin is not None:
+                candidates = None
+                for index, value in ((self.by_brand, brand), (self.by_origin, origin)):
+                    if value is not None:
+                        rows = index.get(value.strip().lower(), ())
+                        candidates = set(rows) if candidates is None else candidates.intersection(rows)
+                indices = sorted(candidates, key=self.sort_key(sort))
+            elif in_stock or min_price is not None or max_price is not None:
+                if in_stock:
+                    indices = self.in_stock_by_price(min_price, max_price)
+                else:
+                    order, values = self._order('price'), self._orders['price_values']
+                    lo = 0 if min_price is None else bisect_left(values, min_price)
+                    hi = len(values) if max_price is None else bisect_right(values, max_price)
+                    indices = order[lo:hi]
+                ranged = min_price is not None or max_price is not None
+                min_price = max_price = None
+                in_stock = False
+                if sort != 'price':
+                    order = self._order(sort)
+                    total = len(indices)
+                    wanted = offset + (limit if limit is not None else total)
+                    if min_selling is None and max_selling is None and wanted * len(order) <= total * total:
+                        # The page fills before the walk passes as many rows as sorting would touch
+                        keep = set(indices).__contains__ if ranged else self._stocked.__getitem__
+                        walk = filter(keep, reversed(order) if descending else order)
+                        page = itertools.islice(walk, offset, None if limit is None else offset + limit)
+                        return [ProductRow(store, i) for i in page], total
+                    # Sorted by row first so ties keep catalog order, as in the cached orders
+                    indices = sorted(sorted(indices), key=self.sort_key(sort))
+            else:
+                indices = self._order(sort)
+            if min_selling is not None or max_selling is not None:
+                selling = self.selling_prices()
+                low = float("-inf") if min_selling is None else min_selling
+                high = float("inf") if max_selling is None else max_selling
+                indices = [i for i in indices if low <= selling[i] <= high]
+            if min_price is not None or max_price is not None or in_stock:
+                prices, quantities = store.prices, store.quantities
+                low = float("-inf") if min_price is None else min_price
+                high = float("inf") if max_price is None else max_price
+                indices = [i for i in indices if low <= prices[i] <= high
+                           and (not in_stock or quantities[i] > 0)]
+            total = len(indices)
+            if descending:
+                start = max(total - offset - (limit if limit is not None else total), 0)
+                page = indices[start:max(total - offset, 0)][::-1]
+            else:
+                page = indices[offset:None if limit is None else offset + limit]
+            return [ProductRow(store, i) for i in page], total
+
+catalog = ProductCatalog()
+
+@timed("read_products")
+def read_products():
+    """Read products from storage and return them as a ProductStore of row views"""
+    pricing.refresh()
+    try:
+        return catalog.refresh()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error reading products: {e}")
+        return []
+
+def products_file_data(products):
+    """Encode products in the comma-separated snapshot format"""
+    lines = []
+    for p in products:
+        line = ",".join(quote_field(p[field]) for field in PRODUCT_FIELDS)
+        lines.append(line)
+    return "\n".join(lines).encode()
+
+def write_products_file(path, products):
+    """Atomically write products in the comma-separated snapshot format"""
+    atomic_write(path, products_file_data(products))
+
+@timed("save_products")
+def save_products(products):
+    """Save the full products list as the new catalog"""
+    try:
+        catalog.save(products)
+        return True
+    except Exception as e:
+        print(f"Error saving products: {e}")
+        catalog.invalidate()
+        return False
+
+@timed("commit_stock")
+def commit_stock_changes():
+    """Write the pending sale/restock changes to storage"""
+    try:
+        catalog.commit()
+        return True
+    except Exception as e:
+        print(f"Error saving stock changes: {e}")
+        catalog.invalidate()
+        return False
+
+def reserve_stock(product, quantity, kind):
+    """Reserve stock for a sale; print the reason and return False on failure"""
+    try:
+        catalog.reserve(product, quantity, kind)
+        return True
+    except StockConflict as e:
+        print(f"Insufficient stock! Available: {e.available}")
+    except StorageBusy as e:
+        print(f"Stock is being updated on another terminal: {e}")
+    return False
+
+def display_menu():
+    """Display main menu"""
+    print("\n" + "=" * 60 + "WeCare Product Management System" + "=" * 60)
+    print("1. Display Products")
+    print("2. Sell Products")
+    print("3. Restock Products")
+    print("4. Exit")
+    print("-" * 60)
+
+PRODUCT_ROW_FORMAT = "{:<5} {:<30} {:<20} {:<10} {:<10} {:<15}"
+
+@timed("render_table")
+def format_product_table(products, total=None, offset=0, title=None):
+    """Render a product table, with a page footer if rows were left out"""
+    lines = [title] if title else []
+    lines.append(PRODUCT_ROW_FORMAT.format('ID', 'Name', 'Brand', 'Quantity', 'Price (NPR)', 'Origin'))
+    lines.append("-" * 90)
+    row_format = PRODUCT_ROW_FORMAT.format
+    for product in products:
+        lines.append(row_format(product['id'], product['name'], product['brand'], product['quantity'],
+                                f"{catalog.selling_price(product):,.2f}", product['origin']))
+    lines.append("-" * 90)
+    if products and total is not None and len(products) < total:
+        lines.append(f"Showing {offset + 1}-{offset + len(products)} of {total:,} products")
+    return "\n".join(lines) + "\n"
+
+@timed("display_products")
+def display_products(page=1, page_size=PAGE_SIZE, **filters):
+    """Display one page of products with marked up prices; return the page count"""
+    read_products()
+    offset = (page - 1) * page_size
+    products, total = catalog.list_products(offset=offset, limit=page_size, **filters)
+    sys.stdout.write("\n" + format_product_table(products, total, offset))
+    return max(1, -(-total // page_size))
+
+def selling_price_range(min_price=None, max_price=None):
+    """list_products() filters for a range of selling prices
+
+    While every product has the same markup the range maps straight onto
+    cost prices, which list_products() cuts out of its price order.
+    """
+    markup = pricing.uniform_markup()
+    if markup is None:
+        return {'min_selling': min_price, 'max_selling': max_price}
+    return {'min_price': None if min_price is None else min_price / markup,
+            'max_price': None if max_price is None else max_price / markup}
+
+def display_eligible_products(base_price, page=1, page_size=PAGE_SIZE):
+    """Display only products that are eligible as free items"""
+    read_products()
+    offset = (page - 1) * page_size
+    products, total = catalog.list_products(max_price=base_price, in_stock=True, sort='price',
+                                            descending=True, offset=offset, limit=page_size)
+    sys.stdout.write(format_product_table(products, total, offset,
+                                          title="\n=== Eligible Products for Free Selection ==="))
+    return total > 0
+
+def display_search_results(query, limit=SEARCH_LIMIT):
+    """Display the products matching a name/brand search"""
+    read_products()
+    products = catalog.search(query, limit)
+    if not products:
+        print(f"No products match '{query}'!")
+        return False
+    sys.stdout.write(format_product_table(products, title=f"\n=== Products matching '{query}' ==="))
+    return True
+
+def report_low_stock(file=None):
+    """Print the products that just fell to their reorder point"""
+    for product in catalog.take_low_stock_alerts():
+        threshold, _ = catalog.reorder_point(product['id'])
+        print(f"Low stock: {product['name']} ({product['brand']}) has {product['quantity']} left "
+              f"(reorder point {threshold})", file=file)
+
+def write_reorder_manifest(groups, out):
+    """Write reorder suggestions as a restock manifest, grouped by brand and origin"""
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(('id', 'name', 'brand', 'quantity', 'price', 'origin'))
+    for _, _, lines in groups:
+        writer.writerows((product['id'], product['name'], product['brand'], quantity,
+                          product['price'], product['origin']) for product, quantity in lines)
+
+def suggest_restock(brand=None, origin=None, output=None):
+    """Write a restock manifest for everything at or below its reorder point"""
+    read_products()
+    groups = catalog.reorder_suggestions(brand, origin)
+    if not groups:
+        print("No products at or below their reorder point!")
+        return 1
+    out = sys.stdout if output in (None, "-") else open(output, "w", newline="")
+    try:
+        write_reorder_manifest(groups, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    for group_brand, group_origin, lines in groups:
+        print(f"{group_brand} / {group_origin}: {len(lines)} products, "
+              f"{sum(quantity for _, quantity in lines):,} units", file=sys.stderr)
+    return 0
+
+def set_reorder_point(product_id, threshold, level=None):
+    """Set a product's reorder point from the command line"""
+    read_products()
+    product = catalog.get(product_id)
+    if not product:
+        print(f"Product with ID {product_id} not found!")
+        return 1
+    if threshold < 0 or (level is not None and level <= threshold):
+        print("Threshold must not be negative and the order-up-to level must be above it!")
+        return 2
+    catalog.set_reorder_point(product_id, threshold, level)
+    threshold, level = catalog.reorder_point(product_id)
+    print(f"✓ {product['name']} ({product['brand']}): reorder at {threshold}, order up to {level}")
+    return 0
+
+def browse_products():
+    """Page through the catalog from the menu"""
+    page = 1
+    while True:
+        pages = display_products(page)
+        if page >= pages:
+            return
+        more = input(f"Page {page} of {pages}. Press Enter for the next page or 'q' to stop: ").strip().lower()
+        if more == 'q':
+            return
+        page += 1
+
+RULE = "=" * 60
+SECTION_RULE = "-" * 60
+ITEM_RULE = "-" * 40
+
+# Invoice layouts with the fixed parts pre-built; only fields are formatted per invoice
+PURCHASE_ITEM_TEMPLATE = """
+    Product: {name}
+    Brand: {brand}
+    Quantity: {quantity}
+    Unit Cost (NPR): {price:,.2f}
+    Subtotal: NPR {subtotal:,.2f}
+    """ + ITEM_RULE
+
+SALES_ITEM_TEMPLATE = """
+    Product: {name}
+    Brand: {brand}
+    Quantity: {quantity} (including {free_earned} free items)
+    Unit Price (NPR): {unit_price:,.2f}
+    Subtotal: NPR {subtotal:,.2f}
+    Discount: NPR {discount:,.2f}
+    """ + ITEM_RULE
+
+FREE_ITEM_TEMPLATE = """
+    Free Product: {name}
+    Brand: {brand}
+    Quantity: {quantity}
+    Unit Price (NPR): {price:,.2f}
+    """ + ITEM_RULE
+
+PURCHASE_INVOICE_TEMPLATE = f"""
+{RULE}
+                    WECARE BEAUTY
+                    Purchase Invoice
+{RULE}
+Invoice No: {{invoice_no}}
+Date: {{date}}
+Supplier: {{party}}
+{SECTION_RULE}
+
+ITEMS:{{items_detail}}
+
+{RULE}
+Total Amount: NPR {{total_amount:,.2f}}
+{RULE}
+"""
+
+SALES_INVOICE_TEMPLATE = f"""
+{RULE}
+                    WECARE BEAUTY
+                    Sales Invoice
+{RULE}
+Invoice No: {{invoice_no}}
+Date: {{date}}
+Customer Name: {{party}}
+{SECTION_RULE}
+
+ITEMS:{{items_detail}}
+
+{RULE}
+Total Amount: NPR {{total_amount:,.2f}}
+{RULE}
+
+Thank you for shopping with WeCare Beauty!
+{{free_offer}}"""
+
+def render_purchase_invoice(invoice_no, date, supplier_name, items):
+    """Render the text of a purchase/restock invoice"""
+    total_amount = 0
+    parts = []
+    for item in items:
+        subtotal = item['quantity'] * item['price']
+        total_amount += subtotal
+        parts.append(PURCHASE_ITEM_TEMPLATE.format(
+            name=item['name'], brand=item['brand'], quantity=item['quantity'],
+            price=item['price'], subtotal=subtotal))
+    return PURCHASE_INVOICE_TEMPLATE.format(
+        invoice_no=invoice_no, date=date, party=supplier_name,
+        items_detail="".join(parts), total_amount=total_amount)
+
+def render_sales_invoice(invoice_no, date, customer_name, items, free_items, free_every=None):
+    """Render the text of a sales invoice
+
+    The footer advertises buy free_every get 1 free, by default from the
+    current pricing rules, and is left out when that offer is off.
+    """
+    if free_every is None:
+        free_every = pricing.free_every
+    total_amount = 0
+    parts = []
+    for item in items:
+        subtotal = item['quantity'] * item['unit_price']
+        discount = item.get('discount', 0)
+        total_amount += subtotal - discount
+        parts.append(SALES_ITEM_TEMPLATE.format(
+            name=item['name'], brand=item['brand'], quantity=item['quantity'],
+            free_earned=item.get('free_earned', 0), unit_price=item['unit_price'],
+            subtotal=subtotal, discount=discount))
+    for free_item in free_items:
+        parts.append(FREE_ITEM_TEMPLATE.format(
+            name=free_item['name'], brand=free_item['brand'],
+            quantity=free_item['quantity'], price=free_item['price']))
+    free_offer = f"Buy {free_every} Get 1 Free on all products!\n" if free_every else ""
+    return SALES_INVOICE_TEMPLATE.format(
+        invoice_no=invoice_no, date=date, party=customer_name,
+        items_detail="".join(parts), total_amount=total_amount, free_offer=free_offer)
+
+INVOICE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    invoice_no TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    party TEXT NOT NULL,
+    party_key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    created TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invoices_party ON invoices (party_key, day);
+CREATE INDEX IF NOT EXISTS invoices_day ON invoices (day);
+"""
+
+class InvoiceArchive:
+    """Invoices stored in one compressed segment file per day plus an index
+
+    Each invoice is appended to <day>.seg as its own gzip member, so a
+    segment can still be read with zcat. index.db maps invoice number,
+    customer/supplier and day to (segment, offset, length), so fetching an
+    invoice is one indexed lookup and one seek.
+    """
+
+    def __init__(self, directory=INVOICE_ARCHIVE_DIR):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.db")
+        self._conn = None
+        self._lock = threading.Lock()
+        self._file_lock = InterProcessLock(os.path.join(directory, "archive" + LOCK_SUFFIX))
+
+    def connect(self):
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.executescript(INVOICE_INDEX_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def segment_name(self, created):
+        return created.strftime('%Y-%m-%d') + ".seg"
+
+    def store(self, invoice_no, kind, party, created, text):
+        """Append an invoice to its day's segment and index it; return its locator"""
+        segment = self.segment_name(created)
+        member = gzip.compress(text.encode(), mtime=0)
+        with self._lock:
+            conn = self.connect()
+            with self._file_lock:
+                with open(os.path.join(self.directory, segment), "ab") as file:
+                    offset = file.seek(0, os.SEEK_END)
+                    file.write(member)
+            metrics.add("bytes_written_total", len(member), file="invoice_archive")
+            conn.execute("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (invoice_no, kind, party, party.strip().lower(), created.strftime('%Y-%m-%d'),
+                          created.strftime('%Y-%m-%d %H:%M:%S'), segment, offset, len(member)))
+        return f"{os.path.join(self.directory, segment)}#{invoice_no}"
+
+    def store_batch(self, day, entries, data):
+        """Append already compressed invoices to a day's segment and index them together
+
+        entries are (invoice_no, kind, party, created, offset, length) with
+        offsets into data. Copies they replace stay in the segment but are
+        no longer indexed.
+        """
+        segment = day + ".seg"
+        with self._lock:
+            conn = self.connect()
+            with self._file_lock:
+                with open(os.path.join(self.directory, segment), "ab") as file:
+                    base = file.seek(0, os.SEEK_END)
+                    file.write(data)
+            metrics.add("bytes_written_total", len(data), file="invoice_archive")
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+                    (invoice_no, kind, party, party.strip().lower(), day, created, segment, base + offset, length)
+                    for invoice_no, kind, party, created, offset, length in entries])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def read(self, entry):
+        """Return the text of an invoice from its index entry"""
+        with open(os.path.join(self.directory, entry['segment']), "rb") as file:
+            file.seek(entry['offset'])
+            return gzip.decompress(file.read(entry['length'])).decode()
+
+    def _select(self, where, params):
+        with self._lock:
+            cursor = self.connect().execute(
+                "SELECT invoice_no, kind, party, day, created, segment, offset, length "
+                f"FROM invoices WHERE {where} ORDER BY created, invoice_no", params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def get(self, invoice_no):
+        """Return the text of one invoice (number or locator), or None"""
+        invoice_no = invoice_no.rsplit("#", 1)[-1]
+        rows = self._select("invoice_no = ?", (invoice_no,))
+        return self.read(rows[0]) if rows else None
+
+    def find(self, party=None, day=None, kind=None):
+        """Return index entries filtered by customer/supplier, day (YYYY-MM-DD) and kind"""
+        where, params = [], []
+        if party:
+            where.append("party_key = ?")
+            params.append(party.strip().lower())
+        if day:
+            where.append("day = ?")
+            params.append(day)
+        if kind:
+            where.append("kind = ?")
+            params.append(kind)
+        return self._select(" AND ".join(where) or "1", params)
+
+    def import_loose_invoices(self, directories=LEGACY_INVOICE_DIRS):
+        """Move invoices written as separate .txt files into the archive"""
+        count = 0
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith(".txt"):
+                    continue
+                path = os.path.join(directory, filename)
+                with open(path, "r") as file:
+                    text = file.read()
+                invoice_no = filename[:-4]
+                kind = "sale" if invoice_no.startswith("SALE_") else "restock"
+                party, created = "", None
+                for line in text.splitlines():
+                    if line.startswith(("Customer Name: ", "Supplier: ")):
+                        party = line.split(": ", 1)[1]
+                    elif line.startswith("Date: "):
+                        try:
+                            created = datetime.strptime(line[6:].strip(), '%Y-%m-%d %H:%M:%S')
+                        except ValueError:
+                            pass
+                if created is None:
+                    created = datetime.fromtimestamp(os.path.getmtime(path))
+                self.store(invoice_no, kind, party, created, text)
+                os.remove(path)
+                count += 1
+        return count
+
+invoice_archive = InvoiceArchive()
+
+class TransactionLog:
+    """One CSV row per invoice line, kept in a file per day for reporting
+
+    Rows are written in TRANSACTION_FIELDS order. All rows of an invoice go
+    out in a single O_APPEND write, so terminals and writer threads can
+    share a day's file without their lines interleaving.
+    """
+
+    def __init__(self, directory=TRANSACTIONS_DIR):
+        self.directory = directory
+
+    def path(self, day):
+        return os.path.join(self.directory, day + ".csv")
+
+    def append(self, created, rows):
+        """Append rows to the file for the day of created"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerows(rows)
+        data = buffer.getvalue().encode()
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.path(created.strftime('%Y-%m-%d')), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                # Two writers may both add a header here; readers skip repeats
+                data = (",".join(TRANSACTION_FIELDS) + "\n").encode() + data
+            os.write(fd, data)
+            metrics.add("bytes_written_total", len(data), file="transactions")
+        finally:
+            os.close(fd)
+
+    def files(self, since=None, until=None):
+        """Return the day files between since and until (YYYY-MM-DD, inclusive)"""
+        if not os.path.isdir(self.directory):
+            return []
+        paths = []
+        for filename in sorted(os.listdir(self.directory)):
+            day = filename[:-4]
+            if not filename.endswith(".csv") or (since and day < since) or (until and day > until):
+                continue
+            paths.append(os.path.join(self.directory, filename))
+        return paths
+
+transaction_log = TransactionLog()
+
+def sale_records(invoice_no, created, customer_name, items, free_items):
+    """Transaction rows for a sales invoice: one per charged and per free line"""
+    stamp = created.strftime('%Y-%m-%d %H:%M:%S')
+    rows = [(stamp, invoice_no, "sale", customer_name, item.get('id', ""), item['name'], item['brand'],
+             item.get('origin', ""), "sale", item['quantity'], item['price'], item['unit_price'],
+             item.get('discount', 0), item.get('free_earned', 0)) for item in items]
+    rows.extend((stamp, invoice_no, "sale", customer_name, item.get('id', ""), item['name'], item['brand'],
+                 item.get('origin', ""), "free", item['quantity'], item['price'], 0, 0, 0)
+                for item in free_items)
+    return rows
+
+def purchase_records(invoice_no, created, supplier_name, items):
+    """Transaction rows for a purchase/restock invoice"""
+    stamp = created.strftime('%Y-%m-%d %H:%M:%S')
+    return [(stamp, invoice_no, "restock", supplier_name, item.get('id', ""), item['name'], item['brand'],
+             item.get('origin', ""), "restock", item['quantity'], item['price'], 0, 0, 0) for item in items]
+
+def render_records(rows):
+    """Render an invoice again from its parsed transaction rows"""
+    created, invoice_no, kind, party = rows[0][:4]
+    items, free_items = [], []
+    for row in map(upgrade_transaction_row, rows):
+        quantity = int(float(row[9]))
+        item = {'id': row[4], 'name': row[5], 'brand': row[6], 'origin': row[7],
+                'quantity': quantity, 'price': float(row[10])}
+        if row[8] == "free":
+            free_items.append(item)
+        else:
+            if row[8] == "sale":
+                item['unit_price'] = float(row[11])
+                item['discount'] = float(row[12])
+                item['free_earned'] = int(float(row[13]))
+            items.append(item)
+    if kind == "sale":
+        return render_sales_invoice(invoice_no, created, party, items, free_items)
+    return render_purchase_invoice(invoice_no, created, party, items)
+
+class InvoiceWriter:
+    """Worker threads that render invoices and store them off the checkout path
+
+    submit() only blocks when queue_size invoices are already waiting, which
+    keeps memory bounded if the disk falls behind. flush() waits for every
+    queued invoice and shutdown() also stops the workers. With workers=0
+    invoices are written synchronously. Transaction rows submitted with an
+    invoice are appended to the transaction log after it is archived.
+    """
+
+    def __init__(self, archive, transactions=None, workers=INVOICE_WORKERS, queue_size=INVOICE_QUEUE_SIZE):
+        self.archive = archive
+        self.transactions = transactions
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.errors = []
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, invoice_no, kind, party, created, records, render, *args):
+        """Queue render(*args) to be stored in the archive as invoice_no"""
+        job = (invoice_no, kind, party, created, records, render, args)
+        if self.workers <= 0:
+            self._write(*job)
+            return
+        with self._lock:
+            if not self._threads:
+                for n in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f"invoice-writer-{n}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        self.queue.put(job)
+
+    @timed("invoice_write")
+    def _write(self, invoice_no, kind, party, created, records, render, args):
+        self.archive.store(invoice_no, kind, party, created, render(*args))
+        metrics.add("invoices_total", kind=kind)
+        if records and self.transactions is not None:
+            self.transactions.append(created, records)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                try:
+                    self._write(*job)
+                except Exception as e:
+                    with self._lock:
+                        self.errors.append((job[0], e))
+                    print(f"Error writing invoice {job[0]}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Block until every queued invoice has been written"""
+        self.queue.join()
+
+    def shutdown(self):
+        """Write everything still queued and stop the worker threads"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+invoice_writer = InvoiceWriter(invoice_archive, transaction_log)
+atexit.register(invoice_writer.shutdown)
+
+class InvoiceSequence:
+    """Invoice numbers that are unique across threads and processes
+
+    The shared counter file is only touched (under an flock and with an
+    atomic rewrite) once per block_size numbers; each process hands out its
+    block from memory. Numbers left in a block when a process exits are
+    skipped, so the sequence is increasing per process but may have gaps.
+    """
+
+    def __init__(self, path=INVOICE_SEQUENCE_FILE, block_size=INVOICE_BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        self._file_lock = InterProcessLock(path + LOCK_SUFFIX)
+
+    def _allocate(self):
+        with self._file_lock:
+            try:
+                with open(self.path, "r") as file:
+                    start = int(file.read().strip() or 1)
+            except FileNotFoundError:
+                start = 1
+            atomic_write(self.path, str(start + self.block_size).encode())
+        self._next, self._end = start, start + self.block_size
+
+    def next(self):
+        """Return the next invoice number"""
+        with self._lock:
+            if self._next >= self._end:
+                self._allocate()
+            number = self._next
+            self._next += 1
+            return number
+
+invoice_sequence = InvoiceSequence()
+
+def invoice_locator(invoice_no, created):
+    """Return where an invoice is archived, as '<segment path>#<invoice no>'"""
+    return f"{os.path.join(invoice_archive.directory, invoice_archive.segment_name(created))}#{invoice_no}"
+
+def next_invoice_no(prefix, now):
+    """Return a collision-free invoice number such as SALE_20250101093000_00000042"""
+    return f"{prefix}_{now.strftime('%Y%m%d%H%M%S')}_{invoice_sequence.next():08d}"
+
+@timed("invoice_submit")
+def create_purchase_invoice(supplier_name, items):
+    """Generate purchase/restock invoice in the background and return its locator"""
+    create_invoice_directories()
+    now = datetime.now()
+    invoice_no = next_invoice_no("RESTOCK", now)
+    invoice_writer.submit(invoice_no, "restock", supplier_name, now,
+                          purchase_records(invoice_no, now, supplier_name, items),
+                          render_purchase_invoice, invoice_no,
+                          now.strftime('%Y-%m-%d %H:%M:%S'), supplier_name,
+                          [dict(item) for item in items])
+    return invoice_locator(invoice_no, now)
+
+@timed("invoice_submit")
+def create_sales_invoice(customer_name, items, free_items):
+    """Generate sales invoice with the buy-N-get-one-free policy in the background"""
+    create_invoice_directories()
+    now = datetime.now()
+    invoice_no = next_invoice_no("SALE", now)
+    invoice_writer.submit(invoice_no, "sale", customer_name, now,
+                          sale_records(invoice_no, now, customer_name, items, free_items),
+                          render_sales_invoice, invoice_no,
+                          now.strftime('%Y-%m-%d %H:%M:%S'), customer_name,
+                          [dict(item) for item in items], [dict(item) for item in free_items],
+                          pricing.free_every)
+    return invoice_locator(invoice_no, now)
+
+def free_item(product, quantity):
+    """Invoice line for a product given away free"""
+    return {
+        'id': product['id'],
+        'name': product['name'],
+        'brand': product['brand'],
+        'origin': product['origin'],
+        'quantity': quantity,
+        'price': product['price']
+    }
+
+def sale_item(product, quantity, promotions=None):
+    """Invoice line for quantity units of product at its selling price, less any promotion
+
+    promotions defaults to the ones running now; pass active_promotions()
+    in when pricing many lines at once.
+    """
+    if promotions is None:
+        promotions = pricing.active_promotions()
+    unit_price = catalog.selling_price(product)
+    if isinstance(product, ProductRow):
+        product = product.to_dict()
+    share, promotion = pricing.best_promotion(promotions, product['id'], product['brand'],
+                                              product['origin'], quantity)
+    item = {
+        'id': product['id'],
+        'name': product['name'],
+        'brand': product['brand'],
+        'origin': product['origin'],
+        'quantity': quantity,
+        'price': product['price'],
+        'unit_price': unit_price,
+        'discount': quantity * unit_price * share,
+        'free_earned': pricing.free_units(quantity)
+    }
+    if promotion:
+        item['promotion'] = promotion
+    return item
+
+def sell_products():
+    """Handle product sales"""
+    items = []
+    free_items = []
+    
+    # Get customer name with validation
+    while True:
+        customer_name = input("Enter customer name: ").strip()
+        if not customer_name:
+            print("Customer name cannot be empty!")
+            continue
+        if any(char.isdigit() for char in customer_name):
+            print("Customer name should not contain numbers!")
+            continue
+        break
+    
+    products = read_products()
+    if not products:
+        print("No products available for sale!")
+        return
+    catalog.watch_low_stock()
+    
+    reserved = []
+    try:
+        while True:
+            try:
+                display_products()
+                product_id = input("\nEnter product ID (or a name/brand to search): ").strip()
+                
+                if not product_id:
+                    print("Product ID cannot be empty!")
+                    continue
+                    
+                try:
+                    product_id = int(product_id)
+                except ValueError:
+                    display_search_results(product_id)
+                    continue
+                    
+                product = catalog.get(product_id)
+                if not product:
+                    print(f"Product with ID {product_id} not found!")
+                    continue
+                
+                quantity = input("Enter quantity: ").strip()
+                if not quantity:
+                    print("Quantity cannot be empty!")
+                    continue
+                    
+                try:
+                    quantity = int(quantity)
+                except ValueError:
+                    print("Quantity must be a number!")
+                    continue
+                    
+                if quantity <= 0:
+                    print("Quantity must be positive!")
+                    continue
+                
+                if quantity > MAX_SALE_QUANTITY:  # Add reasonable limits
+                    print("Quantity exceeds maximum limit of 1000!")
+                    continue
+                    
+                if product['quantity'] < quantity:
+                    print(f"Insufficient stock! Available: {product['quantity']}")
+                    continue
+                
+                # Reserve the stock now so other terminals cannot sell it too
+                if not reserve_stock(product, quantity, 'sale'):
+                    continue
+                reserved.append((product['id'], quantity))
+                items.append(sale_item(product, quantity))
+                if items[-1].get('promotion'):
+                    print(f"{items[-1]['promotion']}: NPR {items[-1]['discount']:,.2f} off")
+                
+                # Handle free items
+                free_quantity = items[-1]['free_earned']
+                if free_quantity > 0:
+                    while True:
+                        choice = input(f"\nYou've earned {free_quantity} free items! Choose an option:\n"
+                                     "1. Select different products as free items\n"
+                                     "2. Get discount instead\n"
+                                     "Enter choice (1/2): ").strip()
+                        
+                        if not choice:
+                            print("Choice cannot be empty!")
+                            continue
+                            
+                        if choice not in ['1', '2']:
+                            print("Invalid choice! Please enter 1 or 2.")
+                            continue
+                        
+                        if choice == '1':
+                            # Free item selection with validation
+                            remaining_free = free_quantity
+                            display_eligible_products(product['price'])
+                            while remaining_free > 0:
+                                try:
+                                    free_id = input(f"\nEnter product ID for free item ({remaining_free} remaining), "
+                                                    "'a' to pick the best value or '0' for discount: ").strip()
+                                    
+                                    if not free_id:
+                                        print("Product ID cannot be empty!")
+                                        continue
+                                        
+                                    if free_id == '0':
+                                        remaining_discount = pricing.free_item_discount(items[-1]['unit_price'], remaining_free)
+                                        items[-1]['discount'] = items[-1].get('discount', 0) + remaining_discount
+                                        print(f"Applying discount of NPR {remaining_discount:,.2f}")
+                                        break
+                                    
+                                    if free_id.lower() == 'a':
+                                        picks = catalog.suggest_free_items(product['price'], remaining_free)
+                                        if not picks:
+                                            print("No eligible products in stock!")
+                                        for free_product, free_qty in picks:
+                                            if not reserve_stock(free_product, free_qty, 'free'):
+                                                break
+                                            reserved.append((free_product['id'], free_qty))
+                                            free_items.append(free_item(free_product, free_qty))
+                                            remaining_free -= free_qty
+                                            print(f"Added {free_qty} x {free_product['name']} ({free_product['brand']}) free")
+                                        continue
+                                    
+                                    try:
+                                        free_id = int(free_id)
+                                    except ValueError:
+                                        print("Product ID must be a number!")
+                                        continue
+                                    
+                                    free_product = catalog.get(free_id)
+                                    if not free_product:
+                                        print(f"Product with ID {free_id} not found!")
+                                        continue
+                                    
+                                    if free_product['price'] > product['price']:
+                                        print("Selected product exceeds price limit for free items!")
+                                        continue
+                                    
+                                    free_qty = input(f"Enter quantity for free item (max {remaining_free}): ").strip()
+                                    if not free_qty:
+                                        print("Quantity cannot be empty!")
+                                        continue
+                                    
+                                    try:
+                                        free_qty = int(free_qty)
+                                    except ValueError:
+                                        print("Quantity must be a number!")
+                                        continue
+                                    
+                                    if free_qty <= 0 or free_qty > remaining_free:
+                                        print(f"Invalid quantity! You can select up to {remaining_free} free items.")
+                                        continue
+                                    
+                                    if free_qty > free_product['quantity']:
+                                        print(f"Insufficient stock for free item! Available: {free_product['quantity']}")
+                                        continue
+                                    
+                                    if not reserve_stock(free_product, free_qty, 'free'):
+                                        continue
+                                    reserved.append((free_product['id'], free_qty))
+                                    free_items.append(free_item(free_product, free_qty))
+                                    remaining_free -= free_qty
+                                    
+                                except Exception as e:
+                                    print(f"An error occurred: {str(e)}")
+                                    continue
+                            break
+                            
+                        elif choice == '2':
+                            discount = pricing.free_item_discount(items[-1]['unit_price'], free_quantity)
+                            items[-1]['discount'] = items[-1].get('discount', 0) + discount
+                            break
+                
+                # Ask for more purchases
+                while True:
+                    more = input("\nWould you like to purchase more items? (yes/no): ").strip().lower()
+                    if not more:
+                        print("Input cannot be empty!")
+                        continue
+                    if more not in ['yes', 'no']:
+                        print("Please enter 'yes' or 'no'")
+                        continue
+                    break
+                
+                if more == 'no':
+                    break
+                    
+            except Exception as e:
+                print(f"An error occurred: {str(e)}")
+                print("Please try again.")
+                continue
+    except BaseException:
+        # Interrupted mid-sale: give the reserved stock back
+        if reserved:
+            catalog.release(reserved)
+        raise
+    
+    if items:
+        try:
+            filepath = create_sales_invoice(customer_name, items, free_items)
+            print(f"\n✓ Sales invoice created successfully: {filepath}")
+        except Exception as e:
+            print(f"Error saving transaction: {str(e)}")
+    report_low_stock()
+
+def restock_products():
+    """Handle product restocking"""
+    items = []
+    
+    # Get supplier name with validation
+    while True:
+        supplier_name = input("Enter supplier name: ").strip()
+        if not supplier_name:
+            print("Supplier name cannot be empty!")
+            continue
+        if any(char.isdigit() for char in supplier_name):
+            print("Supplier name should not contain numbers!")
+            continue
+        break
+
+    products = read_products()
+    if not products:
+        print("No products database found!")
+        return
+        
+    next_id = catalog.next_id()
+
+    while True:
+        restock_choice = input("\nDo you want to restock an existing item? (yes/no): ").strip().lower()
+        if not restock_choice:
+            print("Choice cannot be empty!")
+            continue
+        if restock_choice not in ['yes', 'no']:
+            print("Please enter 'yes' or 'no'")
+            continue
+        break
+
+    if restock_choice == 'yes':
+        while True:
+            try:
+                display_products()
+                product_id = input("\nEnter product ID (or a name/brand to search): ").strip()
+                
+                if not product_id:
+                    print("Product ID cannot be empty!")
+                    continue
+                    
+                try:
+                    product_id = int(product_id)
+                except ValueError:
+                    display_search_results(product_id)
+                    continue
+                
+                product = catalog.get(product_id)
+                if not product:
+                    print(f"Product with ID {product_id} not found!")
+                    retry = input("Would you like to try another ID? (yes/no): ").lower()
+                    if retry != 'yes':
+                        break
+                    continue
+                
+                print(f"Current stock for {product['name']}: {product['quantity']}")
+                
+                quantity = input("Enter quantity to restock: ").strip()
+                if not quantity:
+                    print("Quantity cannot be empty!")
+                    continue
+                    
+                try:
+                    quantity = int(quantity)
+                except ValueError:
+                    print("Quantity must be a number!")
+                    continue
+                
+                if quantity <= 0:
+                    print("Quantity must be positive!")
+                    continue
+                
+                if quantity > MAX_RESTOCK_QUANTITY:
+                    print(f"Quantity exceeds maximum limit of {MAX_RESTOCK_QUANTITY:,}!")
+                    continue
+                    
+                catalog.adjust_stock(product, quantity, 'restock')
+                items.append({
+                    'id': product['id'],
+                    'name': product['name'],
+                    'brand': product['brand'],
+                    'origin': product['origin'],
+                    'quantity': quantity,
+                    'price': product['price']
+                })
+                
+                while True:
+                    more = input("\nWould you like to restock more existing items? (yes/no): ").strip().lower()
+                    if not more:
+                        print("Choice cannot be empty!")
+                        continue
+                    if more not in ['yes', 'no']:
+                        print("Please enter 'yes' or 'no'")
+                        continue
+                    break
+                
+                if more == 'no':
+                    break
+                    
+            except Exception as e:
+                print(f"An error occurred: {str(e)}")
+                print("Please try again.")
+                continue
+    else:
+        while True:
+            add_new = input("\nDo you want to add new products? (yes/no): ").strip().lower()
+            if not add_new:
+                print("Choice cannot be empty!")
+                continue
+            if add_new not in ['yes', 'no']:
+                print("Please enter 'yes' or 'no'")
+                continue
+            break
+
+        if add_new == 'yes':
+            while True:
+                try:
+                    name = input("\nEnter product name: ").strip()
+                    if not name:
+                        print("Product name cannot be empty!")
+                        continue
+                        
+                    brand = input("Enter brand: ").strip()
+                    if not brand:
+                        print("Brand cannot be empty!")
+                        continue
+                    
+                    quantity = input("Enter quantity: ").strip()
+                    if not quantity:
+                        print("Quantity cannot be empty!")
+                        continue
+                    try:
+                        quantity = int(quantity)
+                        if quantity <= 0:
+                            print("Quantity must be positive!")
+                            continue
+                        if quantity > MAX_RESTOCK_QUANTITY:
+                            print(f"Quantity exceeds maximum limit of {MAX_RESTOCK_QUANTITY:,}!")
+                            continue
+                    except ValueError:
+                        print("Quantity must be a number!")
+                        continue
+                    
+                    price = input("Enter cost price: ").strip()
+                    if not price:
+                        print("Price cannot be empty!")
+                        continue
+                    try:
+                        price = float(price)
+                        if price <= 0:
+                            print("Price must be positive!")
+                            continue
+                        if price > MAX_COST_PRICE:
+                            print(f"Price exceeds maximum limit of {MAX_COST_PRICE:,}!")
+                            continue
+                    except ValueError:
+                        print("Price must be a number!")
+                        continue
+                    
+                    origin = input("Enter origin country: ").strip()
+                    if not origin:
+                        print("Origin cannot be empty!")
+                        continue
+                    if any(char.isdigit() for char in origin):
+                        print("Origin should not contain numbers!")
+                        continue
+                    
+                    # The record gets its final ID when the stock changes are committed
+                    items.append(catalog.add({
+                        'id': next_id,
+                        'name': name,
+                        'brand': brand,
+                        'quantity': quantity,
+                        'price': price,
+                        'origin': origin
+                    }))
+                    
+                    next_id += 1
+                    
+                    while True:
+                        more = input("\nWould you like to add more new products? (yes/no): ").strip().lower()
+                        if not more:
+                            print("Choice cannot be empty!")
+                            continue
+                        if more not in ['yes', 'no']:
+                            print("Please enter 'yes' or 'no'")
+                            continue
+                        break
+                    
+                    if more == 'no':
+                        break
+                        
+                except Exception as e:
+                    print(f"An error occurred: {str(e)}")
+                    print("Please try again.")
+                    continue
+    
+    if items:
+        try:
+            commit_stock_changes()
+            filepath = create_purchase_invoice(supplier_name, items)
+            print(f"\n✓ Restock invoice created successfully: {filepath}")
+        except Exception as e:
+            print(f"Error saving transaction: {str(e)}")
+
+def parse_free_spec(spec):
+    """Parse CSV free-item selections written as 'id:qty;id:qty'"""
+    free = []
+    for part in filter(None, (p.strip() for p in spec.split(";"))):
+        product_id, _, quantity = part.partition(":")
+        free.append({'id': product_id.strip(), 'quantity': quantity.strip() or 1})
+    return free
+
+def load_orders(source, fmt=None):
+    """Yield orders from a JSONL or CSV file, or stdin when source is '-'
+
+    JSONL: {"order_id": ..., "customer": ..., "items": [{"id": 5, "quantity": 3,
+    "reward": "free" | "best" | "discount", "free": [{"id": 2, "quantity": 1}]}]}
+    where "best" picks the best-value eligible free items automatically.
+    CSV: order_id,customer,product_id,quantity,reward,free with one row per
+    line item and free items written as "id:qty;id:qty".
+    """
+    if fmt is None:
+        fmt = "csv" if source.lower().endswith(".csv") else "jsonl"
+    file = sys.stdin if source == "-" else open(source, "r", newline="")
+    try:
+        if fmt == "jsonl":
+            for line_no, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    order = json.loads(line)
+                except ValueError as e:
+                    order = {'order_id': f"line {line_no}", 'error': f"Invalid JSON: {e}"}
+                yield order if isinstance(order, dict) else {'order_id': f"line {line_no}",
+                                                             'error': "Expected a JSON object"}
+            return
+        order = None
+        for row in csv.DictReader(file):
+            order_id = (row.get('order_id') or "").strip()
+            if order is None or order_id != order['order_id']:
+                if order is not None:
+                    yield order
+                order = {'order_id': order_id, 'customer': (row.get('customer') or "").strip(), 'items': []}
+            order['items'].append({
+                'id': row.get('product_id'),
+                'quantity': row.get('quantity'),
+                'reward': (row.get('reward') or "").strip().lower() or None,
+                'free': parse_free_spec(row.get('free') or "")
+            })
+        if order is not None:
+            yield order
+    finally:
+        if file is not sys.stdin:
+            file.close()
 
-def read_products():
-    """Read products from file and return as list of dictionaries"""
-    products = []
+def customer_name_error(name, role="Customer"):
+    """Return why a customer/supplier name is invalid, or None"""
+    if not name:
+        return f"{role} name cannot be empty!"
+    if any(char.isdigit() for char in name):
+        return f"{role} name should not contain numbers!"
+    return None
+
+def parse_quantity(value, limit):
+    """Return (quantity, error) for a positive integer quantity up to limit"""
     try:
-        with open("products.txt", "r") as file:
-            for line in file:
-                data = [x.strip() for x in line.strip().split(",")]
-                if len(data) == 6:  # ID, name, brand, quantity, price, origin
-                    products.append({
-                        'id': int(data[0]),
-                        'name': data[1],
-                        'brand': data[2],
-                        'quantity': int(data[3]),
-                        'price': float(data[4]),
-                        'origin': data[5]
-                    })
-        return products
-    except FileNotFoundError:
-        print("Products file not found!")
-        return []
+        quantity = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None, "Quantity must be a number!"
+    if quantity <= 0:
+        return None, "Quantity must be positive!"
+    if quantity > limit:
+        return None, f"Quantity exceeds maximum limit of {limit:,}!"
+    return quantity, None
 
-def save_products(products):
-    """Save products list to file"""
+def parse_price(value, limit=MAX_COST_PRICE):
+    """Return (price, error) for a positive cost price up to limit"""
     try:
-        with open("products.txt", "w") as file:
-            lines = []
-            for p in products:
-                line = f"{p['id']},{p['name']},{p['brand']},{p['quantity']},{p['price']},{p['origin']}"
-                lines.append(line)
-            file.write("\n".join(lines))
-        return True
-    except Exception as e:
-        print(f"Error saving products: {e}")
-        return False
+        price = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return None, "Price must be a number!"
+    if not price > 0:
+        return None, "Price must be positive!"
+    if price > limit:
+        return None, f"Price exceeds maximum limit of {limit:,}!"
+    return price, None
 
-def display_menu():
-    """Display main menu"""
-    print("\n" + "=" * 60 + "WeCare Product Management System" + "=" * 60)
-    print("1. Display Products")
-    print("2. Sell Products")
-    print("3. Restock Products")
-    print("4. Exit")
-    print("-" * 60)
+def build_sale(order, remaining):
+    """Validate one order like sell_products() does and work out its lines
 
-def display_products():
-    """Display all products with marked up prices"""
-    print("\n{:<5} {:<30} {:<20} {:<10} {:<10} {:<15}".format(
-        'ID', 'Name', 'Brand', 'Quantity', 'Price (NPR)', 'Origin'))
-    print("-" * 90)
-    for product in read_products():
-        selling_price = product['price'] * 3  # 200% markup
-        print("{:<5} {:<30} {:<20} {:<10} {:<10} {:<15}".format(
-            product['id'], product['name'], product['brand'], 
-            product['quantity'], f"{selling_price:,.2f}", product['origin']))
-    print("-" * 90)
-
-def display_eligible_products(products, base_price):
-    """Display only products that are eligible as free items"""
-    print("\n=== Eligible Products for Free Selection ===")
-    print("{:<5} {:<30} {:<20} {:<10} {:<10} {:<15}".format(
-        'ID', 'Name', 'Brand', 'Quantity', 'Price (NPR)', 'Origin'))
-    print("-" * 90)
-    
-    eligible_found = False
-    for product in products:
-        if product['price'] <= base_price and product['quantity'] > 0:
-            eligible_found = True
-            selling_price = product['price'] * 3  # 200% markup
-            print("{:<5} {:<30} {:<20} {:<10} {:<10} {:<15}".format(
-                product['id'], product['name'], product['brand'], 
-                product['quantity'], f"{selling_price:,.2f}", product['origin']))
-    print("-" * 90)
-    
-    return eligible_found
+    remaining maps product ID to stock still available in this batch and is
+    only updated when the whole order is valid. Returns (items, free_items,
+    changes, errors).
+    """
+    customer_name = str(order.get('customer') or "").strip()
+    error = order.get('error') or customer_name_error(customer_name)
+    errors = [error] if error else []
+    items, free_items, changes = [], [], []
+    taken = {}
 
-def create_purchase_invoice(supplier_name, items):
-    """Generate purchase/restock invoice"""
-    create_invoice_directories()
-    
-    invoice_no = f"RESTOCK_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    total_amount = 0
-    items_detail = ""
-    
-    for item in items:
-        subtotal = item['quantity'] * item['price']
-        total_amount += subtotal
-        items_detail += f"""
-    Product: {item['name']}
-    Brand: {item['brand']}
-    Quantity: {item['quantity']}
-    Unit Cost (NPR): {item['price']:,.2f}
-    Subtotal: NPR {subtotal:,.2f}
-    {'-'*40}"""
-    
-    invoice = f"""
-{'='*60}
-                    WECARE BEAUTY
-                    Purchase Invoice
-{'='*60}
-Invoice No: {invoice_no}
-Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-Supplier: {supplier_name}
-{'-'*60}
+    def left(product):
+        return remaining.get(product['id'], product['quantity']) - taken.get(product['id'], 0)
 
-ITEMS:{items_detail}
+    promotions = pricing.active_promotions()
 
-{'='*60}
-Total Amount: NPR {total_amount:,.2f}
-{'='*60}
-"""
-    filepath = f"Restock Invoice/{invoice_no}.txt"
-    with open(filepath, "w") as file:
-        file.write(invoice)
-    return filepath
+    lines = order.get('items') or []
+    if not isinstance(lines, list):
+        errors.append("Items must be a list!")
+        lines = []
+    if not lines and not errors:
+        errors.append("Order has no items!")
+    for n, line in enumerate(lines, 1):
+        if not isinstance(line, dict):
+            errors.append(f"Item {n}: Expected an object with id and quantity!")
+            continue
+        try:
+            product_id = int(line.get('id'))
+        except (TypeError, ValueError, OverflowError):
+            errors.append(f"Item {n}: Product ID must be a number!")
+            continue
+        product = catalog.get(product_id)
+        if not product:
+            errors.append(f"Item {n}: Product with ID {product_id} not found!")
+            continue
+        quantity, error = parse_quantity(line.get('quantity'), MAX_SALE_QUANTITY)
+        if error:
+            errors.append(f"Item {n}: {error}")
+            continue
+        if left(product) < quantity:
+            errors.append(f"Item {n}: Insufficient stock! Available: {left(product)}")
+            continue
+        taken[product_id] = taken.get(product_id, 0) + quantity
+        changes.append(StockChange('sale', product_id, -quantity, None))
+        item = sale_item(product, quantity, promotions)
+        items.append(item)
 
-def create_sales_invoice(customer_name, items, free_items):
-    """Generate sales invoice with buy 3 get 1 free policy"""
-    create_invoice_directories()
-    
-    invoice_no = f"SALE_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    total_amount = 0
-    items_detail = ""
-    
+        remaining_free = item['free_earned']
+        free_lines = line.get('free') or []
+        if not isinstance(free_lines, list):
+            errors.append(f"Item {n}: Free items must be a list!")
+            continue
+        reward = line.get('reward') or ("free" if free_lines else "discount")
+        if remaining_free == 0:
+            continue
+        if reward not in ("free", "best", "discount"):
+            errors.append(f"Item {n}: Invalid reward! Use 'free', 'best' or 'discount'.")
+            continue
+        if reward == "best":
+            for free_product, free_qty in catalog.suggest_free_items(product['price'], remaining_free, left):
+                taken[free_product['id']] = taken.get(free_product['id'], 0) + free_qty
+                changes.append(StockChange('free', free_product['id'], -free_qty, None))
+                free_items.append(free_item(free_product, free_qty))
+                remaining_free -= free_qty
+        if reward == "free":
+            for free_line in free_lines:
+                if not isinstance(free_line, dict):
+                    errors.append(f"Item {n}: Expected an object with id and quantity for a free item!")
+                    continue
+                try:
+                    free_id = int(free_line.get('id'))
+                except (TypeError, ValueError, OverflowError):
+                    errors.append(f"Item {n}: Free product ID must be a number!")
+                    continue
+                free_product = catalog.get(free_id)
+                if not free_product:
+                    errors.append(f"Item {n}: Product with ID {free_id} not found!")
+                    continue
+                if free_product['price'] > product['price']:
+                    errors.append(f"Item {n}: Product {free_id} exceeds price limit for free items!")
+                    continue
+                free_qty, error = parse_quantity(free_line.get('quantity'), remaining_free)
+                if error:
+                    errors.append(f"Item {n}: Invalid free quantity! You can select up to {remaining_free} free items.")
+                    continue
+                if free_qty > left(free_product):
+                    errors.append(f"Item {n}: Insufficient stock for free item! Available: {left(free_product)}")
+                    continue
+                taken[free_id] = taken.get(free_id, 0) + free_qty
+                changes.append(StockChange('free', free_id, -free_qty, None))
+                free_items.append(free_item(free_product, free_qty))
+                remaining_free -= free_qty
+        # Whatever is not taken as free items becomes the 50% discount
+        if remaining_free > 0:
+            item['discount'] += pricing.free_item_discount(item['unit_price'], remaining_free)
+
+    if not errors:
+        for product_id, quantity in taken.items():
+            product = catalog.get(product_id)
+            remaining[product_id] = remaining.get(product_id, product['quantity']) - quantity
+    return items, free_items, changes, errors
+
+def sale_total(items):
+    """Total charged for sale items, after discounts"""
+    return sum(item['quantity'] * item['unit_price'] - item.get('discount', 0) for item in items)
+
+@timed("quote_sale")
+def quote_sale(lines, now=None):
+    """Price (product_id, quantity) lines like a sale, without touching stock
+
+    Returns (items, total). Raises ValueError for an unknown product or a
+    quantity out of range.
+    """
+    promotions = pricing.active_promotions(now)
+    items = []
+    for product_id, quantity in lines:
+        product = catalog.get(product_id)
+        if product is None:
+            raise ValueError(f"Product with ID {product_id} not found!")
+        if not 0 < quantity <= MAX_SALE_QUANTITY:
+            raise ValueError(f"Quantity for product {product_id} must be 1-{MAX_SALE_QUANTITY}!")
+        items.append(sale_item(product, quantity, promotions))
+    return items, sale_total(items)
+
+def print_quote(specs):
+    """Print the price of a basket given as ID:QUANTITY strings"""
+    try:
+        lines = [tuple(map(int, spec.split(":", 1))) if ":" in spec else (int(spec), 1) for spec in specs]
+    except ValueError:
+        print("Give items as ID or ID:QUANTITY!")
+        return 2
+    read_products()
+    try:
+        items, total = quote_sale(lines)
+    except ValueError as e:
+        print(e)
+        return 1
+    out = ["{:<40} {:>6} {:>14} {:>14} {:>12} {:>6}  {}".format(
+        'Product', 'Qty', 'Unit (NPR)', 'Subtotal', 'Discount', 'Free', 'Promotion'), "-" * 110]
     for item in items:
-        free_items_count = item.get('free_earned', 0)
-        charged_quantity = item['quantity']
-        subtotal = charged_quantity * (item['price'] * 3)  # 200% markup
-        discount = item.get('discount', 0)
-        total_amount += subtotal - discount
-        
-        items_detail += f"""
-    Product: {item['name']}
-    Brand: {item['brand']}
-    Quantity: {item['quantity']} (including {free_items_count} free items)
-    Unit Price (NPR): {item['price'] * 3:,.2f}
-    Subtotal: NPR {subtotal:,.2f}
-    Discount: NPR {discount:,.2f}
-    {'-'*40}"""
+        out.append("{:<40} {:>6} {:>14,.2f} {:>14,.2f} {:>12,.2f} {:>6}  {}".format(
+            f"{item['id']} {item['name']} ({item['brand']})"[:40], item['quantity'], item['unit_price'],
+            item['quantity'] * item['unit_price'], item['discount'], item['free_earned'],
+            item.get('promotion', "")))
+    out.append("-" * 110)
+    out.append(f"Total: NPR {total:,.2f} (before free-item choices)")
+    sys.stdout.write("\n".join(out) + "\n")
+    return 0
 
-    for free_item in free_items:
-        items_detail += f"""
-    Free Product: {free_item['name']}
-    Brand: {free_item['brand']}
-    Quantity: {free_item['quantity']}
-    Unit Price (NPR): {free_item['price']:,.2f}
-    {'-'*40}"""
-    
-    invoice = f"""
-{'='*60}
-                    WECARE BEAUTY
-                    Sales Invoice
-{'='*60}
-Invoice No: {invoice_no}
-Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-Customer Name: {customer_name}
-{'-'*60}
+@timed("process_orders")
+def process_orders(orders):
+    """Validate and commit a batch of orders with one load and one write
+
+    Every valid order's stock changes are reserved together; if another
+    terminal takes stock in the meantime the batch is re-validated against
+    the fresh catalog. Returns one result dictionary per order.
+    """
+    orders = list(orders)
+    for attempt in range(RESERVE_RETRIES):
+        read_products()
+        remaining = {}
+        sales = []
+        for order in orders:
+            try:
+                sales.append(build_sale(order, remaining))
+            except Exception as e:
+                # Only this order is rejected; build_sale() leaves remaining untouched
+                sales.append(([], [], [], [f"Could not process order: {e}"]))
+        changes = [change for _, _, order_changes, errors in sales if not errors for change in order_changes]
+        try:
+            catalog.reserve_many(changes)
+            break
+        except (StockConflict, StorageBusy):
+            continue
+    else:
+        return [{'order_id': order.get('order_id'), 'status': "rejected",
+                 'errors': ["Stock kept changing on other terminals; try again"]} for order in orders]
 
-ITEMS:{items_detail}
+    results = []
+    for order, (items, free_items, _, errors) in zip(orders, sales):
+        result = {'order_id': order.get('order_id'), 'customer': order.get('customer')}
+        if errors:
+            result.update(status="rejected", errors=errors)
+        else:
+            result.update(status="ok", total=round(sale_total(items), 2),
+                          units=sum(item['quantity'] for item in items),
+                          free_units=sum(item['quantity'] for item in free_items))
+            try:
+                result['invoice'] = create_sales_invoice(str(order['customer']).strip(), items, free_items)
+            except Exception as e:
+                # The stock is already sold, so the order still succeeds
+                result['invoice_error'] = str(e)
+        results.append(result)
+    return results
 
-{'='*60}
-Total Amount: NPR {total_amount:,.2f}
-{'='*60}
+def run_batch(source, fmt=None, results_path=None):
+    """Process an order file and write one JSON result line per order"""
+    read_products()
+    catalog.watch_low_stock()
+    results = process_orders(load_orders(source, fmt))
+    invoice_writer.flush()
+    out = sys.stdout if results_path in (None, "-") else open(results_path, "w")
+    try:
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    accepted = sum(1 for result in results if result['status'] == "ok")
+    print(f"✓ {accepted} of {len(results)} orders processed", file=sys.stderr)
+    report_low_stock(sys.stderr)
+    return 0 if accepted == len(results) else 2
 
-Thank you for shopping with WeCare Beauty!
-Buy 3 Get 1 Free on all products!
-"""
-    filepath = f"Sales Invoice/{invoice_no}.txt"
-    with open(filepath, "w") as file:
-        file.write(invoice)
-    return filepath
+def load_manifest(source, fmt=None):
+    """Yield (line number, line) from a supplier manifest, or stdin when source is '-'
 
-def sell_products():
-    """Handle product sales"""
-    items = []
-    free_items = []
-    
-    # Get customer name with validation
-    while True:
-        customer_name = input("Enter customer name: ").strip()
-        if not customer_name:
-            print("Customer name cannot be empty!")
+    JSONL: {"id": 5, "quantity": 100} to restock a known product, or
+    {"name": ..., "brand": ..., "quantity": ..., "price": ..., "origin": ...}
+    to match by name and brand, adding the product if it is new.
+    CSV: id,name,brand,quantity,price,origin with a header row; leave id
+    empty to match by name and brand.
+    """
+    if fmt is None:
+        fmt = "csv" if source.lower().endswith(".csv") else "jsonl"
+    file = sys.stdin if source == "-" else open(source, "r", newline="")
+    try:
+        if fmt == "jsonl":
+            for line_no, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    line = json.loads(line)
+                except ValueError as e:
+                    line = {'error': f"Invalid JSON: {e}"}
+                yield line_no, line if isinstance(line, dict) else {'error': "Expected a JSON object"}
+            return
+        reader = csv.DictReader(file)
+        for row in reader:
+            if any(row.values()):
+                yield reader.line_num, row
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+def plan_restock(lines):
+    """Validate manifest lines like restock_products() does and match them to products
+
+    Lines with an id restock that product; otherwise name and brand are
+    matched case-insensitively and unknown products get provisional
+    sequential IDs from next_id(); commit() replaces them with the final
+    ones. Price and origin are only read for new products.
+    Returns (shipment, new_products, errors) where shipment maps product
+    ID to the quantity received, in manifest order.
+    """
+    shipment = {}
+    new_products = {}
+    errors = []
+    next_id = catalog.next_id()
+    lines = list(lines)
+    named = catalog.match_names({(str(line.get('name') or "").strip().lower(),
+                                  str(line.get('brand') or "").strip().lower())
+                                 for _, line in lines if line.get('id', line.get('product_id')) in (None, "")})
+
+    for line_no, line in lines:
+        if line.get('error'):
+            errors.append(f"Line {line_no}: {line['error']}")
             continue
-        if any(char.isdigit() for char in customer_name):
-            print("Customer name should not contain numbers!")
+        quantity, error = parse_quantity(line.get('quantity'), MAX_RESTOCK_QUANTITY)
+        if error:
+            errors.append(f"Line {line_no}: {error}")
             continue
-        break
-    
-    products = read_products()
-    if not products:
-        print("No products available for sale!")
-        return
-    
-    while True:
-        try:
-            display_products()
-            product_id = input("\nEnter product ID: ").strip()
-            
-            if not product_id:
-                print("Product ID cannot be empty!")
-                continue
-                
+        product_id = line.get('id', line.get('product_id'))
+        name = str(line.get('name') or "").strip()
+        brand = str(line.get('brand') or "").strip()
+        if product_id not in (None, ""):
             try:
                 product_id = int(product_id)
-            except ValueError:
-                print("Product ID must be a number!")
-                continue
-                
-            product = next((p for p in products if p['id'] == product_id), None)
-            if not product:
-                print(f"Product with ID {product_id} not found!")
-                continue
-            
-            quantity = input("Enter quantity: ").strip()
-            if not quantity:
-                print("Quantity cannot be empty!")
-                continue
-                
-            try:
-                quantity = int(quantity)
-            except ValueError:
-                print("Quantity must be a number!")
-                continue
-                
-            if quantity <= 0:
-                print("Quantity must be positive!")
+            except (TypeError, ValueError, OverflowError):
+                errors.append(f"Line {line_no}: Product ID must be a number!")
                 continue
-            
-            if quantity > 1000:  # Add reasonable limits
-                print("Quantity exceeds maximum limit of 1000!")
+            if product_id not in new_products and not catalog.get(product_id):
+                errors.append(f"Line {line_no}: Product with ID {product_id} not found!")
                 continue
-                
-            if product['quantity'] < quantity:
-                print(f"Insufficient stock! Available: {product['quantity']}")
+        elif not name or not brand:
+            errors.append(f"Line {line_no}: Give a product ID, or a product name and brand!")
+            continue
+        else:
+            product_id = named.get((name.lower(), brand.lower()))
+        if product_id is None:
+            price, error = parse_price(line.get('price'))
+            origin = str(line.get('origin') or "").strip()
+            if not error and not origin:
+                error = "Origin cannot be empty!"
+            if not error and any(char.isdigit() for char in origin):
+                error = "Origin should not contain numbers!"
+            if error:
+                errors.append(f"Line {line_no}: New product {name} ({brand}): {error}")
                 continue
-            
-            # Add main purchase
-            product['quantity'] -= quantity
-            items.append({
-                'name': product['name'],
-                'brand': product['brand'],
-                'quantity': quantity,
-                'price': product['price'],
-                'free_earned': quantity // 3
-            })
-            
-            # Handle free items
-            free_quantity = quantity // 3
-            if free_quantity > 0:
-                while True:
-                    choice = input(f"\nYou've earned {free_quantity} free items! Choose an option:\n"
-                                 "1. Select different products as free items\n"
-                                 "2. Get discount instead\n"
-                                 "Enter choice (1/2): ").strip()
-                    
-                    if not choice:
-                        print("Choice cannot be empty!")
-                        continue
-                        
-                    if choice not in ['1', '2']:
-                        print("Invalid choice! Please enter 1 or 2.")
-                        continue
-                    
-                    if choice == '1':
-                        # Free item selection with validation
-                        remaining_free = free_quantity
-                        while remaining_free > 0:
-                            try:
-                                free_id = input(f"\nEnter product ID for free item ({remaining_free} remaining) or '0' for discount: ").strip()
-                                
-                                if not free_id:
-                                    print("Product ID cannot be empty!")
-                                    continue
-                                    
-                                if free_id == '0':
-                                    remaining_discount = (remaining_free * product['price'] * 3) * 0.5
-                                    items[-1]['discount'] = items[-1].get('discount', 0) + remaining_discount
-                                    print(f"Applying discount of NPR {remaining_discount:,.2f}")
-                                    break
-                                
-                                try:
-                                    free_id = int(free_id)
-                                except ValueError:
-                                    print("Product ID must be a number!")
-                                    continue
-                                
-                                free_product = next((p for p in products if p['id'] == free_id), None)
-                                if not free_product:
-                                    print(f"Product with ID {free_id} not found!")
-                                    continue
-                                
-                                if free_product['price'] > product['price']:
-                                    print("Selected product exceeds price limit for free items!")
-                                    continue
-                                
-                                free_qty = input(f"Enter quantity for free item (max {remaining_free}): ").strip()
-                                if not free_qty:
-                                    print("Quantity cannot be empty!")
-                                    continue
-                                
-                                try:
-                                    free_qty = int(free_qty)
-                                except ValueError:
-                                    print("Quantity must be a number!")
-                                    continue
-                                
-                                if free_qty <= 0 or free_qty > remaining_free:
-                                    print(f"Invalid quantity! You can select up to {remaining_free} free items.")
-                                    continue
-                                
-                                if free_qty > free_product['quantity']:
-                                    print(f"Insufficient stock for free item! Available: {free_product['quantity']}")
-                                    continue
-                                
-                                free_product['quantity'] -= free_qty
-                                free_items.append({
-                                    'name': free_product['name'],
-                                    'brand': free_product['brand'],
-                                    'quantity': free_qty,
-                                    'price': free_product['price']
-                                })
-                                remaining_free -= free_qty
-                                
-                            except Exception as e:
-                                print(f"An error occurred: {str(e)}")
-                                continue
-                        
-                    elif choice == '2':
-                        discount = (free_quantity * product['price'] * 3) * 0.5
-                        items[-1]['discount'] = discount
-                        break
-            
-            # Ask for more purchases
-            while True:
-                more = input("\nWould you like to purchase more items? (yes/no): ").strip().lower()
-                if not more:
-                    print("Input cannot be empty!")
-                    continue
-                if more not in ['yes', 'no']:
-                    print("Please enter 'yes' or 'no'")
-                    continue
-                break
-            
-            if more == 'no':
-                break
-                
-        except Exception as e:
-            print(f"An error occurred: {str(e)}")
-            print("Please try again.")
+            product_id = next_id
+            next_id += 1
+            named[(name.lower(), brand.lower())] = product_id
+            new_products[product_id] = {'id': product_id, 'name': name, 'brand': brand,
+                                        'quantity': 0, 'price': price, 'origin': origin}
+        shipment[product_id] = shipment.get(product_id, 0) + quantity
+    return shipment, new_products, errors
+
+def receive_shipment(supplier_name, lines, skip_invalid=False):
+    """Receive a whole supplier shipment with one commit and one purchase invoice
+
+    Nothing is imported if any line is invalid, unless skip_invalid is set.
+    Returns a result dictionary like process_orders() does.
+    """
+    supplier_name = str(supplier_name or "").strip()
+    result = {'supplier': supplier_name}
+    error = customer_name_error(supplier_name, "Supplier")
+    if error:
+        result.update(status="rejected", errors=[error])
+        return result
+    if not read_products():
+        result.update(status="rejected", errors=["No products database found!"])
+        return result
+    shipment, new_products, errors = plan_restock(lines)
+    if errors:
+        result['errors'] = errors
+        if not skip_invalid:
+            result['status'] = "rejected"
+            return result
+    if not shipment:
+        result.update(status="rejected", errors=errors or ["No products to restock!"])
+        return result
+
+    items = []
+    added = []
+    for product_id, quantity in shipment.items():
+        if product_id in new_products:
+            # The record gets its final ID when the stock changes are committed
+            product = catalog.add(dict(new_products[product_id], quantity=quantity))
+            added.append(product)
+            items.append(product)
             continue
-    
-    if items:
+        product = catalog.get(product_id)
+        catalog.adjust_stock(product, quantity, 'restock')
+        items.append({
+            'id': product_id,
+            'name': product['name'],
+            'brand': product['brand'],
+            'origin': product['origin'],
+            'quantity': quantity,
+            'price': product['price']
+        })
+    if not commit_stock_changes():
+        result.update(status="rejected", errors=["Error saving stock changes"])
+        return result
+    result.update(status="ok", restocked=len(shipment) - len(new_products), added=len(new_products),
+                  units=sum(shipment.values()), new_ids=[product['id'] for product in added])
+    try:
+        result['invoice'] = create_purchase_invoice(supplier_name, items)
+    except OSError as e:
+        result['invoice_error'] = str(e)
+    return result
+
+def import_manifest(source, supplier_name, fmt=None, skip_invalid=False):
+    """Import a supplier manifest file and print what was received"""
+    result = receive_shipment(supplier_name, load_manifest(source, fmt), skip_invalid)
+    invoice_writer.flush()
+    for error in result.get('errors', ()):
+        print(error, file=sys.stderr)
+    if result['status'] != "ok":
+        print("Nothing imported!")
+        return 2
+    print(f"✓ Restocked {result['restocked']} products and added {result['added']} new products "
+          f"({result['units']:,} units)")
+    if 'invoice' in result:
+        print(f"✓ Restock invoice created successfully: {result['invoice']}")
+    else:
+        print(f"Error saving transaction: {result['invoice_error']}")
+    return 2 if result.get('errors') else 0
+
+def query_invoices(args):
+    """Print one archived invoice, or every invoice matching the filters"""
+    if args.import_loose:
+        print(f"✓ Archived {invoice_archive.import_loose_invoices()} loose invoice files")
+    if args.invoice_no:
+        text = invoice_archive.get(args.invoice_no)
+        if text is None:
+            print(f"Invoice {args.invoice_no} not found!")
+            return 1
+        print(text)
+        return 0
+    if not (args.party or args.date or args.kind):
+        if args.import_loose:
+            return 0
+        print("Give an invoice number or at least one of --party, --date, --kind")
+        return 2
+    entries = invoice_archive.find(args.party, args.date, args.kind)
+    if not entries:
+        print("No matching invoices found!")
+        return 1
+    if args.list:
+        print("{:<32} {:<8} {:<20} {:<25}".format('Invoice No', 'Kind', 'Date', 'Customer/Supplier'))
+        print("-" * 90)
+        for entry in entries:
+            print("{:<32} {:<8} {:<20} {:<25}".format(
+                entry['invoice_no'], entry['kind'], entry['created'], entry['party']))
+    else:
+        sys.stdout.write("".join(invoice_archive.read(entry) for entry in entries))
+    return 0
+
+REPORT_DIMENSIONS = ("product", "brand", "origin", "day", "customer")
+REPORT_METRICS = ("units", "revenue", "discount", "cost", "free_units", "free_cost",
+                  "restock_units", "restock_cost")
+REPORT_SORTS = ("units", "revenue", "margin", "free_cost", "discount")
+
+def report_chunks(paths, chunk_bytes=REPORT_CHUNK_BYTES):
+    """Split transaction files into (path, start, end) byte ranges"""
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_bytes):
+            chunks.append((path, start, min(start + chunk_bytes, size)))
+    return chunks
+
+def read_chunk(path, start, end):
+    """Return the lines that start inside [start, end) of a transaction file"""
+    with open(path, "rb") as file:
+        if start:
+            # A line belongs to the chunk its first byte falls in
+            file.seek(start - 1)
+            if file.read(1) != b"\n":
+                file.readline()
+        position = file.tell()
+        if position >= end:
+            return ""
+        data = file.read(end - position)
+        if not data.endswith(b"\n"):
+            data += file.readline()
+    return data.decode()
+
+def strip_transaction_headers(text):
+    """Remove the header lines, current or old, that start each day file"""
+    for fields in (TRANSACTION_FIELDS, TRANSACTION_FIELDS[:LEGACY_TRANSACTION_WIDTH]):
+        text = text.replace(",".join(fields) + "\n", "")
+    return text
+
+def is_transaction_row(row):
+    """Whether a parsed CSV row is a well-formed transaction record, old or new"""
+    if len(row) not in (len(TRANSACTION_FIELDS), LEGACY_TRANSACTION_WIDTH):
+        return False
+    try:
+        for value in row[9:]:
+            float(value)
+    except ValueError:
+        return False
+    return True
+
+def upgrade_transaction_row(row):
+    """Return row with every TRANSACTION_FIELDS column
+
+    Rows from before free_earned was recorded get it from the current rules.
+    """
+    if len(row) != LEGACY_TRANSACTION_WIDTH:
+        return row
+    return list(row) + [str(pricing.free_units(int(float(row[9]))) if row[8] == "sale" else 0)]
+
+def transaction_columns(text):
+    """Split transaction lines into TRANSACTION_FIELDS columns, amounts as floats
+
+    When no field is quoted and every line has the same number of fields,
+    the whole text is split at once and sliced into columns, as
+    parse_product_text() does. Otherwise the csv module parses it and
+    malformed rows are dropped. Old rows get free_earned as in
+    upgrade_transaction_row().
+    """
+    if text.endswith("\n"):
+        text = text[:-1]
+    commas = set(map(COUNT_COMMAS, text.split("\n"))) if '"' not in text else ()
+    if len(commas) == 1 and commas <= {len(TRANSACTION_FIELDS) - 1, LEGACY_TRANSACTION_WIDTH - 1}:
+        width = commas.pop() + 1
+        fields = text.replace("\n", ",").split(",")
+        columns = [fields[k::width] for k in range(width)]
         try:
-            save_products(products)
-            filepath = create_sales_invoice(customer_name, items, free_items)
-            print(f"\n✓ Sales invoice created successfully: {filepath}")
+            columns[9:] = [list(map(float, column)) for column in columns[9:]]
+        except ValueError:
+            pass
+        else:
+            if width == LEGACY_TRANSACTION_WIDTH:
+                columns.append([float(pricing.free_units(int(quantity))) if line == "sale" else 0.0
+                                for line, quantity in zip(columns[8], columns[9])])
+            return columns
+    rows = [upgrade_transaction_row(row) for row in csv.reader(io.StringIO(text)) if is_transaction_row(row)]
+    columns = [list(column) for column in zip(*rows)] or [[] for _ in TRANSACTION_FIELDS]
+    columns[9:] = [list(map(float, column)) for column in columns[9:]]
+    return columns
+
+def aggregate_chunk(task):
+    """Sum REPORT_METRICS per group for one chunk; runs in a worker process
+
+    Every row is mapped to its group with one map() over the key columns
+    joined into strings; a group's slot is the index of its first row. The
+    only per-row Python loops add each amount column into those slots, and
+    the slots are folded into groups at the end, once per group and line
+    kind. Products are keyed as "id\nname\nbrand" until the final results.
+    """
+    path, start, end, dimension = task
+    text = strip_transaction_headers(read_chunk(path, start, end))
+    (created, _, kinds, parties, product_ids, names, brands, origins, lines,
+     quantities, costs, prices, discounts, _) = transaction_columns(text)
+    # Transaction fields never contain newlines, so joined keys cannot collide
+    if dimension == "product":
+        keys = list(map("\n".join, zip(product_ids, names, brands)))
+    elif dimension == "brand":
+        keys = brands
+    elif dimension == "origin":
+        keys = origins
+    elif dimension == "day":
+        keys = list(map(operator.itemgetter(slice(0, 10)), created))
+    else:
+        keys = parties
+    first = {}
+    grouping = zip(lines, kinds, keys) if dimension == "customer" else zip(lines, keys)
+    slots = list(map(first.setdefault, map("\n".join, grouping), itertools.count()))
+    sums = []
+    # One tight loop per column beats a single loop adding four columns
+    for values in (quantities, map(operator.mul, quantities, costs),
+                   map(operator.sub, map(operator.mul, quantities, prices), discounts), discounts):
+        totals = [0.0] * len(slots)
+        for slot, value in zip(slots, values):
+            totals[slot] += value
+        sums.append(totals)
+    units, amounts, revenues, discounted = sums
+
+    groups = {}
+    for i in first.values():
+        if dimension == "customer" and kinds[i] != "sale":
+            continue  # suppliers are not customers
+        key = keys[i]
+        totals = groups.get(key)
+        if totals is None:
+            totals = groups[key] = [0.0] * len(REPORT_METRICS)
+        line = lines[i]
+        if line == "sale":
+            totals[0] += units[i]
+            totals[1] += revenues[i]
+            totals[2] += discounted[i]
+            totals[3] += amounts[i]
+        elif line == "free":
+            totals[4] += units[i]
+            totals[5] += amounts[i]
+        elif line == "restock":
+            totals[6] += units[i]
+            totals[7] += amounts[i]
+    return groups
+
+def aggregate_transactions(dimension, since=None, until=None, workers=None, log=None):
+    """Aggregate the transaction log by dimension across worker processes
+
+    Files are streamed in REPORT_CHUNK_BYTES pieces, so memory depends on
+    the number of groups rather than the size of the history. Returns a
+    list of dictionaries with the group, every metric and the margin
+    (revenue minus the cost of sold and given-away units).
+
+    Each worker handles roughly 60k line items a second by product and
+    120-130k by other dimensions, so ten million lines take about a minute
+    or more per core; only more cores bring that down to seconds.
+    """
+    log = log or transaction_log
+    tasks = [chunk + (dimension,) for chunk in report_chunks(log.files(since, until))]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    totals = {}
+
+    def merge(groups):
+        for key, values in groups.items():
+            current = totals.get(key)
+            if current is None:
+                totals[key] = values
+            else:
+                current[:] = map(operator.add, current, values)
+
+    if workers <= 1:
+        for task in tasks:
+            merge(aggregate_chunk(task))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for groups in pool.imap_unordered(aggregate_chunk, tasks):
+                merge(groups)
+
+    results = []
+    for key, values in totals.items():
+        result = dict(zip(REPORT_METRICS, values))
+        if dimension == "product":
+            result['id'], result['name'], result['brand'] = key.split("\n")
+        else:
+            result[dimension] = key
+        result['margin'] = result['revenue'] - result['cost'] - result['free_cost']
+        results.append(result)
+    return results
+
+def sales_report(args):
+    """Print the transaction log aggregated by one dimension"""
+    results = aggregate_transactions(args.by, args.since, args.until, args.workers)
+    if not results:
+        print("No transactions found!")
+        return 1
+    results.sort(key=lambda result: result[args.sort], reverse=True)
+    shown = results[:args.top] if args.top else results
+    label = "Product" if args.by == "product" else args.by.capitalize()
+    out = [
+        "{:<40} {:>10} {:>16} {:>14} {:>16} {:>10} {:>14}".format(
+            label, 'Units', 'Revenue (NPR)', 'Discount', 'Margin (NPR)', 'Free', 'Free cost'),
+        "-" * 126,
+    ]
+    for result in shown:
+        name = (f"{result['id']} {result['name']} ({result['brand']})" if args.by == "product"
+                else result[args.by])
+        out.append("{:<40} {:>10,.0f} {:>16,.2f} {:>14,.2f} {:>16,.2f} {:>10,.0f} {:>14,.2f}".format(
+            name[:40], result['units'], result['revenue'], result['discount'],
+            result['margin'], result['free_units'], result['free_cost']))
+    out.append("-" * 126)
+    out.append("{:<40} {:>10,.0f} {:>16,.2f} {:>14,.2f} {:>16,.2f} {:>10,.0f} {:>14,.2f}".format(
+        f"Total ({len(results)} groups)",
+        *(sum(result[metric] for result in results)
+          for metric in ('units', 'revenue', 'discount', 'margin', 'free_units', 'free_cost'))))
+    sys.stdout.write("\n".join(out) + "\n")
+    return 0
+
+# Columnar line-item export: magic, row groups, then a JSON footer, its length and the magic
+# again. Each row group holds every column for a run of rows, written by one worker; string
+# columns are dictionary encoded within the group ('I' codes, then PackedStrings offsets and
+# data), numbers are plain arrays. Every block starts 8-byte aligned.
+LINES_MAGIC = b"WCLC"
+LINES_FOOTER = struct.Struct("<Q4s")
+LINE_COLUMN_TYPES = ('S',) * 9 + ('q', 'd', 'd', 'd', 'q')
+
+def invoice_key(line):
+    """Invoice number field of a raw transaction line, as a one-item list"""
+    return line.split(b",", 2)[1:2]
+
+def read_invoice_chunk(path, start, end):
+    """Return the lines of the invoices whose first line starts inside [start, end)
+
+    All rows of an invoice are contiguous (TransactionLog writes them in one
+    append), so an invoice crossing the end is finished here and its tail is
+    skipped by the next chunk.
+    """
+    with open(path, "rb") as file:
+        previous = None
+        if start:
+            # Read the last line starting before the chunk; that also leaves the
+            # file at the chunk's first line
+            back = start
+            while back:
+                back = max(0, back - 4096)
+                file.seek(back)
+                cut = file.read(start - back).rfind(b"\n", 0, start - back - 1)
+                if cut >= 0 or back == 0:
+                    break
+            file.seek(back + cut + 1)
+            previous = invoice_key(file.readline())
+        position = file.tell()
+        if position >= end:
+            return ""
+        data = file.read(end - position)
+        if not data.endswith(b"\n"):
+            data += file.readline()
+        lines = data.splitlines(keepends=True)
+        last = invoice_key(lines[-1])
+        for line in iter(file.readline, b""):
+            if invoice_key(line) != last:
+                break
+            lines.append(line)
+    skip = 0
+    while skip < len(lines) and invoice_key(lines[skip]) == previous:
+        skip += 1
+    return b"".join(lines[skip:]).decode()
+
+def encode_row_group(rows):
+    """Encode rows as one row group of the columnar export; returns (data, column layout)"""
+    blocks, layout, position = [], [], 0
+    for column, kind in zip(zip(*rows), LINE_COLUMN_TYPES):
+        if kind == 'S':
+            dictionary = {}
+            codes = array('I', [dictionary.setdefault(value, len(dictionary)) for value in column])
+            offsets, strings = pack_strings(dictionary)
+            parts = (pad8(codes.tobytes()), offsets, pad8(strings))
+            layout.append({'offset': position, 'size': len(dictionary), 'bytes': len(strings)})
+        else:
+            values = map(int, map(float, column)) if kind == 'q' else map(float, column)
+            parts = (array(kind, values).tobytes(),)
+            layout.append({'offset': position})
+        blocks.extend(parts)
+        position += sum(map(len, parts))
+    return b"".join(blocks), layout
+
+def close_day_chunk(task):
+    """Render, compress and export the invoices of one chunk; runs in a worker process
+
+    Returns (invoices, entries, csv text, row group, layout, rows): invoices
+    is one gzip member per invoice back to back, located by entries.
+    """
+    path, start, end = task
+    pricing.refresh()  # footers follow the rules file, however the worker was started
+    text = strip_transaction_headers(read_invoice_chunk(path, start, end))
+    parsed = list(csv.reader(io.StringIO(text)))
+    rows = [upgrade_transaction_row(row) for row in parsed if is_transaction_row(row)]
+    if len(rows) != len(parsed) or any(len(row) == LEGACY_TRANSACTION_WIDTH for row in parsed):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        text = buffer.getvalue()
+    members, entries, offset = [], [], 0
+    for invoice_no, group in itertools.groupby(rows, operator.itemgetter(1)):
+        group = list(group)
+        member = gzip.compress(render_records(group).encode(), mtime=0)
+        members.append(member)
+        created, _, kind, party = group[0][:4]
+        entries.append((invoice_no, kind, party, created, offset, len(member)))
+        offset += len(member)
+    data, layout = encode_row_group(rows) if rows else (b"", [])
+    return b"".join(members), entries, text, data, layout, len(rows)
+
+@timed("close_day")
+def close_day(day, export_dir=EXPORT_DIR, formats=EXPORT_FORMATS, rearchive=False, workers=None,
+              log=None, archive=None):
+    """Re-render a day's invoices and export its line items across worker processes
+
+    Writes <day>-invoices.gz with every invoice of the day (one gzip member
+    each, so zcat prints them all) and the line items as <day>-lines.csv
+    and/or the columnar <day>-lines.wcc. Workers get EOD_CHUNK_BYTES ranges
+    of the day's transaction file and do the parsing, rendering and
+    compression; this process only appends their output in order. With
+    rearchive the re-rendered invoices also replace the archived copies.
+    Returns (invoices, lines, paths written), or None if the day has no file.
+    """
+    log = log or transaction_log
+    archive = archive or invoice_archive
+    path = log.path(day)
+    if not os.path.exists(path):
+        return None
+    tasks = report_chunks([path], EOD_CHUNK_BYTES)
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    targets = {"invoices": f"{day}-invoices.gz"}
+    if "csv" in formats:
+        targets["csv"] = f"{day}-lines.csv"
+    if "columnar" in formats:
+        targets["columnar"] = f"{day}-lines.wcc"
+    os.makedirs(export_dir, exist_ok=True)
+    outputs = {}
+    for key, name in targets.items():
+        fd, temp_path = tempfile.mkstemp(dir=export_dir, prefix=name + ".", suffix=".tmp")
+        outputs[key] = (os.path.join(export_dir, name), temp_path, os.fdopen(fd, "wb", EXPORT_BUFFER))
+    invoices = lines = 0
+    row_groups = []
+    position = len(LINES_MAGIC)
+
+    def write(result):
+        nonlocal invoices, lines, position
+        members, entries, text, data, layout, rows = result
+        outputs["invoices"][2].write(members)
+        if "csv" in outputs:
+            outputs["csv"][2].write(text.encode())
+        if "columnar" in outputs and rows:
+            outputs["columnar"][2].write(data)
+            row_groups.append({'offset': position, 'rows': rows, 'columns': layout})
+            position += len(data)
+        if rearchive and entries:
+            archive.store_batch(day, entries, members)
+        invoices += len(entries)
+        lines += rows
+
+    try:
+        if "csv" in outputs:
+            outputs["csv"][2].write((",".join(TRANSACTION_FIELDS) + "\n").encode())
+        if "columnar" in outputs:
+            outputs["columnar"][2].write(LINES_MAGIC)
+        if workers <= 1:
+            for task in tasks:
+                write(close_day_chunk(task))
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                for result in pool.imap(close_day_chunk, tasks):
+                    write(result)
+        if "columnar" in outputs:
+            footer = json.dumps({'version': 1, 'byte_order': sys.byteorder, 'rows': lines,
+                                 'columns': TRANSACTION_FIELDS, 'types': LINE_COLUMN_TYPES,
+                                 'row_groups': row_groups}).encode()
+            outputs["columnar"][2].write(footer + LINES_FOOTER.pack(len(footer), LINES_MAGIC))
+        for target, temp_path, file in outputs.values():
+            file.flush()
+            os.fsync(file.fileno())
+            metrics.add("bytes_written_total", file.tell(), file="end_of_day")
+            file.close()
+            os.chmod(temp_path, file_mode(target))
+            replace_file(temp_path, target)
+    except BaseException:
+        for target, temp_path, file in outputs.values():
+            file.close()
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        raise
+    return invoices, lines, [target for target, _, _ in outputs.values()]
+
+def read_line_columns(path):
+    """Load a columnar line-item export as {column: list of values}"""
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < len(LINES_MAGIC) + LINES_FOOTER.size or data[:len(LINES_MAGIC)] != LINES_MAGIC:
+        raise ValueError(f"{path} is not a columnar line-item export")
+    length, magic = LINES_FOOTER.unpack_from(data, len(data) - LINES_FOOTER.size)
+    footer = json.loads(data[len(data) - LINES_FOOTER.size - length:len(data) - LINES_FOOTER.size])
+    if magic != LINES_MAGIC or footer['byte_order'] != sys.byteorder:
+        raise ValueError(f"{path} is not a columnar line-item export for this machine")
+    view = memoryview(data)
+    columns = {name: [] for name in footer['columns']}
+    for group in footer['row_groups']:
+        rows = group['rows']
+        for name, kind, column in zip(footer['columns'], footer['types'], group['columns']):
+            start = group['offset'] + column['offset']
+            if kind == 'S':
+                codes = view[start:start + rows * 4].cast('I')
+                start += rows * 4 + (-rows * 4) % 8
+                size = (column['size'] + 1) * 8
+                values = list(PackedStrings(view[start:start + size].cast('Q'),
+                                            view[start + size:start + size + column['bytes']]))
+                columns[name].extend(map(values.__getitem__, codes))
+            else:
+                columns[name].extend(view[start:start + rows * 8].cast(kind))
+    return columns
+
+def end_of_day(args):
+    """Re-render and export one day's invoices and line items"""
+    day = args.date or datetime.now().strftime('%Y-%m-%d')
+    try:
+        datetime.strptime(day, '%Y-%m-%d')
+    except ValueError:
+        print("Date must be YYYY-MM-DD!")
+        return 2
+    invoice_writer.flush()
+    pricing.refresh()
+    start = time.perf_counter()
+    result = close_day(day, args.export_dir, args.format or EXPORT_FORMATS, args.rearchive, args.workers)
+    if result is None:
+        print(f"No transactions found for {day}!")
+        return 1
+    invoices, lines, paths = result
+    elapsed = time.perf_counter() - start
+    print(f"✓ Rendered {invoices:,} invoices ({lines:,} line items) for {day} in {elapsed:.2f}s")
+    for path in paths:
+        print(f"  {path}")
+    return 0
+
+def event_seq(line):
+    """Sequence number of an event line"""
+    return int(line.split(",", 1)[0])
+
+def parse_event(line):
+    """Parse an event line into (seq, StockChange); the change is None if unusable"""
+    seq, entry = line.split(",", 1)
+    if entry.strip() == "snapshot":
+        return int(seq), StockChange('snapshot', 0, 0, None)
+    return int(seq), parse_ledger_entry(entry)
+
+def parse_snapshot(text):
+    """Split a store snapshot into (store, seq, ProductStore); raises ValueError if malformed"""
+    header, _, body = text.partition("\n")
+    kind, store, seq = header.split(",")
+    if kind != "snapshot":
+        raise ValueError("not a store snapshot")
+    products = ProductStore()
+    if body.strip():
+        products.extend(parse_product_text(body, 2))
+    return store, int(seq), products
+
+class EventLog:
+    """This store's stock changes as an ordered log other stores can replay
+
+    Every committed change is appended to <store>.events in the replication
+    directory as "seq,<ledger entry>". The log's lock is held across the
+    storage commit and the append, so sequence numbers follow commit order
+    across all of the store's terminals. Every snapshot_every events the
+    store's whole stock is written to <store>.snapshot with the sequence
+    number it covers, and events older than the previous snapshot are
+    dropped; a new node loads the snapshot and replays what came after. A
+    change committed but never logged (a crash in between) is put right by
+    the next snapshot; the first event is preceded by one. Without a store
+    name nothing is published.
+    """
+
+    def __init__(self, store=STORE_NAME, directory=REPLICATION_DIR, snapshot_every=SNAPSHOT_EVERY):
+        if store and not STORE_NAME_PATTERN.fullmatch(store):
+            print(f"Store name {store!r} may only use letters, digits, '.', '-' and '_'; not publishing")
+            store = ""
+        self.store = store
+        self.enabled = bool(store)
+        self.directory = directory
+        self.path = os.path.join(directory, f"{store}.events")
+        self.snapshot_path = os.path.join(directory, f"{store}.snapshot")
+        self.snapshot_every = snapshot_every
+        self._file_lock = InterProcessLock(self.path + LOCK_SUFFIX)
+        self._tail = None  # (inode, size, last seq) of the events file
+        self._snapshotter = None
+
+    @contextlib.contextmanager
+    def publishing(self, changes, storage):
+        """Hold the log across a storage commit and append changes if it succeeds"""
+        if not self.enabled or not changes:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._file_lock:
+            if not os.path.exists(self.snapshot_path) and self.last_seq() == 0:
+                self.write_snapshot(storage)  # the stock the first events apply to
+            yield
+            first = self.last_seq() + 1
+            self._append("".join(f"{seq},{format_ledger_entry(change)}"
+                                 for seq, change in enumerate(changes, first)), first + len(changes) - 1)
+        if (first - 1) // self.snapshot_every != (first + len(changes) - 1) // self.snapshot_every:
+            self.snapshot_in_background(storage)
+
+    def _append(self, text, seq):
+        data = text.encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            stat = os.fstat(fd)
+        finally:
+            os.close(fd)
+        self._tail = (stat.st_ino, stat.st_size, seq)
+        metrics.add("bytes_written_total", len(data), file="events")
+
+    def snapshot_seq(self):
+        """Sequence number covered by the current snapshot, or 0 without one"""
+        try:
+            with open(self.snapshot_path, "r") as file:
+                return int(file.readline().rsplit(",", 1)[1])
+        except (FileNotFoundError, IndexError, ValueError):
+            return 0
+
+    def last_seq(self):
+        """Sequence number of the newest event; call with the log locked"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self.snapshot_seq()
+        if self._tail is not None and self._tail[:2] == (stat.st_ino, stat.st_size):
+            return self._tail[2]
+        with open(self.path, "rb") as file:
+            file.seek(max(0, stat.st_size - 4096))
+            lines = file.read().split(b"\n")[:-1]
+        seq = int(lines[-1].split(b",", 1)[0]) if lines else self.snapshot_seq()
+        self._tail = (stat.st_ino, stat.st_size, seq)
+        return seq
+
+    def write_snapshot(self, storage, marker=False):
+        """Snapshot the store's stock at the current sequence number and return that number
+
+        The stock is read through a fresh storage object, so the catalog in
+        use is not disturbed. With marker a 'snapshot' event is logged
+        first, telling replicas that are already up to date to reload.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._file_lock:
+            seq = self.last_seq()
+            if marker:
+                seq += 1
+                self._append(f"{seq},snapshot\n", seq)
+            copy = type(storage)(storage.path)
+            try:
+                products = copy.load()
+            finally:
+                if isinstance(copy, SQLiteStorage):
+                    copy.close()
+        temp_path = write_temp_file(self.snapshot_path,
+                                    f"snapshot,{self.store},{seq}\n".encode() + products_file_data(products))
+        with self._file_lock:
+            previous = self.snapshot_seq()
+            if previous >= seq and os.path.exists(self.snapshot_path) and not marker:
+                os.unlink(temp_path)
+                return previous
+            replace_file(temp_path, self.snapshot_path)
+            self._compact(previous)
+        return seq
+
+    def _compact(self, cutoff):
+        """Drop the events up to cutoff; call with the log locked"""
+        try:
+            with open(self.path, "rb") as file:
+                lines = file.read().splitlines(keepends=True)
+        except FileNotFoundError:
+            return
+        keep = next((n for n, line in enumerate(lines) if int(line.split(b",", 1)[0]) > cutoff), len(lines))
+        if keep:
+            atomic_write(self.path, b"".join(lines[keep:]))
+            self._tail = None
+
+    def snapshot_in_background(self, storage):
+        """Start write_snapshot() on a thread unless one is already running"""
+        if self._snapshotter is not None and self._snapshotter.is_alive():
+            return
+        self._snapshotter = threading.Thread(target=self._snapshot_quietly, args=(storage,),
+                                             name="store-snapshot", daemon=True)
+        self._snapshotter.start()
+
+    def _snapshot_quietly(self, storage):
+        try:
+            self.write_snapshot(storage)
         except Exception as e:
-            print(f"Error saving transaction: {str(e)}")
+            print(f"Error writing store snapshot: {e}")
+
+    def wait_for_snapshot(self):
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+
+events = EventLog()
+atexit.register(events.wait_for_snapshot)
+
+class FileTransport:
+    """Store event logs and snapshots read from a shared directory
+
+    The directory may be local (several stores on one machine, or tests)
+    or a network share. Reading resumes where the last call stopped.
+    """
+
+    def __init__(self, directory=REPLICATION_DIR):
+        self.directory = directory
+        self._positions = {}  # store -> (inode, offset, last seq before offset)
+
+    def __str__(self):
+        return self.directory
+
+    def stores(self):
+        """Names of the stores publishing into the directory"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted({filename.rsplit(".", 1)[0] for filename in os.listdir(self.directory)
+                       if filename.endswith((".events", ".snapshot"))})
+
+    def snapshot(self, store):
+        """A store's snapshot text, or None"""
+        try:
+            with open(os.path.join(self.directory, f"{store}.snapshot"), "r") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def events(self, store, after):
+        """A store's event lines with sequence numbers above after, oldest first"""
+        try:
+            file = open(os.path.join(self.directory, f"{store}.events"), "rb")
+        except FileNotFoundError:
+            return []
+        with file:
+            inode = os.fstat(file.fileno()).st_ino
+            position = self._positions.get(store)
+            if position is not None and position[0] == inode and position[2] <= after:
+                file.seek(position[1])
+            else:
+                position = (inode, 0, 0)
+            data = file.read()
+        end = data.rfind(b"\n") + 1  # a line still being written waits for the next call
+        lines = data[:end].decode().splitlines(keepends=True)
+        if lines:
+            self._positions[store] = (inode, position[1] + end, event_seq(lines[-1]))
+        return [line for line in lines if event_seq(line) > after]
+
+class HTTPTransport:
+    """One store's event log and snapshot fetched from its service"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url.strip().rstrip("/")
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.url
 
-def restock_products():
-    """Handle product restocking"""
-    items = []
-    
-    # Get supplier name with validation
-    while True:
-        supplier_name = input("Enter supplier name: ").strip()
-        if not supplier_name:
-            print("Supplier name cannot be empty!")
-            continue
-        if any(char.isdigit() for char in supplier_name):
-            print("Supplier name should not contain numbers!")
-            continue
-        break
+    def _get(self, path):
+        with urlopen(self.url + path, timeout=self.timeout) as response:
+            return response.read().decode()
 
-    products = read_products()
-    if not products:
-        print("No products database found!")
-        return
-        
-    next_id = max((p['id'] for p in products), default=0) + 1
+    def stores(self):
+        return [json.loads(self._get("/replication"))['store']]
 
-    while True:
-        restock_choice = input("\nDo you want to restock an existing item? (yes/no): ").strip().lower()
-        if not restock_choice:
-            print("Choice cannot be empty!")
-            continue
-        if restock_choice not in ['yes', 'no']:
-            print("Please enter 'yes' or 'no'")
-            continue
-        break
+    def snapshot(self, store):
+        try:
+            return self._get("/replication/snapshot")
+        except OSError as e:
+            if getattr(e, 'code', None) == 404:
+                return None
+            raise
 
-    if restock_choice == 'yes':
+    def events(self, store, after):
+        lines = []
         while True:
+            page = self._get(f"/replication/events?after={after}").splitlines(keepends=True)
+            lines.extend(page)
+            if len(page) < EVENTS_PAGE:
+                return lines
+            after = event_seq(page[-1])
+
+class StoreReplica:
+    """Another store's stock, rebuilt from its snapshot and the events after it"""
+
+    def __init__(self, store):
+        self.store = store
+        self.seq = 0
+        self.products = ProductStore()
+        self.by_id = {}
+        self.loaded = False
+
+    def bootstrap(self, transport):
+        """Load the store's snapshot if it is newer than what we have; return whether it was"""
+        text = transport.snapshot(self.store)
+        if text is None:
+            return False
+        store, seq, products = parse_snapshot(text)
+        if self.loaded and seq <= self.seq:
+            return False
+        self.products, self.by_id, self.seq, self.loaded = products, index_ids(products), seq, True
+        return True
+
+    def catch_up(self, transport):
+        """Apply the store's new events, reloading the snapshot when they do not follow on
+
+        Returns the number of events applied.
+        """
+        if not self.loaded:
+            self.bootstrap(transport)
+            self.loaded = True
+        lines = transport.events(self.store, self.seq)
+        if lines and event_seq(lines[0]) > self.seq + 1 and self.bootstrap(transport):
+            lines = transport.events(self.store, self.seq)
+        applied = 0
+        for line in lines:
+            seq, change = parse_event(line)
+            if seq <= self.seq:
+                continue
+            if seq != self.seq + 1:
+                print(f"Events {self.seq + 1}-{seq - 1} of store {self.store} are missing; waiting for a snapshot")
+                break
+            if change is not None and change.kind == 'snapshot':
+                if not self.bootstrap(transport) or self.seq < seq:
+                    break  # the snapshot is still being written
+                return applied + 1 + self.catch_up(transport)
+            if change is not None:
+                apply_change(self.products, self.by_id, change)
+            self.seq = seq
+            applied += 1
+        return applied
+
+class ReplicaSet:
+    """Replicas of the other stores, fed by one or more transports"""
+
+    def __init__(self, transports, local_store=None):
+        self.transports = transports
+        self.local_store = local_store
+        self.replicas = {}
+
+    def sync(self):
+        """Catch every replica up; return the number of events applied"""
+        applied = 0
+        for transport in self.transports:
             try:
-                display_products()
-                product_id = input("\nEnter product ID: ").strip()
-                
-                if not product_id:
-                    print("Product ID cannot be empty!")
+                stores = transport.stores()
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Cannot reach {transport}: {e}")
+                continue
+            for store in stores:
+                if store == self.local_store:
                     continue
-                    
+                replica = self.replicas.get(store)
+                if replica is None:
+                    replica = self.replicas[store] = StoreReplica(store)
                 try:
-                    product_id = int(product_id)
-                except ValueError:
-                    print("Product ID must be a number!")
-                    continue
-                
-                product = next((p for p in products if p['id'] == product_id), None)
-                if not product:
-                    print(f"Product with ID {product_id} not found!")
-                    retry = input("Would you like to try another ID? (yes/no): ").lower()
-                    if retry != 'yes':
+                    applied += replica.catch_up(transport)
+                except (OSError, ValueError) as e:
+                    print(f"Error replicating store {store} from {transport}: {e}")
+        return applied
+
+def make_replicas(peers=None):
+    """A ReplicaSet over the replication directory and any peer services"""
+    return ReplicaSet([FileTransport()] + [HTTPTransport(url) for url in (PEERS if peers is None else peers)],
+                      events.store or None)
+
+def consolidated_stock(replicas, brand=None, name=None):
+    """Stock of every product in this store and the replicas, matched by name and brand
+
+    Returns (store names, rows); each row has the name, brand, total and a
+    quantity per store. brand must match exactly and name as a substring,
+    both ignoring case.
+    """
+    views = [(events.store or "local", catalog.products)]
+    views.extend((store, replica.products) for store, replica in sorted(replicas.replicas.items()))
+    brand = brand.strip().lower() if brand else None
+    name = name.strip().lower() if name else None
+    rows = {}
+    for store, products in views:
+        strings = products.strings
+        for product_name, brand_code, quantity in zip(products.names, products.brand_codes, products.quantities):
+            product_brand = strings[brand_code]
+            if brand is not None and product_brand.lower() != brand:
+                continue
+            if name is not None and name not in product_name.lower():
+                continue
+            key = (product_name.strip().lower(), product_brand.strip().lower())
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = {'name': product_name, 'brand': product_brand, 'total': 0, 'stores': {}}
+            row['stores'][store] = row['stores'].get(store, 0) + quantity
+            row['total'] += quantity
+    return [store for store, _ in views], sorted(rows.values(), key=lambda row: (row['name'].lower(), row['brand'].lower()))
+
+def show_stores(args):
+    """Print stock across all stores"""
+    read_products()
+    replicas = make_replicas(args.peer or None)
+    replicas.sync()
+    stores, rows = consolidated_stock(replicas, args.brand, args.name)
+    if not rows:
+        print("No matching products found!")
+        return 1
+    shown = rows[:args.top] if args.top else rows
+    header = "{:<30} {:<20}".format('Name', 'Brand') + "".join(f" {store[:12]:>12}" for store in stores) + f" {'Total':>10}"
+    out = [header, "-" * len(header)]
+    for row in shown:
+        out.append("{:<30} {:<20}".format(row['name'][:30], row['brand'][:20])
+                   + "".join(f" {row['stores'].get(store, 0):>12,}" for store in stores) + f" {row['total']:>10,}")
+    out.append("-" * len(header))
+    out.append(f"{len(rows):,} products in {len(stores)} stores"
+               + (f", showing {len(shown):,}" if len(shown) < len(rows) else ""))
+    sys.stdout.write("\n".join(out) + "\n")
+    return 0
+
+def replicate(args):
+    """Snapshot this store, or pull the other stores' events once or continuously"""
+    if args.snapshot:
+        if not events.enabled:
+            print("Set WECARE_STORE to this shop's name first!")
+            return 2
+        seq = events.write_snapshot(make_storage())
+        print(f"✓ Snapshot of store {events.store} written at event {seq:,}: {events.snapshot_path}")
+        return 0
+    replicas = make_replicas(args.peer or None)
+    while True:
+        start = time.perf_counter()
+        applied = replicas.sync()
+        if not args.follow or applied:
+            for store, replica in sorted(replicas.replicas.items()):
+                print(f"{store:<20} event {replica.seq:>10,}  {len(replica.products):>10,} products  "
+                      f"{sum(replica.products.quantities):>12,} units")
+            print(f"✓ Applied {applied:,} events in {time.perf_counter() - start:.3f}s")
+        if not args.follow:
+            return 0 if replicas.replicas else 1
+        time.sleep(args.follow)
+
+class HTTPError(Exception):
+    """Request failure reported to the client with a status code"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def product_json(product):
+    """JSON-ready product with its marked up selling price"""
+    data = product.to_dict()
+    data['selling_price'] = round(catalog.selling_price(product), 2)
+    return data
+
+def query_value(query, name, convert=str, default=None):
+    """Return one query string parameter converted, or raise a 400 HTTPError"""
+    values = query.get(name)
+    if not values or values[-1] == "":
+        return default
+    try:
+        return convert(values[-1])
+    except ValueError:
+        raise HTTPError(400, f"Invalid value for {name}: {values[-1]!r}")
+
+def query_flag(value):
+    return value.lower() in ("1", "true", "yes")
+
+class ProductService:
+    """HTTP/JSON front end for several terminals sharing one in-memory catalog
+
+    Reads are answered on the event loop straight from the catalog. Stock
+    changes run one at a time on a single writer thread, so they never
+    interleave with each other. The writer only takes the catalog lock
+    that reads use to apply a change in memory after it is committed, so
+    a slow ledger fsync does not hold up reads. Sales that arrive while the writer is busy are processed
+    together as one batch, with one reservation and one ledger write; an
+    order that cannot be processed is rejected on its own. The writer also
+    picks up changes made by other processes.
+
+        GET  /products?brand=&origin=&min_price=&max_price=&in_stock=&sort=&desc=&page=&page_size=
+        GET  /products/<id>
+        GET  /search?q=&limit=
+        POST /sales      an order as in batch mode: {"customer": ..., "items": [...]}
+        POST /restock    {"supplier": ..., "items": [manifest lines], "skip_invalid": false}
+        GET  /invoices/<invoice no>
+        GET  /invoices?party=&date=&kind=
+        GET  /reorder?brand=&origin=
+        GET  /metrics    Prometheus text format, when WECARE_METRICS is set
+        GET  /stores?brand=&name=          stock per store across all replicated stores
+        GET  /replication                  this store's name, when WECARE_STORE is set
+        GET  /replication/events?after=    its event log as text, a page at a time
+        GET  /replication/snapshot         its latest stock snapshot as text
+    """
+
+    def __init__(self, poll_interval=SERVICE_POLL_INTERVAL, replicas=None):
+        self.poll_interval = poll_interval
+        self.replicas = replicas if replicas is not None else ReplicaSet([])
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stock-writer")
+        self.reader = ThreadPoolExecutor(max_workers=4, thread_name_prefix="invoice-reader")
+        self.pending_sales = []
+        self.sales_task = None
+
+    async def write(self, func, *args):
+        """Run a stock change on the writer thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.writer, func, *args)
+
+    async def sell(self, order):
+        """Queue an order for the next sales batch and return its result"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending_sales.append((order, future))
+        if self.sales_task is None or self.sales_task.done():
+            self.sales_task = asyncio.create_task(self.process_sales())
+        return await future
+
+    async def process_sales(self):
+        while self.pending_sales:
+            batch, self.pending_sales = self.pending_sales, []
+            try:
+                results = await self.write(process_orders, [order for order, _ in batch])
+            except Exception as e:
+                # process_orders() rejects bad orders itself; this is a storage failure
+                # and nothing in the batch was sold
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+    def warm_up(self):
+        """Build the search index and sort orders before the first request needs them"""
+        read_products()
+        catalog.search("")
+        for sort in SORT_KEYS:
+            catalog.list_products(sort=sort, limit=1)
+        catalog.list_products(in_stock=True, sort='price', limit=1)
+        catalog.watch_low_stock()
+
+    async def poll(self):
+        """Keep the catalog in step with other terminals"""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.write(read_products)
+            await self.write(self.replicas.sync)
+
+    async def route(self, method, path, query, body):
+        """Return (status, payload) for one request"""
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if method == "GET" and parts == ["products"]:
+            page = query_value(query, 'page', int, 1)
+            page_size = query_value(query, 'page_size', int, PAGE_SIZE)
+            if page < 1 or page_size < 1:
+                raise HTTPError(400, "Page and page size must be positive!")
+            sort = query_value(query, 'sort', default='id')
+            if sort not in SORT_KEYS:
+                raise HTTPError(400, f"sort must be one of {', '.join(SORT_KEYS)}")
+            # Prices in requests are selling prices; the catalog stores cost prices
+            prices = selling_price_range(query_value(query, 'min_price', float),
+                                         query_value(query, 'max_price', float))
+            rows, total = catalog.list_products(
+                brand=query_value(query, 'brand'), origin=query_value(query, 'origin'), **prices,
+                in_stock=query_value(query, 'in_stock', query_flag, False), sort=sort,
+                descending=query_value(query, 'desc', query_flag, False),
+                offset=(page - 1) * page_size, limit=page_size)
+            return 200, {'total': total, 'page': page, 'page_size': page_size,
+                         'products': [product_json(row) for row in rows]}
+        if method == "GET" and len(parts) == 2 and parts[0] == "products":
+            try:
+                product = catalog.get(int(parts[1]))
+            except ValueError:
+                raise HTTPError(400, "Product ID must be a number!")
+            if product is None:
+                raise HTTPError(404, f"Product with ID {parts[1]} not found!")
+            return 200, product_json(product)
+        if method == "GET" and parts == ["search"]:
+            text = query_value(query, 'q', default="")
+            if not text.strip():
+                raise HTTPError(400, "Search query cannot be empty!")
+            limit = query_value(query, 'limit', int, SEARCH_LIMIT)
+            if limit < 1:
+                raise HTTPError(400, "Limit must be positive!")
+            rows = catalog.search(text, limit)
+            return 200, {'query': text, 'products': [product_json(row) for row in rows]}
+        if method == "POST" and parts == ["sales"]:
+            order = self.parse_body(body)
+            result = await self.sell(order)
+            return (200 if result['status'] == "ok" else 422), result
+        if method == "POST" and parts == ["quote"]:
+            lines = self.parse_body(body).get('items')
+            if not isinstance(lines, list):
+                raise HTTPError(400, "items must be a list of {id, quantity} objects")
+            try:
+                lines = [(int(line['id']), int(line.get('quantity', 1))) for line in lines]
+            except (TypeError, KeyError, AttributeError, ValueError, OverflowError):
+                raise HTTPError(400, "items must be a list of {id, quantity} objects with whole numbers")
+            try:
+                items, total = quote_sale(lines)
+            except ValueError as e:
+                raise HTTPError(422, str(e))
+            return 200, {'items': items, 'total': round(total, 2)}
+        if method == "POST" and parts == ["restock"]:
+            shipment = self.parse_body(body)
+            lines = shipment.get('items')
+            if not isinstance(lines, list):
+                raise HTTPError(400, "items must be a list of manifest lines")
+            lines = [(n, line if isinstance(line, dict) else {'error': "Expected a JSON object"})
+                     for n, line in enumerate(lines, 1)]
+            result = await self.write(receive_shipment, shipment.get('supplier'), lines,
+                                      bool(shipment.get('skip_invalid')))
+            return (200 if result['status'] == "ok" else 422), result
+        if method == "GET" and parts[0] == "invoices" and len(parts) <= 2:
+            loop = asyncio.get_running_loop()
+            if len(parts) == 2:
+                text = await loop.run_in_executor(self.reader, invoice_archive.get, parts[1])
+                if text is None:
+                    raise HTTPError(404, f"Invoice {parts[1]} not found!")
+                return 200, text
+            party, day, kind = (query_value(query, name) for name in ('party', 'date', 'kind'))
+            if not (party or day or kind):
+                raise HTTPError(400, "Give at least one of party, date, kind")
+            entries = await loop.run_in_executor(self.reader, invoice_archive.find, party, day, kind)
+            return 200, {'invoices': [{key: entry[key] for key in ('invoice_no', 'kind', 'party', 'created')}
+                                      for entry in entries]}
+        if method == "GET" and parts == ["reorder"]:
+            groups = catalog.reorder_suggestions(query_value(query, 'brand'), query_value(query, 'origin'))
+            return 200, {'groups': [{'brand': brand, 'origin': origin,
+                                     'items': [dict(product.to_dict(), quantity=quantity, stock=product['quantity'])
+                                               for product, quantity in lines]}
+                                    for brand, origin, lines in groups]}
+        if method == "GET" and parts == ["metrics"]:
+            if not metrics.enabled:
+                raise HTTPError(404, "Metrics are disabled; set WECARE_METRICS to a metrics file")
+            return 200, metrics.render()
+        if method == "GET" and parts == ["stores"]:
+            stores, rows = await self.write(consolidated_stock, self.replicas,
+                                            query_value(query, 'brand'), query_value(query, 'name'))
+            return 200, {'stores': stores, 'products': rows}
+        if method == "GET" and parts[0] == "replication" and len(parts) <= 2:
+            if not events.enabled:
+                raise HTTPError(404, "This store does not publish events; set WECARE_STORE")
+            loop = asyncio.get_running_loop()
+            if len(parts) == 1:
+                return 200, {'store': events.store}
+            if parts[1] == "events":
+                after = query_value(query, 'after', int, 0)
+                lines = await loop.run_in_executor(self.reader, self.event_page, after)
+                return 200, "".join(lines)
+            if parts[1] == "snapshot":
+                text = await loop.run_in_executor(self.reader, self.transport.snapshot, events.store)
+                if text is None:
+                    raise HTTPError(404, "No snapshot yet")
+                return 200, text
+            raise HTTPError(404, f"No such endpoint: {path}")
+        if parts[0] in SERVICE_ENDPOINTS:
+            raise HTTPError(405, f"{method} is not allowed here")
+        raise HTTPError(404, f"No such endpoint: {path}")
+
+    @functools.cached_property
+    def transport(self):
+        """This store's own event log, read the way a replica would"""
+        return FileTransport(events.directory)
+
+    def event_page(self, after):
+        return self.transport.events(events.store, after)[:EVENTS_PAGE]
+
+    def parse_body(self, body):
+        try:
+            data = json.loads(body or b"null")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON: {e}")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Expected a JSON object")
+        return data
+
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until it closes"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
                         break
-                    continue
-                
-                print(f"Current stock for {product['name']}: {product['quantity']}")
-                
-                quantity = input("Enter quantity to restock: ").strip()
-                if not quantity:
-                    print("Quantity cannot be empty!")
-                    continue
-                    
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
                 try:
-                    quantity = int(quantity)
+                    method, target, version = request_line.decode("latin-1").split()
+                    length = int(headers.get('content-length', 0))
                 except ValueError:
-                    print("Quantity must be a number!")
-                    continue
-                
-                if quantity <= 0:
-                    print("Quantity must be positive!")
-                    continue
-                
-                if quantity > 10000:  # Reasonable upper limit
-                    print("Quantity exceeds maximum limit of 10,000!")
-                    continue
-                    
-                product['quantity'] += quantity
-                items.append({
-                    'name': product['name'],
-                    'brand': product['brand'],
-                    'quantity': quantity,
-                    'price': product['price']
-                })
-                
-                while True:
-                    more = input("\nWould you like to restock more existing items? (yes/no): ").strip().lower()
-                    if not more:
-                        print("Choice cannot be empty!")
-                        continue
-                    if more not in ['yes', 'no']:
-                        print("Please enter 'yes' or 'no'")
-                        continue
+                    await self.respond(writer, 400, {'error': "Malformed request"}, False)
                     break
-                
-                if more == 'no':
+                keep_alive = headers.get('connection', "").lower() != "close" and version == "HTTP/1.1"
+                if length > MAX_REQUEST_BODY:
+                    await self.respond(writer, 413, {'error': "Request body too large"}, False)
                     break
-                    
-            except Exception as e:
-                print(f"An error occurred: {str(e)}")
-                print("Please try again.")
-                continue
-    else:
-        while True:
-            add_new = input("\nDo you want to add new products? (yes/no): ").strip().lower()
-            if not add_new:
-                print("Choice cannot be empty!")
-                continue
-            if add_new not in ['yes', 'no']:
-                print("Please enter 'yes' or 'no'")
-                continue
-            break
-
-        if add_new == 'yes':
-            while True:
+                body = await reader.readexactly(length) if length else b""
+                url = urlsplit(target)
+                start = time.perf_counter()
                 try:
-                    name = input("\nEnter product name: ").strip()
-                    if not name:
-                        print("Product name cannot be empty!")
-                        continue
-                        
-                    brand = input("Enter brand: ").strip()
-                    if not brand:
-                        print("Brand cannot be empty!")
-                        continue
-                    
-                    quantity = input("Enter quantity: ").strip()
-                    if not quantity:
-                        print("Quantity cannot be empty!")
-                        continue
-                    try:
-                        quantity = int(quantity)
-                        if quantity <= 0:
-                            print("Quantity must be positive!")
-                            continue
-                        if quantity > 10000:
-                            print("Quantity exceeds maximum limit of 10,000!")
-                            continue
-                    except ValueError:
-                        print("Quantity must be a number!")
-                        continue
-                    
-                    price = input("Enter cost price: ").strip()
-                    if not price:
-                        print("Price cannot be empty!")
-                        continue
-                    try:
-                        price = float(price)
-                        if price <= 0:
-                            print("Price must be positive!")
-                            continue
-                        if price > 1000000:
-                            print("Price exceeds maximum limit of 1,000,000!")
-                            continue
-                    except ValueError:
-                        print("Price must be a number!")
-                        continue
-                    
-                    origin = input("Enter origin country: ").strip()
-                    if not origin:
-                        print("Origin cannot be empty!")
-                        continue
-                    if any(char.isdigit() for char in origin):
-                        print("Origin should not contain numbers!")
-                        continue
-                    
-                    products.append({
-                        'id': next_id,
-                        'name': name,
-                        'brand': brand,
-                        'quantity': quantity,
-                        'price': price,
-                        'origin': origin
-                    })
-                    
-                    items.append({
-                        'name': name,
-                        'brand': brand,
-                        'quantity': quantity,
-                        'price': price
-                    })
-                    
-                    next_id += 1
-                    
-                    while True:
-                        more = input("\nWould you like to add more new products? (yes/no): ").strip().lower()
-                        if not more:
-                            print("Choice cannot be empty!")
-                            continue
-                        if more not in ['yes', 'no']:
-                            print("Please enter 'yes' or 'no'")
-                            continue
-                        break
-                    
-                    if more == 'no':
-                        break
-                        
+                    status, payload = await self.route(method, url.path, parse_qs(url.query), body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
                 except Exception as e:
-                    print(f"An error occurred: {str(e)}")
-                    print("Please try again.")
-                    continue
-    
-    if items:
+                    status, payload = 500, {'error': str(e)}
+                if metrics.enabled:
+                    endpoint = url.path.strip("/").split("/")[0]
+                    metrics.observe(f"http_{method.lower()}_{endpoint if endpoint in SERVICE_ENDPOINTS else 'other'}",
+                                    time.perf_counter() - start)
+                    metrics.add("http_requests_total", status=status)
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            data, content_type = payload.encode(), "text/plain; charset=utf-8"
+        else:
+            data, content_type = json.dumps(payload).encode(), "application/json"
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode() + data)
+        await writer.drain()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        """Load the catalog and serve requests until cancelled or sent SIGTERM"""
+        await self.write(self.warm_up)
+        server = await asyncio.start_server(self.handle, host, port)
+        poller = asyncio.create_task(self.poll())
+        stop = asyncio.Event()
         try:
-            save_products(products)
-            filepath = create_purchase_invoice(supplier_name, items)
-            print(f"\n✓ Restock invoice created successfully: {filepath}")
-        except Exception as e:
-            print(f"Error saving transaction: {str(e)}")
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        except (NotImplementedError, AttributeError):  # Windows
+            pass
+        address = server.sockets[0].getsockname()
+        print(f"Serving {len(catalog.products):,} products on http://{address[0]}:{address[1]}", flush=True)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            poller.cancel()
+            self.writer.shutdown()
+            self.reader.shutdown()
+            invoice_writer.shutdown()
+
+def run_service(host=SERVICE_HOST, port=SERVICE_PORT):
+    """Run the HTTP service until interrupted"""
+    try:
+        asyncio.run(ProductService(replicas=make_replicas()).serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    print("Service stopped")
+    return 0
 
 def main():
     """Main program loop"""
@@ -584,12 +5165,13 @@ def main():
             choice = int(input("Enter your choice: "))
             
             if choice == 1:
-                display_products()
+                browse_products()
             elif choice == 2:
                 sell_products()
             elif choice == 3:
                 restock_products()
             elif choice == 4:
+                invoice_writer.shutdown()
                 print("Thank you for using WeCare Product Management System!")
                 break
             else:
@@ -602,5 +5184,152 @@ def main():
         
         input("\nPress Enter to continue...")
 
+def build_parser():
+    """Command line interface; without a command the interactive menu runs"""
+    parser = argparse.ArgumentParser(description="WeCare Product Management System")
+    sub = parser.add_subparsers(dest="command")
+
+    importer = sub.add_parser("import-sqlite", help="copy the text catalog into an SQLite database")
+    importer.add_argument("--source", default=PRODUCTS_FILE, help="products text file")
+    importer.add_argument("--database", default=SQLITE_FILE, help="SQLite database to (re)create")
+
+    batch = sub.add_parser("batch", help="process a JSONL/CSV file of orders without prompts")
+    batch.add_argument("orders", help="orders file, or - to read from stdin")
+    batch.add_argument("--format", choices=("jsonl", "csv"), help="default: from the file extension")
+    batch.add_argument("--results", help="write per-order JSON results here (default: stdout)")
+
+    restock = sub.add_parser("restock", help="receive a supplier CSV/JSONL manifest in one go")
+    restock.add_argument("manifest", help="manifest file, or - to read from stdin")
+    restock.add_argument("--supplier", required=True, help="supplier name for the purchase invoice")
+    restock.add_argument("--format", choices=("jsonl", "csv"), help="default: from the file extension")
+    restock.add_argument("--skip-invalid", action="store_true",
+                         help="import the valid lines even if some are rejected")
+
+    reorder = sub.add_parser("reorder", help="suggest a restock manifest for low-stock products")
+    reorder.add_argument("--brand")
+    reorder.add_argument("--origin")
+    reorder.add_argument("--output", help="manifest file to write (default: stdout)")
+
+    reorder_point = sub.add_parser("reorder-point", help="set a product's reorder threshold")
+    reorder_point.add_argument("product_id", type=int)
+    reorder_point.add_argument("threshold", type=int, help="alert and reorder at or below this stock")
+    reorder_point.add_argument("--order-up-to", type=int,
+                               help=f"stock level to restock to (default: {REORDER_COVER}x the threshold)")
+
+    invoices = sub.add_parser("invoice", help="fetch archived invoices")
+    invoices.add_argument("invoice_no", nargs="?", help="invoice number (or locator) to print")
+    invoices.add_argument("--party", help="customer or supplier name")
+    invoices.add_argument("--date", help="day as YYYY-MM-DD")
+    invoices.add_argument("--kind", choices=("sale", "restock"))
+    invoices.add_argument("--list", action="store_true", help="only list matching invoices")
+    invoices.add_argument("--import-loose", action="store_true",
+                          help="move old per-file invoices into the archive first")
+
+    listing = sub.add_parser("list", help="list products a page at a time")
+    listing.add_argument("--brand")
+    listing.add_argument("--origin")
+    listing.add_argument("--min-price", type=float, help="lowest selling price (NPR)")
+    listing.add_argument("--max-price", type=float, help="highest selling price (NPR)")
+    listing.add_argument("--in-stock", action="store_true", help="hide products with no stock")
+    listing.add_argument("--sort", choices=SORT_KEYS, default="id")
+    listing.add_argument("--desc", action="store_true", help="sort in descending order")
+    listing.add_argument("--page", type=int, default=1)
+    listing.add_argument("--page-size", type=int, default=PAGE_SIZE)
+
+    quote = sub.add_parser("quote", help="price a basket with the current markups and promotions")
+    quote.add_argument("items", nargs="+", help="ID or ID:QUANTITY per line")
+
+    searcher = sub.add_parser("search", help="find products by name or brand")
+    searcher.add_argument("query", nargs="+", help="words to match; prefixes and typos are allowed")
+    searcher.add_argument("--limit", type=int, default=SEARCH_LIMIT)
+
+    service = sub.add_parser("serve", help="serve the catalog to terminals over HTTP/JSON")
+    service.add_argument("--host", default=SERVICE_HOST)
+    service.add_argument("--port", type=int, default=SERVICE_PORT, help="0 picks a free port")
+
+    report = sub.add_parser("report", help="sales totals from the transaction log (roughly 60k line "
+                            "items/s per worker by product, 120k by other dimensions)")
+    report.add_argument("--by", choices=REPORT_DIMENSIONS, default="product")
+    report.add_argument("--sort", choices=REPORT_SORTS, default="revenue")
+    report.add_argument("--top", type=int, default=20, help="rows to show, 0 for all")
+    report.add_argument("--since", help="first day as YYYY-MM-DD")
+    report.add_argument("--until", help="last day as YYYY-MM-DD")
+    report.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+
+    closing = sub.add_parser("end-of-day", help="re-render a day's invoices and export its line items")
+    closing.add_argument("--date", help="day as YYYY-MM-DD (default: today)")
+    closing.add_argument("--export-dir", default=EXPORT_DIR)
+    closing.add_argument("--format", choices=EXPORT_FORMATS, action="append",
+                         help="line-item export; repeat for both (default: both)")
+    closing.add_argument("--rearchive", action="store_true",
+                         help="also replace the archived invoices with the re-rendered ones")
+    closing.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+
+    replication = sub.add_parser("replicate", help="snapshot this store or pull the other stores' events")
+    replication.add_argument("--snapshot", action="store_true",
+                             help="write this store's snapshot now (needs WECARE_STORE)")
+    replication.add_argument("--peer", action="append", help="another store's service URL; repeatable")
+    replication.add_argument("--follow", type=float, metavar="SECONDS", help="keep pulling at this interval")
+
+    stores = sub.add_parser("stores", help="stock of products across every store")
+    stores.add_argument("--brand")
+    stores.add_argument("--name", help="part of the product name")
+    stores.add_argument("--peer", action="append", help="another store's service URL; repeatable")
+    stores.add_argument("--top", type=int, default=0, help="rows to show, 0 for all")
+    return parser
+
+def run_command(args):
+    """Run a non-interactive command"""
+    if args.command == "import-sqlite":
+        try:
+            count = SQLiteStorage(args.database).import_text(args.source)
+        except FileNotFoundError:
+            print("Products file not found!")
+            return 1
+        print(f"✓ Imported {count} products into {args.database}")
+    elif args.command == "batch":
+        return run_batch(args.orders, args.format, args.results)
+    elif args.command == "restock":
+        return import_manifest(args.manifest, args.supplier, args.format, args.skip_invalid)
+    elif args.command == "reorder":
+        return suggest_restock(args.brand, args.origin, args.output)
+    elif args.command == "reorder-point":
+        return set_reorder_point(args.product_id, args.threshold, args.order_up_to)
+    elif args.command == "invoice":
+        return query_invoices(args)
+    elif args.command == "list":
+        if args.page < 1 or args.page_size < 1:
+            print("Page and page size must be positive!")
+            return 2
+        # Listed prices include the markup; the catalog stores cost prices
+        pages = display_products(args.page, args.page_size, brand=args.brand, origin=args.origin,
+                                 **selling_price_range(args.min_price, args.max_price),
+                                 in_stock=args.in_stock, sort=args.sort, descending=args.desc)
+        if args.page > pages:
+            print(f"Page {args.page} is past the last page ({pages})")
+            return 1
+    elif args.command == "search":
+        if args.limit < 1:
+            print("Limit must be positive!")
+            return 2
+        return 0 if display_search_results(" ".join(args.query), args.limit) else 1
+    elif args.command == "quote":
+        return print_quote(args.items)
+    elif args.command == "serve":
+        return run_service(args.host, args.port)
+    elif args.command == "report":
+        return sales_report(args)
+    elif args.command == "end-of-day":
+        return end_of_day(args)
+    elif args.command == "replicate":
+        return replicate(args)
+    elif args.command == "stores":
+        return show_stores(args)
+    return 0
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = build_parser().parse_args()
+    if args.command is None:
+        profiled(main)
+    else:
+        sys.exit(profiled(run_command, args))
\ No newline at end of file